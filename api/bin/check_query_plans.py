@@ -0,0 +1,103 @@
+"""Fail when any statement in api/database_query.py falls back to a full table scan.
+
+Builds throwaway in-memory databases from api/share (schema, seed data and
+every migration) and runs EXPLAIN QUERY PLAN on each catalogue statement
+with all parameters bound to NULL. Any "SCAN <table>" of a real table is a
+failure, including "SCAN <table> USING [COVERING] INDEX", which still reads
+every entry of the index. Scans of subqueries, CTEs and table-valued
+functions like json_each are not. The roster statements, which
+DatabaseManager.stream serves a batch at a time, also fail on a
+"USE TEMP B-TREE FOR ORDER BY" that sorts every row before the first one
+comes out (sorting the "RIGHT PART" one section at a time is fine).
+
+Exits non-zero on any failure; `make check` runs it.
+
+Usage (from the repository root):
+    python -m api.bin.check_query_plans [-v]
+"""
+
+import argparse
+import glob
+import re
+import sqlite3
+import sys
+
+from api.database_query import ENROLLMENTS_STATEMENTS, USERS_STATEMENTS, _PARAMETER_PATTERN
+
+ENROLLMENTS_SCRIPTS = ["./api/share/enrollments.sql"] + sorted(glob.glob("./api/share/migrations/*.sql"))
+USERS_SCRIPTS = ["./api/share/users.sql"]
+
+SQL_KEYWORDS = {"AS", "ON", "JOIN", "LEFT", "INNER", "CROSS", "WHERE", "GROUP", "ORDER", "LIMIT", "SET",
+                "USING", "NATURAL", "UNION", "WINDOW", "VALUES", "SELECT"}
+TABLE_REFERENCE = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+"?(\w+)"?(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+FULL_SORT = "USE TEMP B-TREE FOR ORDER BY"
+STREAMED_STATEMENTS = {"roster", "roster_by_course", "roster_by_section", "roster_by_course_section"}
+FULL_SCAN = re.compile(r"^SCAN (\w+)(?: USING (?:COVERING )?INDEX \w+)?$")
+
+
+def open_database(scripts):
+    connection = sqlite3.connect(":memory:")
+    for script in scripts:
+        with open(script) as sql:
+            connection.executescript(sql.read())
+    return connection
+
+
+def table_aliases(sql, tables):
+    """Map every name a statement uses for a real table (the table itself or its alias) to the table."""
+    aliases = {}
+    for table, alias in TABLE_REFERENCE.findall(sql):
+        if table.lower() not in tables:
+            continue
+        aliases[table.lower()] = table
+        if alias and alias.upper() not in SQL_KEYWORDS:
+            aliases[alias.lower()] = table
+    return aliases
+
+
+def full_scans(connection, sql):
+    tables = {row[0].lower() for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    aliases = table_aliases(sql, tables)
+    params = {name: None for name in _PARAMETER_PATTERN.findall(sql)}
+    plan = [row[3] for row in connection.execute("EXPLAIN QUERY PLAN " + sql, params)]
+    scans = []
+    for detail in plan:
+        match = FULL_SCAN.match(detail)
+        if match and match.group(1).lower() in aliases:
+            scans.append(aliases[match.group(1).lower()])
+    return plan, scans
+
+
+def check(connection, statements, verbose):
+    failures = 0
+    for name, sql in statements.items():
+        plan, scans = full_scans(connection, sql)
+        sorted_up_front = name in STREAMED_STATEMENTS and FULL_SORT in plan
+        if scans:
+            failures += 1
+            print(f"FAIL {name}: full scan of {', '.join(scans)}")
+        elif sorted_up_front:
+            failures += 1
+            print(f"FAIL {name}: sorts every row before returning the first")
+        elif verbose:
+            print(f"ok   {name}")
+        if verbose or scans or sorted_up_front:
+            for detail in plan:
+                print(f"       {detail}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every plan, not only failures")
+    args = parser.parse_args()
+
+    failures = check(open_database(USERS_SCRIPTS), USERS_STATEMENTS, args.verbose)
+    failures += check(open_database(ENROLLMENTS_SCRIPTS), ENROLLMENTS_STATEMENTS, args.verbose)
+    total = len(USERS_STATEMENTS) + len(ENROLLMENTS_STATEMENTS)
+    print(f"{total - failures}/{total} statements use indexes")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
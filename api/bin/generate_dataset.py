@@ -0,0 +1,303 @@
+"""Build large, reproducible enrollments and users databases for benchmarks.
+
+Starts from the same scripts as api/bin/init.sh (schema and hand-written
+seed rows), bulk-loads generated departments, classes, sections,
+instructors, students and registrations on top, then applies every
+migration so indexes are built once over the loaded rows and waitlist
+positions are backfilled. The same --seed always produces the same rows.
+
+Registrations are replayed in a shuffled arrival order against each
+section's capacity. Students enroll while seats are free and join the
+waitlist once the section is full, up to the WAITLIST_ALLOWED + 1 (16)
+spots the service's claim_waitlist_spot admits, and --drop-rate of the
+attempts end up dropped. The section counters match the registration
+rows afterwards. Section popularity is skewed, so the popular sections
+fill up and grow waitlists.
+
+Generated users are written to both the enrollments Users table and the
+LiteFS users database. They all share one PBKDF2 hash of --password, so
+the password is hashed once, not once per user. --accounts writes their
+logins as JSONL for benchmarks/load_test.py.
+
+The users database is built in --users-staging, outside the LiteFS mount,
+and then handed to the running primary with `litefs import`, so LiteFS
+records it as one transaction and ships it to the replicas. Without the
+litefs binary, --users-import sqlite copies it in through the mount with
+SQLite's backup API, which writes through LiteFS's journal like any
+other client. Files inside the mount are never deleted or written with
+journaling off.
+
+Usage (from the repository root):
+    python -m api.bin.generate_dataset [--students 50000] [--registrations-per-student 12] [--seed 449] [--force]
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import time
+
+from api.database_query import WAITLIST_ALLOWED
+from api.utils import hash_password
+
+ENROLLMENTS_SQL = "./api/share/enrollments.sql"
+ENROLLMENTS_MIGRATIONS = sorted(glob.glob("./api/share/migrations/*.sql"))
+USERS_SQL = "./api/share/users.sql"
+ENROLLMENTS_DB = "./api/var/enrollments.db"
+USERS_DB = "./api/var/primary/fuse/users.db"
+USERS_STAGING_DB = "./api/var/users-import.db"
+LITEFS = "./api/bin/litefs"
+
+BATCH_SIZE = 50000
+REGISTRATION_OPENS = "2023-08-01 08:00:00"
+
+DEPARTMENTS = [
+    ("Computer Science", "COMP"), ("Mathematics", "MATH"), ("Physics", "PHYS"), ("Chemistry", "CHEM"),
+    ("Biology", "BIOL"), ("Psychology", "PSYC"), ("English", "ENGL"), ("History", "HIST"),
+    ("Economics", "ECON"), ("Philosophy", "PHIL"), ("Art", "ARTS"), ("Music", "MUSC"),
+    ("Sociology", "SOCI"), ("Political Science", "POSC"), ("Geology", "GEOL"), ("Business", "BUSN"),
+    ("Nursing", "NURS"), ("Kinesiology", "KINE"), ("Communications", "COMM"), ("Engineering", "ENGR"),
+]
+COURSE_TOPICS = ["Introduction to", "Foundations of", "Topics in", "Advanced", "Seminar in", "Methods in",
+                 "Principles of", "Applied", "Theory of", "Studies in"]
+FIRST_NAMES = ["Emma", "Liam", "Olivia", "Noah", "Ava", "Elijah", "Sophia", "James", "Isabella", "Lucas",
+               "Mia", "Mason", "Amelia", "Ethan", "Harper", "Logan", "Evelyn", "Aiden", "Abigail", "Jackson",
+               "Maria", "Jose", "Wei", "Priya", "Hiroshi", "Fatima", "Omar", "Chloe", "Mateo", "Aaliyah"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez",
+              "Martinez", "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore",
+              "Jackson", "Martin", "Lee", "Perez", "Thompson", "White", "Harris", "Sanchez", "Clark", "Nguyen",
+              "Kim", "Patel"]
+MIDDLE_INITIALS = [f"{letter}." for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"] + [None] * 8
+
+
+def departments(count):
+    """count (name, code) pairs, numbering repeats once the named list runs out."""
+    result = []
+    for index in range(count):
+        name, code = DEPARTMENTS[index % len(DEPARTMENTS)]
+        round_number = index // len(DEPARTMENTS)
+        result.append((f"{name} {round_number + 1}", f"{code}{round_number + 1}") if round_number else (name, code))
+    return result
+
+
+def people(rng, first_cwid, count, role):
+    return [(first_cwid + index, rng.choice(FIRST_NAMES), rng.choice(MIDDLE_INITIALS), rng.choice(LAST_NAMES),
+             f"{role}{first_cwid + index}", role) for index in range(count)]
+
+
+def catalog(rng, args, instructors):
+    classes, sections = [], []
+    for department, code in departments(args.departments):
+        for number in range(args.courses_per_department):
+            course_code = f"{code}-{1000 + number}"
+            classes.append((course_code, f"{rng.choice(COURSE_TOPICS)} {department} {number + 1}", department))
+            for section_number in range(1, rng.randint(1, args.sections_per_course) + 1):
+                sections.append([section_number, course_code, rng.choice(instructors)[0],
+                                 rng.randint(args.min_seats, args.max_seats)])
+    return classes, sections
+
+
+def registrations(rng, args, students, sections):
+    """Registration rows in arrival order plus each section's final (enrolled, waitlisted) counts.
+
+    Rows carry their arrival as seconds after REGISTRATION_OPENS rather
+    than a date, SQLite formats the dates while loading.
+    """
+    # a few popular sections draw most of the demand
+    popularity = [rng.paretovariate(2.5) for _ in sections]
+    cumulative, total = [], 0.0
+    for weight in popularity:
+        total += weight
+        cumulative.append(total)
+    section_indexes = range(len(sections))
+
+    attempts = []
+    for student in students:
+        wanted = max(1, round(rng.gauss(args.registrations_per_student, 2)))
+        courses = set()
+        for index in rng.choices(section_indexes, cum_weights=cumulative, k=wanted * 2):
+            course_code = sections[index][1]
+            if course_code not in courses:
+                courses.add(course_code)
+                attempts.append((student[0], index))
+                if len(courses) == wanted:
+                    break
+    rng.shuffle(attempts)
+
+    enrolled = [0] * len(sections)
+    waitlisted = [0] * len(sections)
+    rows = []
+    for arrival, (student_id, index) in enumerate(attempts):
+        if rng.random() < args.drop_rate:
+            status = 'dropped'
+        elif enrolled[index] < sections[index][3]:
+            status = 'enrolled'
+            enrolled[index] += 1
+        elif waitlisted[index] <= WAITLIST_ALLOWED:
+            # claim_waitlist_spot admits while Waitlist <= WAITLIST_ALLOWED, one more than the constant
+            status = 'waitlisted'
+            waitlisted[index] += 1
+        else:
+            # turned away, the section and its waitlist are full
+            continue
+        rows.append((student_id, sections[index][1], sections[index][0], arrival, status))
+    return rows, enrolled, waitlisted
+
+
+def run_script(connection, path):
+    with open(path) as sql:
+        connection.executescript(sql.read())
+
+
+def insert_batches(connection, sql, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        connection.executemany(sql, rows[start:start + BATCH_SIZE])
+
+
+def prepare(path, force):
+    if os.path.exists(path):
+        if not force:
+            raise SystemExit(f"{path} exists, pass --force to replace it")
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    connection = sqlite3.connect(path, isolation_level=None)
+    # a throwaway build, durability only matters once it is finished
+    connection.execute("PRAGMA journal_mode=OFF")
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.execute("PRAGMA cache_size=-262144")
+    connection.execute("PRAGMA temp_store=MEMORY")
+    # lets CREATE INDEX sort with helper threads on multi-core machines
+    connection.execute("PRAGMA threads=4")
+    return connection
+
+
+def build_enrollments(args, users, classes, sections, rows, enrolled, waitlisted, closed):
+    connection = prepare(args.enrollments_db, args.force)
+    run_script(connection, ENROLLMENTS_SQL)
+    connection.execute("BEGIN")
+    insert_batches(connection, "INSERT INTO Users (CWID, Name, Middle, LastName, Role) VALUES (?, ?, ?, ?, ?)",
+                   [(cwid, name, middle, last_name, role) for cwid, name, middle, last_name, _, role in users])
+    insert_batches(connection, "INSERT INTO Class (CourseCode, Name, Department) VALUES (?, ?, ?)", classes)
+    insert_batches(connection,
+                   "INSERT INTO Section (SectionNumber, CourseCode, InstructorID, MaxEnrollment, CurrentEnrollment, "
+                   "Waitlist, SectionStatus) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   [(*section, enrolled[index], waitlisted[index], 'closed' if index in closed else 'open')
+                    for index, section in enumerate(sections)])
+    # RecordID is AUTOINCREMENT, which rewrites sqlite_sequence after every
+    # statement; one INSERT ... SELECT from a staging table updates it once
+    connection.execute("CREATE TEMP TABLE RegistrationLoad (StudentID, CourseCode, SectionNumber, Arrival, Status)")
+    insert_batches(connection, "INSERT INTO RegistrationLoad VALUES (?, ?, ?, ?, ?)", rows)
+    connection.execute(
+        "INSERT INTO RegistrationList (StudentID, CourseCode, SectionNumber, EnrollmentDate, Status) "
+        "SELECT StudentID, CourseCode, SectionNumber, datetime(?, '+' || Arrival || ' seconds'), Status "
+        "FROM RegistrationLoad ORDER BY Arrival", (REGISTRATION_OPENS,))
+    connection.execute("DROP TABLE RegistrationLoad")
+    connection.execute("COMMIT")
+    # indexes, waitlist positions and statistics, built once over the loaded rows
+    for migration in ENROLLMENTS_MIGRATIONS:
+        run_script(connection, migration)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.close()
+
+
+def build_users(args, users, password_hash):
+    # a private file outside the LiteFS mount, only handed to LiteFS once it is complete
+    connection = prepare(args.users_staging, True)
+    run_script(connection, USERS_SQL)
+    connection.execute("BEGIN")
+    insert_batches(connection,
+                   "INSERT INTO Users (CWID, Name, Middle, LastName, username, password, Role) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   [(cwid, name, middle, last_name, username, password_hash, role)
+                    for cwid, name, middle, last_name, username, role in users])
+    connection.execute("COMMIT")
+    # the rollback journal mode init.sh's users.db has, written back into the header
+    connection.execute("PRAGMA journal_mode=DELETE")
+    connection.close()
+
+
+def import_users(args):
+    """Replace --users-db with the staged build, through LiteFS rather than around it."""
+    if args.users_import == "litefs":
+        command = [args.litefs, "import", "-name", os.path.basename(args.users_db), args.users_staging]
+        try:
+            returncode = subprocess.run(command).returncode
+        except FileNotFoundError:
+            raise SystemExit(f"{args.litefs} not found, pass --litefs or --users-import sqlite")
+        if returncode != 0:
+            raise SystemExit(f"{' '.join(command)} failed, is the LiteFS primary running?")
+    else:
+        staging = sqlite3.connect(f"file:{args.users_staging}?mode=ro", uri=True)
+        target = sqlite3.connect(args.users_db)
+        staging.backup(target)
+        target.close()
+        staging.close()
+    os.remove(args.users_staging)
+
+
+def write_accounts(path, users, password):
+    with open(path, "w") as accounts:
+        for cwid, _, _, _, username, role in users:
+            accounts.write(json.dumps({"username": username, "password": password, "cwid": cwid, "role": role}) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=449)
+    parser.add_argument("--departments", type=int, default=40)
+    parser.add_argument("--courses-per-department", type=int, default=50)
+    parser.add_argument("--sections-per-course", type=int, default=5, help="at most this many sections per course")
+    parser.add_argument("--min-seats", type=int, default=30)
+    parser.add_argument("--max-seats", type=int, default=90)
+    parser.add_argument("--instructors", type=int, default=1500)
+    parser.add_argument("--students", type=int, default=50000)
+    parser.add_argument("--registrations-per-student", type=float, default=12, help="mean courses each student tries")
+    parser.add_argument("--drop-rate", type=float, default=0.08, help="share of registrations that end up dropped")
+    parser.add_argument("--closed-rate", type=float, default=0.02, help="share of sections frozen after loading")
+    parser.add_argument("--password", default="password", help="password of every generated user")
+    parser.add_argument("--enrollments-db", default=ENROLLMENTS_DB)
+    parser.add_argument("--users-db", default=USERS_DB, help="users database inside the LiteFS primary's mount")
+    parser.add_argument("--users-staging", default=USERS_STAGING_DB,
+                        help="where the users database is built, outside the mount")
+    parser.add_argument("--users-import", choices=["litefs", "sqlite"], default="litefs",
+                        help="hand the build to LiteFS with `litefs import`, or copy it through the mount")
+    parser.add_argument("--litefs", default=LITEFS, help="litefs binary for --users-import litefs")
+    parser.add_argument("--accounts", help="write the generated logins as JSONL for benchmarks/load_test.py")
+    parser.add_argument("--force", action="store_true", help="replace existing database files")
+    args = parser.parse_args()
+
+    if os.path.exists(args.users_db) and not args.force:
+        raise SystemExit(f"{args.users_db} exists, pass --force to replace it")
+
+    start = time.perf_counter()
+    rng = random.Random(args.seed)
+    # generated CWIDs start above the hand-written seed users
+    instructors = people(rng, 1000, args.instructors, 'instructor')
+    students = people(rng, 1000 + args.instructors, args.students, 'student')
+    classes, sections = catalog(rng, args, instructors)
+    rows, enrolled, waitlisted = registrations(rng, args, students, sections)
+    # sections are generated department by department, a sample spreads the closed ones over all of them
+    closed = set(rng.sample(range(len(sections)), round(len(sections) * args.closed_rate)))
+    users = instructors + students
+    generated = time.perf_counter()
+
+    password_hash = hash_password(args.password)
+    build_enrollments(args, users, classes, sections, rows, enrolled, waitlisted, closed)
+    build_users(args, users, password_hash)
+    import_users(args)
+    if args.accounts:
+        write_accounts(args.accounts, users, args.password)
+
+    statuses = {status: sum(1 for row in rows if row[4] == status) for status in ('enrolled', 'waitlisted', 'dropped')}
+    print(f"{len(users)} users, {len(classes)} classes, {len(sections)} sections, {len(rows)} registrations "
+          f"({', '.join(f'{count} {status}' for status, count in statuses.items())})")
+    print(f"generated in {generated - start:.1f}s, loaded in {time.perf_counter() - generated:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
 #!/bin/sh
 
 sqlite3 ./api/var/enrollments.db < ./api/share/enrollments.sql
-sqlite3 ./api/var/primary/fuse/users.db < ./api/share/users.sql
\ No newline at end of file
+for migration in ./api/share/migrations/*.sql; do
+    sqlite3 ./api/var/enrollments.db < "$migration"
+done
+sqlite3 ./api/var/primary/fuse/users.db < ./api/share/users.sql
@@ -0,0 +1,185 @@
+"""Split, merge or rebalance the enrollments database across shard files.
+
+Copies every row of the --from databases (one unsharded database or the
+shards of an earlier layout, in shard order) into the --to databases,
+placing each course with api.shard_router.shard_index so the service finds
+it once ENROLLMENTS_SHARDS lists the --to files in the same order:
+
+- Class, Section and RegistrationList rows go to the shard of their course.
+  Registrations keep their dates, statuses and waitlist positions but get
+  new RecordIDs, since the sources numbered theirs independently.
+- Users is copied to every shard, so role checks and roster joins never
+  leave the shard that holds the course.
+- waitlist:* versions go with their section. Each department's classes:*
+  version is summed over the sources and the sum plus one goes to the
+  first shard, so the service sees every catalog as changed and drops
+  the /classes bodies it cached before the move.
+
+Targets are built from the first source's schema (tables and indexes, so
+every migration it has is carried over), filled one source at a time
+and analyzed. Row counts are checked against the sources before it
+reports success. Stop the enrollments services while it runs, as writes
+made to the sources during the copy are lost.
+
+Usage (from the repository root):
+    python -m api.bin.reshard --from ./api/var/enrollments.db --to ./api/var/shard-0.db ./api/var/shard-1.db [--force]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+from api.shard_router import shard_index
+
+SHARDED_TABLES = ["Class", "Section", "RegistrationList"]
+REGISTRATION_COLUMNS = "StudentID, CourseCode, SectionNumber, EnrollmentDate, Status, WaitlistPosition"
+
+
+def prepare(path, force):
+    if os.path.exists(path):
+        if not force:
+            raise SystemExit(f"{path} exists, pass --force to replace it")
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    connection = sqlite3.connect(path, isolation_level=None, uri=True)
+    # a fresh file nobody reads until it is finished
+    connection.execute("PRAGMA journal_mode=OFF")
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.execute("PRAGMA temp_store=MEMORY")
+    connection.execute("PRAGMA threads=4")
+    return connection
+
+
+def source_schema(path):
+    """CREATE statements of the source's tables, then its indexes (built after the copy)."""
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    rows = connection.execute(
+        "SELECT type, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+        "AND type IN ('table', 'index') ORDER BY type = 'index', rowid").fetchall()
+    connection.close()
+    return [sql for kind, sql in rows if kind == 'table'], [sql for kind, sql in rows if kind == 'index']
+
+
+def count(connection, table, schema="main"):
+    return connection.execute(f"SELECT COUNT(*) FROM {schema}.{table}").fetchone()[0]
+
+
+def source_counts(sources):
+    connection = sqlite3.connect(":memory:", uri=True)
+    counts = dict.fromkeys(SHARDED_TABLES, 0)
+    users = set()
+    for path in sources:
+        connection.execute("ATTACH DATABASE ? AS source", (f"file:{path}?mode=ro",))
+        for table in SHARDED_TABLES:
+            counts[table] += count(connection, table, "source")
+        users.update(row[0] for row in connection.execute("SELECT CWID FROM source.Users"))
+        connection.execute("DETACH DATABASE source")
+    connection.close()
+    counts["Users"] = len(users)
+    return counts
+
+
+def versions(sources):
+    """(waitlist versions by resource, summed classes versions by resource) over every source."""
+    waitlists, catalogs = {}, {}
+    for path in sources:
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        for resource, version in connection.execute("SELECT Resource, Version FROM ResourceVersion"):
+            if resource.startswith("waitlist:"):
+                waitlists[resource] = max(waitlists.get(resource, 0), version)
+            elif resource.startswith("classes:"):
+                catalogs[resource] = catalogs.get(resource, 0) + version
+        connection.close()
+    return waitlists, catalogs
+
+
+def build_shard(path, index, shards, sources, tables, indexes, waitlists, catalogs, force):
+    connection = prepare(path, force)
+    connection.create_function("shard_index", 2, shard_index, deterministic=True)
+    connection.execute("BEGIN")
+    for sql in tables:
+        connection.execute(sql)
+    connection.execute("COMMIT")
+
+    # attached one at a time, SQLite caps the number of attached databases
+    for source in sources:
+        connection.execute("ATTACH DATABASE ? AS source", (f"file:{source}?mode=ro",))
+        connection.execute("BEGIN")
+        connection.execute("INSERT OR IGNORE INTO Users SELECT * FROM source.Users ORDER BY CWID")
+        connection.execute("INSERT INTO Class SELECT * FROM source.Class WHERE shard_index(CourseCode, ?) = ? "
+                           "ORDER BY CourseCode", (shards, index))
+        connection.execute("INSERT INTO Section SELECT * FROM source.Section WHERE shard_index(CourseCode, ?) = ? "
+                           "ORDER BY CourseCode, SectionNumber", (shards, index))
+        connection.execute(f"INSERT INTO RegistrationList ({REGISTRATION_COLUMNS}) "
+                           f"SELECT {REGISTRATION_COLUMNS} FROM source.RegistrationList "
+                           f"WHERE shard_index(CourseCode, ?) = ? ORDER BY RecordID", (shards, index))
+        connection.execute("COMMIT")
+        connection.execute("DETACH DATABASE source")
+
+    connection.execute("BEGIN")
+    # waitlist:<CourseCode>:<SectionNumber>, the course code never holds a colon of its own
+    connection.executemany("INSERT INTO ResourceVersion (Resource, Version) VALUES (?, ?)",
+                           [(resource, version) for resource, version in waitlists.items()
+                            if shard_index(resource.split(":")[1], shards) == index])
+    if index == 0:
+        connection.executemany("INSERT INTO ResourceVersion (Resource, Version) VALUES (?, ?)",
+                               [(resource, version + 1) for resource, version in catalogs.items()])
+    connection.execute("COMMIT")
+
+    for sql in indexes:
+        connection.execute(sql)
+    connection.execute("ANALYZE")
+    connection.execute("PRAGMA journal_mode=WAL")
+    counts = {table: count(connection, table) for table in ["Users"] + SHARDED_TABLES}
+    connection.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--from", dest="sources", nargs="+", required=True, metavar="DB",
+                        help="current database files, in shard order")
+    parser.add_argument("--to", dest="targets", nargs="+", required=True, metavar="DB",
+                        help="new shard files, in the order ENROLLMENTS_SHARDS will list them")
+    parser.add_argument("--force", action="store_true", help="replace existing target files")
+    args = parser.parse_args()
+
+    for source in args.sources:
+        if not os.path.exists(source):
+            raise SystemExit(f"{source} does not exist")
+    overlap = {os.path.realpath(path) for path in args.sources} & {os.path.realpath(path) for path in args.targets}
+    if overlap:
+        raise SystemExit(f"{', '.join(sorted(overlap))} is both a source and a target")
+
+    start = time.perf_counter()
+    tables, indexes = source_schema(args.sources[0])
+    expected = source_counts(args.sources)
+    waitlists, catalogs = versions(args.sources)
+    totals = dict.fromkeys(SHARDED_TABLES, 0)
+    failed = False
+    for index, path in enumerate(args.targets):
+        counts = build_shard(path, index, len(args.targets), args.sources, tables, indexes, waitlists, catalogs,
+                             args.force)
+        print(f"{path}: {counts['Class']} classes, {counts['Section']} sections, "
+              f"{counts['RegistrationList']} registrations, {counts['Users']} users")
+        for table in SHARDED_TABLES:
+            totals[table] += counts[table]
+        if counts["Users"] != expected["Users"]:
+            print(f"  expected {expected['Users']} users")
+            failed = True
+    for table in SHARDED_TABLES:
+        if totals[table] != expected[table]:
+            print(f"{table}: {totals[table]} rows across the shards, {expected[table]} in the sources")
+            failed = True
+    print(f"{len(args.sources)} -> {len(args.targets)} shards in {time.perf_counter() - start:.1f}s")
+    if failed:
+        sys.exit(1)
+    print(f"ENROLLMENTS_SHARDS={','.join(args.targets)}")
+
+
+if __name__ == "__main__":
+    main()
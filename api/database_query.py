@@ -1,655 +1,966 @@
+import base64
+import json
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
 from sqlite3 import Connection
-from typing import List, Union
+from typing import Dict, List, Tuple, Union
 
-from fastapi import HTTPException, status
 from loguru import logger
 from typing import Optional
 
+from .log_config import sample_rows
+from .metrics import STATS_LOCK, increment
 from .models import *
 
 
 LIST_AVAILABLE_SQL_QUERY = """
-	SELECT available_classes.name as 'course_name', available_classes.coursecode as 'course_code', 
-    available_classes.department, available_classes.currentenrollment as 'current_enrollment', 
-    available_classes.waitlist, available_classes.maxenrollment as "max_enrollment", 
-    available_classes.sectionnumber as "section_number", 
-    ur.name as "instructor_first_name", ur.lastname as "instructor_last_name"  
-    FROM Users ur, (SELECT cl.coursecode, cl.name, cl.department, sc.currentenrollment, 
-    sc.maxenrollment, sc.waitlist, sc.sectionnumber, sc.instructorid FROM "Class" as cl 
-    join section as sc on cl.coursecode = sc.coursecode WHERE cl.Department = '{department_name}') 
+	SELECT available_classes.name as 'course_name', available_classes.coursecode as 'course_code',
+    available_classes.department, available_classes.currentenrollment as 'current_enrollment',
+    available_classes.waitlist, available_classes.maxenrollment as "max_enrollment",
+    available_classes.sectionnumber as "section_number",
+    ur.name as "instructor_first_name", ur.lastname as "instructor_last_name"
+    FROM Users ur, (SELECT cl.coursecode, cl.name, cl.department, sc.currentenrollment,
+    sc.maxenrollment, sc.waitlist, sc.sectionnumber, sc.instructorid FROM "Class" as cl
+    join section as sc on cl.coursecode = sc.coursecode WHERE cl.Department = :department_name)
     as available_classes where ur.cwid = available_classes.instructorid
 """
+
+# Ordered on Section's columns, so SQLite walks the instructor's sections in
+# SectionInstructorIdx order and only sorts one section's students at a time.
+# The first rows of a streamed roster are ready after one section, not after
+# the whole roster has been sorted.
+ROSTER_SQL_QUERY = """
+    SELECT
+        Users.CWID AS StudentCWID,
+        Users.Name AS StudentFirstName,
+        Users.LastName AS StudentLastName,
+        Class.CourseCode AS CourseCode,
+        Section.SectionNumber AS SectionNumber,
+        Class.Name AS ClassName,
+        RegistrationList.Status AS Status
+    FROM
+        RegistrationList
+        JOIN Users ON RegistrationList.StudentID = Users.CWID
+        JOIN Section ON RegistrationList.CourseCode = Section.CourseCode AND RegistrationList.SectionNumber = Section.SectionNumber
+        JOIN Class ON Section.CourseCode = Class.CourseCode
+    WHERE
+        Section.InstructorID = :instructor_id
+        AND RegistrationList.Status IN (:status_0, :status_1, :status_2)
+        {filters}
+        AND (:after_cwid IS NULL
+             OR (Section.CourseCode, Section.SectionNumber, Users.LastName, Users.Name, Users.CWID)
+                > (:after_course_code, :after_section_number, :after_last_name, :after_first_name, :after_cwid))
+    ORDER BY Section.CourseCode, Section.SectionNumber, Users.LastName, Users.Name, Users.CWID
+    LIMIT COALESCE(:limit, -1)
+"""
+
+# Every statement the services run, by name. All of them are parameterized so
+# SQLite compiles each one once per connection and reuses it from the
+# connection's statement cache afterwards.
+USERS_STATEMENTS = {
+    'insert_user': """
+        INSERT INTO Users (CWID, Name, Middle, LastName, username, password, Role)
+        VALUES (:cwid, :first_name, :middle_name, :last_name, :username, :password, :role)
+    """,
+    'user_credentials': """
+        SELECT CWID, password, Role FROM Users WHERE username = :username
+    """,
+}
+
+ENROLLMENTS_STATEMENTS = {
+    'available_classes': LIST_AVAILABLE_SQL_QUERY,
+    'user_role': """
+        SELECT Role FROM Users WHERE CWID = :cwid
+    """,
+    'registration_status': """
+        SELECT Status, EnrollmentDate FROM RegistrationList
+        WHERE StudentID = :student_id AND CourseCode = :course_code AND SectionNumber = :section_number
+    """,
+    'active_registration': """
+        SELECT Status, EnrollmentDate, WaitlistPosition FROM RegistrationList
+        WHERE StudentID = :student_id AND CourseCode = :course_code AND SectionNumber = :section_number
+        AND Status IN ('enrolled', 'waitlisted')
+    """,
+    'cart_sections': """
+        SELECT cart.key, Section.SectionStatus, RegistrationList.Status, RegistrationList.EnrollmentDate
+        FROM json_each(:sections) AS cart
+        LEFT JOIN Section
+            ON Section.CourseCode = json_extract(cart.value, '$[0]')
+            AND Section.SectionNumber = json_extract(cart.value, '$[1]')
+        LEFT JOIN RegistrationList
+            ON RegistrationList.StudentID = :student_id AND RegistrationList.CourseCode = Section.CourseCode
+            AND RegistrationList.SectionNumber = Section.SectionNumber AND RegistrationList.Status IN ('enrolled', 'waitlisted')
+    """,
+    'insert_registration': """
+        INSERT INTO RegistrationList (StudentID, CourseCode, SectionNumber, Status, WaitlistPosition)
+        VALUES (:student_id, :course_code, :section_number, :status, :waitlist_position)
+        RETURNING EnrollmentDate
+    """,
+    'claim_seat': """
+        UPDATE Section SET CurrentEnrollment = CurrentEnrollment + 1
+        WHERE CourseCode = :course_code AND SectionNumber = :section_number
+        AND SectionStatus = 'open' AND CurrentEnrollment < MaxEnrollment
+        RETURNING CurrentEnrollment
+    """,
+    'claim_waitlist_spot': """
+        UPDATE Section SET Waitlist = Waitlist + 1
+        WHERE CourseCode = :course_code AND SectionNumber = :section_number
+        AND SectionStatus = 'open' AND Waitlist <= :waitlist_allowed
+        RETURNING Waitlist
+    """,
+    'resource_version': """
+        SELECT Version FROM ResourceVersion WHERE Resource = :resource
+    """,
+    'bump_catalog_version': """
+        INSERT INTO ResourceVersion (Resource, Version)
+        SELECT 'classes:' || Department, 1 FROM Class WHERE CourseCode = :course_code
+        ON CONFLICT (Resource) DO UPDATE SET Version = Version + 1
+    """,
+    'bump_resource_version': """
+        INSERT INTO ResourceVersion (Resource, Version) VALUES (:resource, 1)
+        ON CONFLICT (Resource) DO UPDATE SET Version = Version + 1
+    """,
+    'student_waitlist_versions': """
+        SELECT rl.CourseCode, rl.SectionNumber, COALESCE(rv.Version, 0)
+        FROM RegistrationList rl
+        LEFT JOIN ResourceVersion rv ON rv.Resource = 'waitlist:' || rl.CourseCode || ':' || rl.SectionNumber
+        WHERE rl.StudentID = :student_id AND rl.Status = 'waitlisted'
+        ORDER BY rl.CourseCode, rl.SectionNumber
+    """,
+    'decrement_enrollment': """
+        UPDATE Section SET CurrentEnrollment = CurrentEnrollment - 1
+        WHERE CourseCode = :course_code AND SectionNumber = :section_number
+    """,
+    'decrement_waitlist': """
+        UPDATE Section SET Waitlist = Waitlist - 1
+        WHERE CourseCode = :course_code AND SectionNumber = :section_number
+    """,
+    'drop_active_registration': """
+        UPDATE RegistrationList SET Status = 'dropped', WaitlistPosition = NULL
+        WHERE StudentID = :student_id AND CourseCode = :course_code AND SectionNumber = :section_number
+        AND Status IN ('enrolled', 'waitlisted')
+    """,
+    'close_waitlist_gap': """
+        UPDATE RegistrationList SET WaitlistPosition = WaitlistPosition - 1
+        WHERE CourseCode = :course_code AND SectionNumber = :section_number AND Status = 'waitlisted'
+        AND WaitlistPosition > :waitlist_position
+    """,
+    'promote_waitlisted': """
+        UPDATE RegistrationList SET Status = 'enrolled', WaitlistPosition = NULL
+        WHERE CourseCode = :course_code AND SectionNumber = :section_number AND Status = 'waitlisted'
+        AND WaitlistPosition <= COALESCE((
+            SELECT MaxEnrollment - CurrentEnrollment FROM Section
+            WHERE CourseCode = :course_code AND SectionNumber = :section_number AND SectionStatus = 'open'
+        ), 0)
+        RETURNING CourseCode, SectionNumber
+    """,
+    'promote_all_waitlisted': """
+        UPDATE RegistrationList SET Status = 'enrolled', WaitlistPosition = NULL
+        WHERE RecordID IN (
+            SELECT rl.RecordID
+            FROM RegistrationList rl
+            CROSS JOIN Section s ON s.CourseCode = rl.CourseCode AND s.SectionNumber = rl.SectionNumber
+            WHERE s.SectionStatus = 'open' AND s.CurrentEnrollment < s.MaxEnrollment
+            AND rl.Status = 'waitlisted' AND rl.WaitlistPosition <= s.MaxEnrollment - s.CurrentEnrollment
+        )
+        RETURNING CourseCode, SectionNumber
+    """,
+    'apply_promotions': """
+        WITH Promotion AS MATERIALIZED (
+            SELECT json_extract(value, '$[0]') AS CourseCode, json_extract(value, '$[1]') AS SectionNumber,
+                json_extract(value, '$[2]') AS Promoted
+            FROM json_each(:promotions)
+        )
+        UPDATE Section
+        SET CurrentEnrollment = CurrentEnrollment + Promotion.Promoted, Waitlist = Waitlist - Promotion.Promoted
+        FROM Promotion
+        WHERE Section.CourseCode = Promotion.CourseCode AND Section.SectionNumber = Promotion.SectionNumber
+    """,
+    'shift_promoted_waitlists': """
+        WITH Promotion AS MATERIALIZED (
+            SELECT json_extract(value, '$[0]') AS CourseCode, json_extract(value, '$[1]') AS SectionNumber,
+                json_extract(value, '$[2]') AS Promoted
+            FROM json_each(:promotions)
+        )
+        UPDATE RegistrationList
+        SET WaitlistPosition = WaitlistPosition - Promotion.Promoted
+        FROM Promotion
+        WHERE RegistrationList.CourseCode = Promotion.CourseCode
+        AND RegistrationList.SectionNumber = Promotion.SectionNumber AND RegistrationList.Status = 'waitlisted'
+    """,
+    'bump_promoted_waitlist_versions': """
+        INSERT INTO ResourceVersion (Resource, Version)
+        SELECT 'waitlist:' || json_extract(p.value, '$[0]') || ':' || json_extract(p.value, '$[1]'), 1
+        FROM json_each(:promotions) AS p
+        WHERE true
+        ON CONFLICT (Resource) DO UPDATE SET Version = Version + 1
+    """,
+    'bump_promoted_catalog_versions': """
+        INSERT INTO ResourceVersion (Resource, Version)
+        SELECT DISTINCT 'classes:' || c.Department, 1
+        FROM json_each(:promotions) AS p JOIN Class c ON c.CourseCode = json_extract(p.value, '$[0]')
+        WHERE true
+        ON CONFLICT (Resource) DO UPDATE SET Version = Version + 1
+    """,
+    'class_exists': """
+        SELECT CourseCode FROM Class WHERE CourseCode = :course_code
+    """,
+    'section_exists': """
+        SELECT SectionNumber FROM Section WHERE CourseCode = :course_code AND SectionNumber = :section_number
+    """,
+    'section_status': """
+        SELECT SectionStatus FROM Section WHERE CourseCode = :course_code AND SectionNumber = :section_number
+    """,
+    'section_instructor': """
+        SELECT InstructorID FROM Section WHERE CourseCode = :course_code AND SectionNumber = :section_number
+    """,
+    'insert_class': """
+        INSERT INTO Class (CourseCode, Name, Department) VALUES (:course_code, :class_name, :department)
+    """,
+    'insert_section': """
+        INSERT INTO Section (SectionNumber, CourseCode, InstructorID, MaxEnrollment, CurrentEnrollment, Waitlist, SectionStatus)
+        VALUES (:section_number, :course_code, :instructor_id, :max_enrollment, 0, 0, 'open')
+    """,
+    'delete_section': """
+        DELETE FROM Section WHERE CourseCode = :course_code AND SectionNumber = :section_number
+    """,
+    'update_section_instructor': """
+        UPDATE Section SET InstructorID = :instructor_id
+        WHERE CourseCode = :course_code AND SectionNumber = :section_number
+    """,
+    'freeze_section': """
+        UPDATE Section SET SectionStatus = 'closed'
+        WHERE CourseCode = :course_code AND SectionNumber = :section_number
+    """,
+    'roster': ROSTER_SQL_QUERY.format(filters=""),
+    'roster_by_course': ROSTER_SQL_QUERY.format(filters="AND Section.CourseCode = :course_code"),
+    'roster_by_section': ROSTER_SQL_QUERY.format(filters="AND Section.SectionNumber = :section_number"),
+    'roster_by_course_section': ROSTER_SQL_QUERY.format(
+        filters="AND Section.CourseCode = :course_code AND Section.SectionNumber = :section_number"),
+    'waitlist_positions': """
+        SELECT WaitlistPosition, CourseCode, SectionNumber FROM RegistrationList
+        WHERE StudentID = :student_id AND Status = 'waitlisted'
+    """,
+    'section_waitlist': """
+        SELECT
+            r.StudentID,
+            u.Name AS StudentName,
+            strftime('%Y-%m-%dT%H:%M:%S', r.EnrollmentDate) AS EnrollmentDate,
+            r.Status
+        FROM
+            RegistrationList r
+        JOIN
+            Users u ON r.StudentID = u.CWID
+        WHERE
+            r.CourseCode = :course_code
+            AND r.SectionNumber = :section_number
+            AND r.Status = 'waitlisted'
+        ORDER BY
+            r.WaitlistPosition
+    """,
+}
+
+STATEMENTS = {**USERS_STATEMENTS, **ENROLLMENTS_STATEMENTS}
+
+# name -> [executions, total seconds]; plain increments, the GIL is enough for counters
+STATEMENT_STATS = {name: [0, 0.0] for name in STATEMENTS}
+# the same totals by operation, the database_query function that ran the statement
+FUNCTION_STATS: Dict[str, list] = {}
+
+_PARAMETER_PATTERN = re.compile(r":(\w+)")
+_WRITE_PATTERN = re.compile(r"\b(INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+
 WAITLIST_ALLOWED = 15
 class DBException(Exception):
     def __init__(self, error_detail:str) -> None:
         self.error_detail = error_detail
 
+class DuplicateRecordException(DBException):
+    pass
 
-def username_exists(users_connection: Connection, username: str):
-    cursor = users_connection.cursor()
-    response = cursor.execute(f'''
-        SELECT * 
-        FROM Users
-        WHERE
-            username="{username}";
-    ''').fetchone()
+class NotAuthorizedException(DBException):
+    pass
 
-    if response: return True
-    return False
+class RecordNotFoundException(DBException):
+    pass
 
+class SectionClosedException(DBException):
+    pass
 
-def add_user(users_connection: Connection, user_info: CreateUserRequest):
-    query = f'''
-        INSERT INTO Users
-        (CWID, Name, Middle, LastName, username, password, Role)
-        VALUES
-        ({user_info.cwid}, "{user_info.first_name}", 
-        "{user_info.middle_name}", "{user_info.last_name}", "{user_info.username}",
-        "{user_info.password}", "{user_info.role}")
-    '''
-
-    cursor = users_connection.cursor()
-    cursor.execute("BEGIN")
+
+def _record(operation: str, name: str, elapsed: float) -> None:
+    with STATS_LOCK:
+        stats = STATEMENT_STATS[name]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats = FUNCTION_STATS.setdefault(operation, [0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+
+
+def execute(db_connection: Union[Connection, sqlite3.Cursor], operation: str, name: str,
+            params: Optional[dict] = None) -> sqlite3.Cursor:
+    """Run a catalogue statement by name for ``operation``, recording its count and time.
+
+    Only the first step of the statement is timed, which covers writes
+    without RETURNING. Statements that return rows go through fetch_one or
+    fetch_all, so the time includes reading them.
+    """
+    start = time.perf_counter()
+    try:
+        return db_connection.execute(STATEMENTS[name], params or {})
+    finally:
+        _record(operation, name, time.perf_counter() - start)
+
+
+def fetch_one(db_connection: Union[Connection, sqlite3.Cursor], operation: str, name: str,
+              params: Optional[dict] = None):
+    """First row of a catalogue statement, or None, timed through the fetch."""
+    start = time.perf_counter()
+    try:
+        return db_connection.execute(STATEMENTS[name], params or {}).fetchone()
+    finally:
+        _record(operation, name, time.perf_counter() - start)
+
+
+def fetch_all(db_connection: Union[Connection, sqlite3.Cursor], operation: str, name: str,
+              params: Optional[dict] = None) -> list:
+    """Every row of a catalogue statement, timed through the fetch."""
+    start = time.perf_counter()
     try:
-        cursor.execute(query)
-        cursor.execute("COMMIT")
+        return db_connection.execute(STATEMENTS[name], params or {}).fetchall()
+    finally:
+        _record(operation, name, time.perf_counter() - start)
+
+
+def warm_statement_cache(db_connection: Connection, statements: Dict[str, str]) -> None:
+    """Compile the read statements of a catalogue into the connection's statement cache.
+
+    Each SELECT runs once with every parameter bound to NULL, which matches no
+    rows. Writes are compiled on first use.
+    """
+    for sql in statements.values():
+        if not sql.lstrip().upper().startswith(("SELECT", "WITH")) or _WRITE_PATTERN.search(sql):
+            continue
+        params = {name: None for name in _PARAMETER_PATTERN.findall(sql)}
+        db_connection.execute(sql, params).fetchall()
+
+
+def get_statement_stats() -> Dict[str, dict]:
+    """Execution count, total and mean time in milliseconds for every statement that has run."""
+    result = {}
+    with STATS_LOCK:
+        stats = [(name, count, total) for name, (count, total) in STATEMENT_STATS.items()]
+    for name, count, total in stats:
+        if count:
+            result[name] = {'count': count, 'total_ms': total * 1000, 'mean_ms': total * 1000 / count}
+    return result
+
+
+def _count_busy(err: Exception) -> None:
+    if isinstance(err, sqlite3.OperationalError) and ('locked' in str(err) or 'busy' in str(err)):
+        increment('sqlite_busy_total')
+
+
+@contextmanager
+def transaction(db_connection: Connection, error_detail: str, begin: str = "BEGIN"):
+    """Yield a cursor inside BEGIN/COMMIT, rolling back and raising DBException on any error.
+
+    Inside a transaction that is already open (a group commit batch of
+    db_pool.DatabaseManager) it uses a SAVEPOINT instead. Only this
+    function's changes roll back, and the outer transaction commits them.
+    """
+    cursor = db_connection.cursor()
+    nested = db_connection.in_transaction
+    try:
+        cursor.execute("SAVEPOINT nested_transaction" if nested else begin)
+    except sqlite3.OperationalError as err:
+        _count_busy(err)
+        cursor.close()
+        raise
+    rollback = ("ROLLBACK TO nested_transaction", "RELEASE nested_transaction") if nested else ("ROLLBACK",)
+    try:
+        yield cursor
+        cursor.execute("RELEASE nested_transaction" if nested else "COMMIT")
+    except DBException:
+        for statement in rollback:
+            cursor.execute(statement)
+        increment('transaction_rollbacks_total', reason='rejected')
+        logger.info('Rolling back transaction')
+        raise
     except Exception as err:
         logger.error(err)
-        cursor.execute("ROLLBACK")
+        _count_busy(err)
+        for statement in rollback:
+            cursor.execute(statement)
+        increment('transaction_rollbacks_total', reason='error')
         logger.info('Rolling back transaction')
-        raise DBException(error_detail = 'Fail to add user')
+        raise DBException(error_detail = error_detail)
     finally:
         cursor.close()
 
+
+def _user_params(user_info: CreateUserRequest) -> dict:
+    return {'cwid': user_info.cwid, 'first_name': user_info.first_name, 'middle_name': user_info.middle_name,
+            'last_name': user_info.last_name, 'username': user_info.username,
+            'password': user_info.password, 'role': user_info.role}
+
+
+def _duplicate_user_detail(err: sqlite3.IntegrityError, user_info: CreateUserRequest) -> Union[str, None]:
+    if 'Users.username' in str(err):
+        return f'username="{user_info.username}" already exist!'
+    if 'Users.CWID' in str(err):
+        return f'cwid={user_info.cwid} already exist!'
+    return None
+
+
+def add_user(users_connection: Connection, user_info: CreateUserRequest):
+    # no existence pre-check, the UNIQUE constraints on CWID and username report conflicts
+    with transaction(users_connection, 'Fail to add user') as cursor:
+        try:
+            execute(cursor, 'add_user', 'insert_user', _user_params(user_info))
+        except sqlite3.IntegrityError as err:
+            detail = _duplicate_user_detail(err, user_info)
+            if detail is None:
+                raise
+            raise DuplicateRecordException(error_detail = detail)
+
     return QueryStatus.SUCCESS
 
 
-def get_user(users_connection: Connection, username: str):
-    cursor = users_connection.cursor()
-    response = cursor.execute(f'''
-        SELECT *
-        FROM Users
-        WHERE
-            username="{username}";
-    ''').fetchone()
+def add_users_batch(users_connection: Connection, users: List[CreateUserRequest]) -> List[Union[str, None]]:
+    """Insert many users in a single transaction.
+
+    A row that violates a constraint only rolls back its own statement, so
+    the rest of the batch still commits. Returns one entry per user: None
+    when it was inserted, otherwise the error detail.
+    """
+    results = []
+    with transaction(users_connection, 'Fail to add users') as cursor:
+        for user_info in users:
+            try:
+                execute(cursor, 'add_users_batch', 'insert_user', _user_params(user_info))
+                results.append(None)
+            except sqlite3.IntegrityError as err:
+                results.append(_duplicate_user_detail(err, user_info) or str(err))
+
+    return results
 
-    if not response: return None
-    return response
 
-def get_available_classes(db_connection: Connection, department_name: str) -> List[AvailableClass]:
+def get_user_credentials(users_connection: Connection, username: str):
+    """Fetch (CWID, password, Role) for a username with one lookup on the username index.
+
+    Returns None when the username does not exist.
+    """
+    return fetch_one(users_connection, 'get_user_credentials', 'user_credentials', {'username': username})
+
+def get_available_classes(db_connection: Connection, department_name: str) -> List[dict]:
     """Query database to get available classes for a given department name
 
     Args:
-        db_connection (Connection): SQLite Connection 
+        db_connection (Connection): SQLite Connection
         department_name (str): Department name
 
     Returns:
-        List[AvailableClass]: List of available classes
+        List[dict]: available classes shaped like AvailableClass, ready for json_bytes
     """
-    result = []
-    query = LIST_AVAILABLE_SQL_QUERY.format(department_name=department_name)
-    cursor = db_connection.cursor()
-    rows =  cursor.execute(query)
-    if rows.arraysize == 0:
-        raise HTTPException(status_code= status.HTTP_400_BAD_REQUEST, detail= f'Record not found for given department_name:{department_name}')
-    for row in rows:
-        available_class = AvailableClass(course_name=row[0], 
-                                     course_code=row[1],
-                                     department=row[2],
-                                     current_enrollment=row[3],
-                                     waitlist=row[4],
-                                     max_enrollment=row[5],
-                                     section_number=row[6],
-                                     instructor_first_name=row[7],
-                                     instructor_last_name=row[8])
-        result.append(available_class)
-    cursor.close()
-    return result
-    
+    rows = sample_rows(fetch_all(db_connection, 'get_available_classes', 'available_classes', {'department_name': department_name}), __name__)
+    return [{"course_code": row[1],
+             "course_name": row[0],
+             "department": row[2],
+             "instructor_first_name": row[7],
+             "instructor_last_name": row[8],
+             "current_enrollment": row[3],
+             "max_enrollment": row[5],
+             "waitlist": row[4],
+             "section_number": row[6]} for row in rows]
+
+
+def classes_resource(department_name: str) -> str:
+    """ResourceVersion key of the /classes listing for a department."""
+    return f'classes:{department_name}'
+
+def get_resource_version(db_connection: Connection, resource: str) -> int:
+    row = fetch_one(db_connection, 'get_resource_version', 'resource_version', {'resource': resource})
+    return row[0] if row is not None else 0
+
+def get_catalog_version(db_connection: Connection, department_name: str) -> int:
+    return get_resource_version(db_connection, classes_resource(department_name))
+
+def get_available_classes_snapshot(db_connection: Connection, department_name: str) -> Tuple[int, List[dict]]:
+    """Available classes of a department together with the catalog version they were read at.
+
+    Both reads run in one read transaction, so the version always describes
+    the rows returned.
+    """
+    db_connection.execute("BEGIN")
+    try:
+        version = get_catalog_version(db_connection, department_name)
+        classes = get_available_classes(db_connection, department_name)
+    finally:
+        db_connection.execute("COMMIT")
+    return version, classes
 
-def check_user_role(db_connection: Connection, student_id: int)-> Union[str, None]:
-    logger.info('Checking user role')
-    query = f"""
-            SELECT role FROM Users where CWID = {student_id} 
-            """
-    cursor = db_connection.cursor()
-    rows =  cursor.execute(query)
-    if rows.arraysize == 0:
-        raise HTTPException(status_code= status.HTTP_400_BAD_REQUEST, detail= f'Record not found for given student_id:{student_id}')
-    result = UserRole.NOT_FOUND
-    for row in rows:
-        result = row[0]
-    return result
+def waitlist_resource(course_code: str, section_number: int) -> str:
+    """ResourceVersion key of the waitlist of a section."""
+    return f'waitlist:{course_code}:{section_number}'
 
+def get_waitlist_version(db_connection: Connection, course_code: str, section_number: int) -> int:
+    return get_resource_version(db_connection, waitlist_resource(course_code, section_number))
 
-def count_waitlist_registration(db_connection: Connection, section_id: int)->int:
-    logger.info('Checking waitlist registration')
-    query = f"""SELECT COUNT(*) FROM RegistrationList WHERE ClassID = {section_id} and Status = 'waitlisted'
-    """
-    cursor = db_connection.cursor()
-    rows =  cursor.execute(query)
-    if rows.arraysize == 0:
-        raise HTTPException(status_code= status.HTTP_400_BAD_REQUEST, detail= f'Record not found for given section_id:{section_id}')
-    result = 0
-    for row in rows:
-        result = row[0]
-    return result
+def get_waitlist_position_tag(db_connection: Connection, student_id: int) -> str:
+    """Summary of the waitlist versions of every section a student is waitlisted in.
 
-def check_enrollment_eligibility(db_connection: Connection, section_number: int, course_code: str)->str:
-    logger.info('Checking enrollment eligibility')
-    query = f"""SELECT CurrentEnrollment as 'current_enrollment', MaxEnrollment as 'max_enrollment', Waitlist as 'waitlist' FROM "Section" WHERE CourseCode = '{course_code}' and SectionNumber = {section_number}
+    A student's positions only change when one of those waitlists changes or
+    the student joins or leaves one, and either changes this string.
     """
+    rows = fetch_all(db_connection, 'get_waitlist_position_tag', 'student_waitlist_versions', {'student_id': student_id})
+    return ','.join(f'{row[0]}:{row[1]}:{row[2]}' for row in rows)
 
-    cursor = db_connection.cursor()
-    rows =  cursor.execute(query)
-    if rows.arraysize == 0:
-        raise HTTPException(status_code= status.HTTP_400_BAD_REQUEST, detail= f'Record not found for given section_number:{section_number} and course_code:{course_code}')
-    query_result = {}
-    for row in rows:
-        query_result['current_enrollment'] = row[0]
-        query_result['max_enrollment'] = row[1]
-        query_result['waitlist'] = row[2]
-    
-    # First check whether there is capacity to enroll in a section
-    if query_result['max_enrollment'] - query_result['current_enrollment'] >= 1:
-        return RegistrationStatus.ENROLLED
-    
-    if query_result['waitlist'] <= WAITLIST_ALLOWED:
-        return RegistrationStatus.WAITLISTED
-    
-    return RegistrationStatus.NOT_ELIGIBLE
-
-def check_status_query(db_connection: Connection, enrollment_request: EnrollmentRequest) -> Union[EnrollmentResponse, None]:
-    check_status_query = f""" SELECT Status, EnrollmentDate FROM RegistrationList where StudentID = {enrollment_request.student_id} and SectionNumber = {enrollment_request.section_number} and CourseCode = '{enrollment_request.course_code}'"""
-    cursor = db_connection.cursor()
-    try:
-        rows =  cursor.execute(check_status_query).fetchone()
-        if not rows:
-            return None
-        row = rows[0]
-        if row[0] == RegistrationStatus.ENROLLED:
-            return EnrollmentResponse(enrollment_status="already enrolled", enrollment_date=row[1])
-    except Exception as err:
-        logger.error(err)
-        raise DBException(error_detail = 'Fail to register')
-    return None
+def _bump_catalog_version(cursor: sqlite3.Cursor, course_code: str) -> None:
+    """Mark the /classes listing of the course's department as changed, inside the caller's transaction."""
+    execute(cursor, '_bump_catalog_version', 'bump_catalog_version', {'course_code': course_code})
 
+def _bump_waitlist_version(cursor: sqlite3.Cursor, course_code: str, section_number: int) -> None:
+    """Mark the waitlist of a section as changed, inside the caller's transaction."""
+    execute(cursor, '_bump_waitlist_version', 'bump_resource_version', {'resource': waitlist_resource(course_code, section_number)})
 
-def complete_registration(db_connection: Connection, registration: Registration) -> str:
+
+def check_user_role(db_connection: Connection, student_id: int)-> Union[str, None]:
+    logger.info('Checking user role')
+    row = fetch_one(db_connection, 'check_user_role', 'user_role', {'cwid': student_id})
+    if row is None:
+        return UserRole.NOT_FOUND
+    return row[0]
+
+
+def _claim_registration(cursor: sqlite3.Cursor, student_id: int, course_code: str, section_number: int) -> EnrollmentResponse:
+    """Claim a seat, or failing that a waitlist spot, inside an already open write transaction.
+
+    The capacity checks live in the WHERE clause of the UPDATE, so two
+    concurrent requests can never both take the last seat.
+    """
+    params = {'course_code': course_code, 'section_number': section_number, 'student_id': student_id}
+    existing = fetch_one(cursor, '_claim_registration', 'active_registration', params)
+    if existing is not None:
+        return _existing_registration(existing[0], existing[1])
+    return _claim_section(cursor, student_id, course_code, section_number)
+
+def _existing_registration(registration_status: str, enrollment_date) -> EnrollmentResponse:
+    if registration_status == RegistrationStatus.ENROLLED:
+        return EnrollmentResponse(enrollment_status="already enrolled", enrollment_date=enrollment_date)
+    return EnrollmentResponse(enrollment_status="already waitlisted", enrollment_date=enrollment_date)
+
+def _claim_section(cursor: sqlite3.Cursor, student_id: int, course_code: str, section_number: int) -> EnrollmentResponse:
+    """Claim a seat or waitlist spot for a student with no active registration in the section."""
+    section = {'course_code': course_code, 'section_number': section_number}
+    params = {**section, 'student_id': student_id}
+    waitlist_position = None
+    if fetch_all(cursor, '_claim_section', 'claim_seat', section):
+        registration_status = RegistrationStatus.ENROLLED
+    else:
+        waitlist_spot = fetch_all(cursor, '_claim_section', 'claim_waitlist_spot', {**section, 'waitlist_allowed': WAITLIST_ALLOWED})
+        if not waitlist_spot:
+            row = fetch_one(cursor, '_claim_section', 'section_status', section)
+            if row is None:
+                raise RecordNotFoundException(error_detail = f'Record not found for given section_number:{section_number} and course_code:{course_code}')
+            if row[0] != "open":
+                raise SectionClosedException(error_detail = 'Class is no longer active')
+            return EnrollmentResponse(enrollment_status = 'not eligible')
+        registration_status = RegistrationStatus.WAITLISTED
+        # the waitlist counter after claiming the spot is the new student's place in line
+        waitlist_position = waitlist_spot[0][0]
+
+    enrollment_date = fetch_one(cursor, '_claim_section', 'insert_registration', {**params, 'status': registration_status,
+                                                              'waitlist_position': waitlist_position})[0]
+    _bump_catalog_version(cursor, course_code)
+    if registration_status == RegistrationStatus.WAITLISTED:
+        _bump_waitlist_version(cursor, course_code, section_number)
+    return EnrollmentResponse(enrollment_status = registration_status, enrollment_date = enrollment_date)
+
+def _authorize_student(cursor: sqlite3.Cursor, student_id: int, role: Optional[str]) -> None:
+    """Raise NotAuthorizedException unless the user is a student, looking the role up only when not given."""
+    if role is None:
+        row = fetch_one(cursor, '_authorize_student', 'user_role', {'cwid': student_id})
+        role = row[0] if row is not None else UserRole.NOT_FOUND
+    if role != UserRole.STUDENT:
+        raise NotAuthorizedException(error_detail = f'Enrollment not authorized for role:{role}')
+
+def enroll_student(db_connection: Connection, enrollment_request: EnrollmentRequest,
+                   role: Optional[str] = None) -> EnrollmentResponse:
+    """Enroll or waitlist a student in one BEGIN IMMEDIATE transaction.
+
+    ``role`` is the student's role when the caller already knows it (from
+    gateway claims or a cache), saving the lookup.
+
+    Raises NotAuthorizedException when the user is not a student,
+    RecordNotFoundException for an unknown section and SectionClosedException
+    when enrollment for the section is frozen.
+    """
     logger.info('Starting registration')
-    insert_query = f"""
-    INSERT INTO RegistrationList (StudentID,CourseCode, SectionNumber, Status) VALUES ({registration.student_id},'{registration.course_code}', {registration.section_number}, '{registration.enrollment_status}')
+    with transaction(db_connection, 'Fail to register', begin="BEGIN IMMEDIATE") as cursor:
+        _authorize_student(cursor, enrollment_request.student_id, role)
+        return _claim_registration(cursor, enrollment_request.student_id, enrollment_request.course_code,
+                                   enrollment_request.section_number)
+
+def enroll_cart(db_connection: Connection, cart_request: CartEnrollmentRequest,
+                role: Optional[str] = None) -> List[CartSectionResult]:
+    """Enroll or waitlist a student in every section of a cart in one BEGIN IMMEDIATE transaction.
+
+    One query checks all the sections and the student's registrations in
+    them, then each remaining section is claimed like a single enrollment.
+    Sections that cannot be claimed get their own status ('not found',
+    'closed', 'not eligible', 'duplicate') without failing the rest of the
+    cart. ``role`` works as for enroll_student. Raises NotAuthorizedException
+    when the user is not a student.
     """
-    update_current_enrollment_query = f"""
-    UPDATE "Section" SET CurrentEnrollment = CurrentEnrollment + 1 WHERE SectionNumber = {registration.section_number} and CourseCode = '{registration.course_code}'
+    logger.info('Starting cart registration')
+    sections = [(item.course_code, item.section_number) for item in cart_request.sections]
+    with transaction(db_connection, 'Fail to register', begin="BEGIN IMMEDIATE") as cursor:
+        _authorize_student(cursor, cart_request.student_id, role)
+
+        checks = {row[0]: row[1:] for row in fetch_all(cursor, 'enroll_cart', 'cart_sections', {'student_id': cart_request.student_id,
+                                                                               'sections': json.dumps(sections)})}
+        results = []
+        seen = set()
+        for index, (course_code, section_number) in enumerate(sections):
+            section_status, registration_status, enrollment_date = checks[index]
+            if (course_code, section_number) in seen:
+                response = EnrollmentResponse(enrollment_status='duplicate')
+            elif section_status is None:
+                response = EnrollmentResponse(enrollment_status='not found')
+            elif registration_status is not None:
+                response = _existing_registration(registration_status, enrollment_date)
+            elif section_status != 'open':
+                response = EnrollmentResponse(enrollment_status='closed')
+            else:
+                response = _claim_section(cursor, cart_request.student_id, course_code, section_number)
+            seen.add((course_code, section_number))
+            results.append(CartSectionResult(course_code=course_code, section_number=section_number,
+                                             enrollment_status=response.enrollment_status,
+                                             enrollment_date=response.enrollment_date))
+        return results
+
+def _apply_promotions(cursor: sqlite3.Cursor, promoted_rows) -> Dict[Tuple[str, int], int]:
+    """Move counters, waitlist positions and versions for registrations just promoted from the waitlist.
+
+    ``promoted_rows`` are the (CourseCode, SectionNumber) rows returned by a
+    promotion UPDATE. Every affected section is updated by one statement per
+    table, however many sections there are.
     """
-    update_waitlist_query = f"""
-    UPDATE "Section" SET Waitlist = Waitlist + 1 WHERE SectionNumber = {registration.section_number} and CourseCode = '{registration.course_code}'
+    promoted = {}
+    for course_code, section_number in promoted_rows:
+        promoted[(course_code, section_number)] = promoted.get((course_code, section_number), 0) + 1
+    if promoted:
+        payload = {'promotions': json.dumps([[course_code, section_number, count]
+                                             for (course_code, section_number), count in promoted.items()])}
+        execute(cursor, '_apply_promotions', 'apply_promotions', payload)
+        execute(cursor, '_apply_promotions', 'shift_promoted_waitlists', payload)
+        execute(cursor, '_apply_promotions', 'bump_promoted_waitlist_versions', payload)
+        execute(cursor, '_apply_promotions', 'bump_promoted_catalog_versions', payload)
+        logger.info(f'Promoted {sum(promoted.values())} waitlisted students in {len(promoted)} sections')
+    return promoted
+
+def _promote_waitlisted(cursor: sqlite3.Cursor, course_code: str, section_number: int) -> int:
+    """Fill the open seats of a section from the front of its waitlist, inside the caller's transaction."""
+    rows = fetch_all(cursor, '_promote_waitlisted', 'promote_waitlisted', {'course_code': course_code, 'section_number': section_number})
+    return sum(_apply_promotions(cursor, rows).values())
+
+def _drop_registration(cursor: sqlite3.Cursor, student_id: int, course_code: str, section_number: int) -> Union[str, None]:
+    """Drop a student's active registration and hand a freed seat to the waitlist.
+
+    Returns the status the registration had, or None when the student was
+    neither enrolled nor waitlisted.
     """
-
-    cursor = db_connection.cursor()
-    cursor.execute("BEGIN")
-    try:
-        cursor.execute(insert_query)
-        if registration.enrollment_status == RegistrationStatus.ENROLLED:
-            cursor.execute(update_current_enrollment_query)
-        elif registration.enrollment_status == RegistrationStatus.WAITLISTED:
-            cursor.execute(update_waitlist_query)
-        cursor.execute("COMMIT")
-    except Exception as err:
-        logger.error(err)
-        cursor.execute("ROLLBACK")
-        logger.info('Rolling back transaction')
-        raise DBException(error_detail = 'Fail to register')
-    finally:
-        cursor.close()
-
-    return QueryStatus.SUCCESS
+    section = {'course_code': course_code, 'section_number': section_number}
+    params = {**section, 'student_id': student_id}
+    row = fetch_one(cursor, '_drop_registration', 'active_registration', params)
+    if row is None:
+        return None
+    execute(cursor, '_drop_registration', 'drop_active_registration', params)
+    if row[0] == RegistrationStatus.ENROLLED:
+        execute(cursor, '_drop_registration', 'decrement_enrollment', section)
+        _promote_waitlisted(cursor, course_code, section_number)
+    else:
+        execute(cursor, '_drop_registration', 'decrement_waitlist', section)
+        execute(cursor, '_drop_registration', 'close_waitlist_gap', {**section, 'waitlist_position': row[2]})
+        _bump_waitlist_version(cursor, course_code, section_number)
+    _bump_catalog_version(cursor, course_code)
+    return row[0]
 
 def update_student_registration_status(db_connection:Connection, registration: Registration)-> str:
     logger.info('Upadting the registration status')
-    check_status_query = f""" SELECT Status FROM RegistrationList where StudentID = {registration.student_id} and SectionNumber = {registration.section_number} and CourseCode = '{registration.course_code}'"""
-    update_status_query = f""" UPDATE RegistrationList SET Status = 'dropped' where StudentID = {registration.student_id} and 
-                               SectionNumber = {registration.section_number} and CourseCode = '{registration.course_code}' and status = 'enrolled' """
-    update_current_enrollment_query = f"""UPDATE SECTION set CurrentEnrollment = CurrentEnrollment -1 where SectionNumber = {registration.section_number} and CourseCode = '{registration.course_code}'"""
-    update_waitlist_count_query = f"""UPDATE "Section" SET Waitlist = Waitlist - 1 WHERE SectionNumber = {registration.section_number} and CourseCode = '{registration.course_code}'"""
-    cursor = db_connection.cursor()
-    cursor.execute("BEGIN")
-    try:
-        rows =  cursor.execute(check_status_query)
-        if rows.arraysize == 0:
-            raise HTTPException(status_code= status.HTTP_400_BAD_REQUEST, detail= f'Record not found')
-        row = rows.fetchone()
-        if row[0] == RegistrationStatus.DROPPED:
+    params = {'student_id': registration.student_id, 'course_code': registration.course_code,
+              'section_number': registration.section_number}
+    with transaction(db_connection, 'Fail to drop the class', begin="BEGIN IMMEDIATE") as cursor:
+        dropped = _drop_registration(cursor, registration.student_id, registration.course_code,
+                                     registration.section_number)
+        if dropped is None:
+            if fetch_one(cursor, 'update_student_registration_status', 'registration_status', params) is None:
+                raise RecordNotFoundException(error_detail = 'Record not found')
             return RegistrationStatus.DROPPED
-        else:
-            cursor.execute(update_status_query)
-            if row[0] == RegistrationStatus.ENROLLED:
-                cursor.execute(update_current_enrollment_query)
-            elif row[0] == RegistrationStatus.WAITLISTED:
-                cursor.execute(update_waitlist_count_query)
-        cursor.execute("COMMIT")
-    except Exception as err:
-        logger.error(err)
-        cursor.execute("ROLLBACK")
-        logger.info('Rolling back transaction')
-        raise DBException(error_detail = 'Fail to drop the class')
-    finally:
-        cursor.close()
     return QueryStatus.SUCCESS
-        
-    
+
+def rebalance_waitlists(db_connection: Connection) -> Dict[Tuple[str, int], int]:
+    """Fill every open seat in every open section from the front of its waitlist.
+
+    One UPDATE promotes every waitlisted registration whose position fits in
+    its section's free seats, then the counters and remaining positions of
+    all affected sections are moved together.
+
+    Returns:
+        Dict[Tuple[str, int], int]: students promoted per (course code, section number)
+    """
+    logger.info('Rebalancing waitlists')
+    with transaction(db_connection, 'Fail to rebalance waitlists', begin="BEGIN IMMEDIATE") as cursor:
+        rows = fetch_all(cursor, 'rebalance_waitlists', 'promote_all_waitlisted')
+        return _apply_promotions(cursor, rows)
+
+
 def check_class_exists(db_connection: Connection, course_code: str)-> bool:
     logger.info('Checking if class exists')
-    result = False
-    query = f"""
-            SELECT CourseCode FROM Class where CourseCode = '{course_code}' 
-            """
-    cursor = db_connection.cursor()
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    if len(rows) > 0:
-        result = True
-    return result
+    row = fetch_one(db_connection, 'check_class_exists', 'class_exists', {'course_code': course_code})
+    return row is not None
 
 
 def check_section_exists(db_connection: Connection, course_code: str, section_number: int)-> bool:
     logger.info('Checking if section exists')
-    result = False
-    query = f"""
-            SELECT SectionNumber FROM Section where CourseCode = '{course_code}' and SectionNumber = {section_number}
-            """
-    cursor = db_connection.cursor()
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    if len(rows) > 0:
-        result = True
-    return result
-
-def check_if_active(db_connection, enrollment_request):
-    query = """SELECT SectionStatus from Section WHERE CourseCode = ? AND SectionNumber = ?"""
-    cursor = db_connection.cursor()
-    cursor.execute(query, (enrollment_request.course_code, enrollment_request.section_number))
-    result = cursor.fetchone()
-    if result is not None and (result[0] == "open"):
-        return True
-    else:
-        return False
+    params = {'course_code': course_code, 'section_number': section_number}
+    row = fetch_one(db_connection, 'check_section_exists', 'section_exists', params)
+    return row is not None
 
 def check_is_instructor(db_connection: Connection, instructor_id: int)-> Union[str, None]:
     logger.info('Checking if user is instructor')
-    query = f"""
-            SELECT role FROM Users where CWID = {instructor_id}
-            """
-    cursor = db_connection.cursor()
-    rows =  cursor.execute(query)
-    if rows.arraysize == 0:
-        raise HTTPException(status_code= status.HTTP_400_BAD_REQUEST, detail= f'Record not found for given CWID: {instructor_id}')
-    result = UserRole.NOT_FOUND
-    for row in rows:
-        result = row[0]
-    return result
+    row = fetch_one(db_connection, 'check_is_instructor', 'user_role', {'cwid': instructor_id})
+    if row is None:
+        return UserRole.NOT_FOUND
+    return row[0]
 
 
 def addClass(db_connection: Connection, course_code, class_name, department) -> str:
     logger.info('Starting to add class')
-    insert_query = f"""
-    INSERT INTO Class (CourseCode, Name, Department) VALUES ('{course_code}', '{class_name}', '{department}')
-    """
-
-    cursor = db_connection.cursor()
-
-    cursor.execute("BEGIN")
-    try:
-        cursor.execute(insert_query)
-        cursor.execute("COMMIT")
-    except Exception as err:
-        logger.error(err)
-        cursor.execute("ROLLBACK")
-        logger.info('Rolling back transaction')
-        raise DBException(error_detail = 'Fail to add class')
-    finally:
-        cursor.close()
+    params = {'course_code': course_code, 'class_name': class_name, 'department': department}
+    with transaction(db_connection, 'Fail to add class') as cursor:
+        execute(cursor, 'addClass', 'insert_class', params)
+        _bump_catalog_version(cursor, course_code)
 
     return QueryStatus.SUCCESS
 
 def addSection(db_connection: Connection, section_number, course_code, instructor_id, max_enrollment) -> str:
     logger.info('Starting to add section')
-    insert_query = f"""
-    INSERT INTO Section (SectionNumber, CourseCode, InstructorID, MaxEnrollment, CurrentEnrollment, Waitlist, SectionStatus) VALUES ({section_number}, '{course_code}', {instructor_id}, {max_enrollment}, 0, 0, 'open')
-    """
-    cursor = db_connection.cursor()
-    cursor.execute("BEGIN")
-    try:
-        cursor.execute(insert_query)
-        cursor.execute("COMMIT")
-    except Exception as err:
-        logger.error(err)
-        cursor.execute("ROLLBACK")
-        logger.info('Rolling back transaction')
-        raise DBException(error_detail = 'Fail to add section')
-    finally:
-        cursor.close()
+    params = {'section_number': section_number, 'course_code': course_code,
+              'instructor_id': instructor_id, 'max_enrollment': max_enrollment}
+    with transaction(db_connection, 'Fail to add section') as cursor:
+        execute(cursor, 'addSection', 'insert_section', params)
+        _bump_catalog_version(cursor, course_code)
 
     return QueryStatus.SUCCESS
 
 def deleteSection(db_connection: Connection, course_code: str, section_number: int) -> str:
     logger.info('Starting to delete section')
-    delete_query = f"""
-    DELETE FROM Section WHERE CourseCode = '{course_code}' and SectionNumber = {section_number}
-    """
-
-    cursor = db_connection.cursor()
-    cursor.execute("BEGIN")
-    try:
-        cursor.execute(delete_query)
-        cursor.execute("COMMIT")
-    except Exception as err:
-        logger.error(err)
-        cursor.execute("ROLLBACK")
-        logger.info('Rolling back transaction')
-        raise DBException(error_detail = 'Fail to delete section')
-    finally:
-        cursor.close()
+    params = {'course_code': course_code, 'section_number': section_number}
+    with transaction(db_connection, 'Fail to delete section') as cursor:
+        execute(cursor, 'deleteSection', 'delete_section', params)
+        _bump_catalog_version(cursor, course_code)
+        _bump_waitlist_version(cursor, course_code, section_number)
 
     return QueryStatus.SUCCESS
 
 def changeSectionInstructor(db_connection: Connection, course_code: str, section_number: int, instructor_id: int) -> str:
-    logger.info('Starting to change instructor for section ', str(section_number))
-    update_query = f"""
-    UPDATE Section SET InstructorID = {instructor_id} WHERE SectionNumber = {section_number} and CourseCode = '{course_code}'
-    """
-
-    cursor = db_connection.cursor()
-    cursor.execute("BEGIN")
-    try:
-        cursor.execute(update_query)
-        cursor.execute("COMMIT")
-    except Exception as err:
-        logger.error(err)
-        cursor.execute("ROLLBACK")
-        logger.info('Rolling back transaction')
-        raise DBException(error_detail = 'Fail to change instructor')
-    finally:
-        cursor.close()
+    logger.info(f'Starting to change instructor for section {course_code} {section_number}')
+    params = {'course_code': course_code, 'section_number': section_number, 'instructor_id': instructor_id}
+    with transaction(db_connection, 'Fail to change instructor') as cursor:
+        execute(cursor, 'changeSectionInstructor', 'update_section_instructor', params)
+        _bump_catalog_version(cursor, course_code)
 
     return QueryStatus.SUCCESS
 
 def freezeEnrollment(db_connection: Connection, course_code: str, section_number: int) -> str:
-    logger.info('Starting to freeze enrollment for section ', str(section_number))
-    update_query = f"""
-    UPDATE Section SET SectionStatus = 'closed' WHERE SectionNumber = {section_number} and CourseCode = '{course_code}'
-    """
-
-    cursor = db_connection.cursor()
-    cursor.execute("BEGIN")
-    try:
-        cursor.execute(update_query)
-        cursor.execute("COMMIT")
-    except Exception as err:
-        logger.error(err)
-        cursor.execute("ROLLBACK")
-        logger.info('Rolling back transaction')
-        raise DBException(error_detail = 'Fail to freeze enrollment')
-    finally:
-        cursor.close()
+    logger.info(f'Starting to freeze enrollment for section {course_code} {section_number}')
+    params = {'course_code': course_code, 'section_number': section_number}
+    with transaction(db_connection, 'Fail to freeze enrollment') as cursor:
+        execute(cursor, 'freezeEnrollment', 'freeze_section', params)
+        _bump_catalog_version(cursor, course_code)
 
     return QueryStatus.SUCCESS
 
-# enrolled students
-def get_enrolled_students(db_connection: Connection, instructor_id: int, course_code: Optional[str] = None, section_number: Optional[int] = None) -> List[EnrollmentListResponse]:
-    logger.info('Getting enrolled students for instructor with CWID:')
-    query = """
-                SELECT
-                    Users.CWID AS StudentCWID,
-                    Users.Name AS StudentFirstName,
-                    Users.LastName AS StudentLastName,
-                    Class.CourseCode AS CourseCode,
-                    Section.SectionNumber AS SectionNumber,
-                    Class.Name AS ClassName,
-                    RegistrationList.Status AS Status
-                FROM
-                    RegistrationList
-                    JOIN Users ON RegistrationList.StudentID = Users.CWID
-                    JOIN Section ON RegistrationList.CourseCode = Section.CourseCode AND RegistrationList.SectionNumber = Section.SectionNumber
-                    JOIN Class ON Section.CourseCode = Class.CourseCode
-                WHERE
-                    Section.InstructorID = ?
-                    AND RegistrationList.Status = 'enrolled'
-            """
-    params = [instructor_id]
-    if course_code is not None:
-        query += " AND Section.CourseCode = ?"
-        params.append(course_code)
-    if section_number is not None:
-        query += " AND Section.SectionNumber = ?"
-        params.append(section_number)
-    else:
-        query += " ORDER BY Class.CourseCode, Section.SectionNumber, Users.LastName, Users.Name"
-    cur = db_connection.execute(query, tuple(params))
-    enrollment = cur.fetchall()
-    if not enrollment:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Enrollment for instructor not found"
-        )
-    results = [{"student_cwid": row[0],
-                      "student_first_name": row[1],
-                      "student_last_name": row[2],
-                      "course_code": row[3],
-                      "section_number": row[4],
-                      "class_name": row[5],
-                      "status": row[6]} for row in enrollment]
-    return results
+ROSTER_STATUSES = (RegistrationStatus.ENROLLED, RegistrationStatus.WAITLISTED, RegistrationStatus.DROPPED)
+# keyset columns of a roster cursor, in ORDER BY order
+ROSTER_CURSOR_FIELDS = ('after_course_code', 'after_section_number', 'after_last_name', 'after_first_name', 'after_cwid')
+ROSTER_CURSOR_TYPES = (str, int, str, str, int)
+
+def roster_record(row) -> dict:
+    return {"student_cwid": row[0],
+            "student_first_name": row[1],
+            "student_last_name": row[2],
+            "course_code": row[3],
+            "section_number": row[4],
+            "class_name": row[5],
+            "status": row[6]}
+
+def _roster_results(enrollment) -> list:
+    return [roster_record(row) for row in enrollment]
+
+def roster_key(student: dict) -> tuple:
+    """Sort key of a roster record, the ORDER BY of ROSTER_SQL_QUERY."""
+    return (student["course_code"], student["section_number"], student["student_last_name"],
+            student["student_first_name"], student["student_cwid"])
+
+def roster_row_key(row) -> tuple:
+    """roster_key of a raw roster row."""
+    return (row[3], row[4], row[2], row[1], row[0])
+
+def encode_roster_cursor(student: dict) -> str:
+    """Opaque keyset cursor pointing just past a roster record, in roster order."""
+    key = list(roster_key(student))
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_roster_cursor(cursor: Optional[str]) -> Optional[dict]:
+    """Keyset parameters for a cursor made by encode_roster_cursor, None for no cursor.
+
+    Raises:
+        ValueError: the cursor was not made by encode_roster_cursor
+    """
+    if cursor is None:
+        return None
+    key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    if (not isinstance(key, list) or len(key) != len(ROSTER_CURSOR_TYPES)
+            or not all(type(value) is expected for value, expected in zip(key, ROSTER_CURSOR_TYPES))):
+        raise ValueError('Invalid roster cursor')
+    return dict(zip(ROSTER_CURSOR_FIELDS, key))
+
+def _roster_params(instructor_id: int, statuses, course_code: Optional[str], section_number: Optional[int],
+                   after: Optional[dict], limit: Optional[int]) -> Tuple[str, dict]:
+    name = 'roster'
+    if course_code is not None and section_number is not None:
+        name = 'roster_by_course_section'
+    elif course_code is not None:
+        name = 'roster_by_course'
+    elif section_number is not None:
+        name = 'roster_by_section'
+    requested = [RegistrationStatus(registration_status).value for registration_status in statuses]
+    # unused slots stay NULL, which never matches a status
+    slots = (requested + [None] * len(ROSTER_STATUSES))[:len(ROSTER_STATUSES)]
+    params = {'instructor_id': instructor_id, 'course_code': course_code, 'section_number': section_number,
+              'limit': limit, **dict.fromkeys(ROSTER_CURSOR_FIELDS), **(after or {}),
+              **{f'status_{index}': slot for index, slot in enumerate(slots)}}
+    return name, params
+
+def roster_cursor(db_connection: Connection, instructor_id: int, statuses = ROSTER_STATUSES,
+                  course_code: Optional[str] = None, section_number: Optional[int] = None,
+                  after: Optional[dict] = None, limit: Optional[int] = None) -> sqlite3.Cursor:
+    """Open cursor over the roster rows, for callers that stream them instead of fetching them all.
+
+    The caller fetches the rows, so the recorded time only covers the first step of the statement.
+    """
+    name, params = _roster_params(instructor_id, statuses, course_code, section_number, after, limit)
+    return execute(db_connection, 'roster_cursor', name, params)
 
-# waitlisted students
-def get_waitlisted_students(db_connection: Connection, instructor_id: int, course_code: Optional[str] = None, section_number: Optional[int] = None) -> List[EnrollmentListResponse]:
-    logger.info('Getting enrolled students for instructor with CWID:')
-    query = """
-                SELECT
-                    Users.CWID AS StudentCWID,
-                    Users.Name AS StudentFirstName,
-                    Users.LastName AS StudentLastName,
-                    Class.CourseCode AS CourseCode,
-                    Section.SectionNumber AS SectionNumber,
-                    Class.Name AS ClassName,
-                    RegistrationList.Status AS Status
-                FROM
-                    RegistrationList
-                    JOIN Users ON RegistrationList.StudentID = Users.CWID
-                    JOIN Section ON RegistrationList.CourseCode = Section.CourseCode AND RegistrationList.SectionNumber = Section.SectionNumber
-                    JOIN Class ON Section.CourseCode = Class.CourseCode
-                WHERE
-                    Section.InstructorID = ?
-                    AND RegistrationList.Status = 'waitlisted'
-            """
-    params = [instructor_id]
-    if course_code is not None:
-        query += " AND Section.CourseCode = ?"
-        params.append(course_code)
-    if section_number is not None:
-        query += " AND Section.SectionNumber = ?"
-        params.append(section_number)
-    else:
-        query += " ORDER BY Class.CourseCode, Section.SectionNumber, Users.LastName, Users.Name"
-    cur = db_connection.execute(query, tuple(params))
-    enrollment = cur.fetchall()
-    if not enrollment:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Waitlist for instructor not found"
-        )
-    results = [{"student_cwid": row[0],
-                      "student_first_name": row[1],
-                      "student_last_name": row[2],
-                      "course_code": row[3],
-                      "section_number": row[4],
-                      "class_name": row[5],
-                      "status": row[6]} for row in enrollment]
-    return results
+def get_roster(db_connection: Connection, instructor_id: int, statuses = ROSTER_STATUSES,
+               course_code: Optional[str] = None, section_number: Optional[int] = None,
+               after: Optional[dict] = None, limit: Optional[int] = None) -> Tuple[Dict[str, list], Optional[str]]:
+    """Students of an instructor's sections for any mix of registration statuses, in one query.
 
-# dropped students 
-def get_dropped_students(db_connection: Connection, instructor_id: int,course_code: Optional[str] = None, section_number: Optional[int] = None) -> List[EnrollmentListResponse]:
-    logger.info('Getting dropped students for instructor')
-    query = """
-                SELECT
-                    Users.CWID AS StudentCWID,
-                    Users.Name AS StudentFirstName,
-                    Users.LastName AS StudentLastName,
-                    Class.CourseCode AS CourseCode,
-                    Section.SectionNumber AS SectionNumber,
-                    Class.Name AS ClassName,
-                    RegistrationList.Status AS Status
-                FROM
-                    RegistrationList
-                    JOIN Users ON RegistrationList.StudentID = Users.CWID
-                    JOIN Section ON RegistrationList.CourseCode = Section.CourseCode AND RegistrationList.SectionNumber = Section.SectionNumber
-                    JOIN Class ON Section.CourseCode = Class.CourseCode
-                WHERE
-                    Section.InstructorID = ?
-                    AND RegistrationList.Status = 'dropped' 
-            """
-    params = [instructor_id]
-    if course_code is not None:
-        query += " AND Section.CourseCode = ?"
-        params.append(course_code)
-    if section_number is not None:
-        query += " AND Section.SectionNumber = ?"
-        params.append(section_number)
-    else:
-        query += " ORDER BY Class.CourseCode, Section.SectionNumber, Users.LastName, Users.Name"
-    cur = db_connection.execute(query, tuple(params))
-    enrollment = cur.fetchall()
-    if not enrollment:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="No students that dropped found for instructor"
-        )
-    results = [{"student_cwid": row[0],
-                      "student_first_name": row[1],
-                      "student_last_name": row[2],
-                      "course_code": row[3],
-                      "section_number": row[4],
-                      "class_name": row[5],
-                      "status": row[6]} for row in enrollment]
-    return results
+    Args:
+        db_connection (Connection): SQLite Connection
+        instructor_id (int): Instructor id
+        statuses: any of enrolled, waitlisted and dropped
+        course_code (Optional[str]): only this course
+        section_number (Optional[int]): only this section number
+        after (Optional[dict]): keyset from decode_roster_cursor, start after this record
+        limit (Optional[int]): at most this many records, all of them when None
 
-def get_waitlist_status(db_connection: Connection, student_id: int) -> str:
-    logger.info('Checking waitlist position for student ', str(student_id))
-    query = f"""
-        WITH WaitlistPosition AS (
-        SELECT
-            rl.StudentID,
-            rl.CourseCode,
-            rl.SectionNumber,
-            rl.Status,
-            ROW_NUMBER() OVER (PARTITION BY rl.CourseCode, rl.SectionNumber ORDER BY rl.EnrollmentDate) AS Position
-        FROM
-            RegistrationList rl
-        WHERE
-            rl.Status = 'waitlisted'
-        )
-        SELECT
-            wlp.Position,
-            wlp.CourseCode,
-            wlp.SectionNumber
-        FROM
-            WaitlistPosition wlp
-        WHERE
-            wlp.StudentID = {student_id}
+    Returns:
+        Tuple[Dict[str, list], Optional[str]]: roster rows for each requested status, in roster order,
+        and the cursor of the next page when more rows follow
     """
-    cursor = db_connection.cursor()
-    rows =  cursor.execute(query)
-    if rows.arraysize == 0:
-        raise HTTPException(status_code= status.HTTP_400_BAD_REQUEST, detail= f'Record not found.')
-    result = []
-    for row in rows:
-        logger.info(str(row))
-        waitlist = WaitlistPositionList(
-            waitlist_position = row[0],
-            section_number = row[2],
-            course_code = row[1]
-        )
-        result.append(waitlist)
-    print(result)
-    return result
-
-def get_waitlist(db_connection: Connection, course_code: str, section_number: int) -> list:
-    logger.info(f'fetching  the students on the waitlist with coursecode and section no {course_code}, {section_number}')
-    query = f"""
-        SELECT
-            r.StudentID,
-            u.Name AS StudentName,
-            r.EnrollmentDate,
-            r.Status
-        FROM
-            RegistrationList r
-        JOIN
-            Users u ON r.StudentID = u.CWID
-        WHERE
-            r.CourseCode = "{course_code}"
-            AND r.SectionNumber = {section_number}
-            AND r.Status = 'waitlisted'
-        ORDER BY
-            r.EnrollmentDate;
+    # one extra row tells whether there is a next page
+    name, params = _roster_params(instructor_id, statuses, course_code, section_number, after,
+                                  None if limit is None else limit + 1)
+    rows = fetch_all(db_connection, 'get_roster', name, params)
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_roster_cursor(roster_record(rows[-1]))
+    roster = {RegistrationStatus(registration_status).value: [] for registration_status in statuses}
+    for student in _roster_results(sample_rows(rows, __name__)):
+        roster[student["status"]].append(student)
+    return roster, next_cursor
+
+def merge_roster_pages(pages, limit: Optional[int] = None) -> Tuple[Dict[str, list], Optional[str]]:
+    """One roster page out of the same get_roster page read from every shard.
+
+    Each shard returned up to ``limit`` records after the same cursor, so the
+    first ``limit`` of their union in roster order is the real page.
     """
-    cursor = db_connection.cursor()
-    rows =  cursor.execute(query)
-    if rows.arraysize == 0:
-        raise HTTPException(status_code= status.HTTP_400_BAD_REQUEST, detail= f'Records not found.')
-        # todo: throw appropriate error messages
-    result = []
-    for row in rows:
-        logger.info(str(row))
-        student = WaitlistStudents(
-            student_id = row[0],
-            student_name = row[1],
-            enrollment_date = row[2]
-        )
-        result.append(student)
-    logger.info(result)
-    return result
-
-# check if student is enrolled 
+    students = sorted((student for roster, _ in pages for records in roster.values() for student in records),
+                      key=roster_key)
+    more = any(next_cursor is not None for _, next_cursor in pages)
+    if limit is not None and len(students) > limit:
+        students = students[:limit]
+        more = True
+    roster = {registration_status: [] for registration_status in pages[0][0]}
+    for student in students:
+        roster[student["status"]].append(student)
+    return roster, encode_roster_cursor(students[-1]) if more and students else None
+
+def get_instructor_roster(db_connection: Connection, instructor_id: int, statuses = ROSTER_STATUSES,
+                          course_code: Optional[str] = None, section_number: Optional[int] = None,
+                          after: Optional[dict] = None, limit: Optional[int] = None,
+                          role: Optional[str] = None) -> Tuple[str, Dict[str, list], Optional[str]]:
+    """Role check and roster on one connection. The roster is empty unless the user is an instructor.
+
+    The role is only looked up when the caller does not pass it.
+    """
+    if role is None:
+        role = check_is_instructor(db_connection, instructor_id)
+    if role != UserRole.INSTRUCTOR:
+        return role, {}, None
+    return (role, *get_roster(db_connection, instructor_id, statuses, course_code, section_number, after, limit))
+
+def get_waitlist_status(db_connection: Connection, student_id: int) -> List[dict]:
+    """Waitlist positions of a student, shaped like WaitlistPositionList."""
+    logger.info(f'Checking waitlist position for student {student_id}')
+    rows = sample_rows(fetch_all(db_connection, 'get_waitlist_status', 'waitlist_positions', {'student_id': student_id}), __name__)
+    return [{"section_number": row[2],
+             "course_code": row[1],
+             "waitlist_position": row[0]} for row in rows]
+
+def get_waitlist(db_connection: Connection, course_code: str, section_number: int) -> List[dict]:
+    """Waitlisted students of a section in waitlist order, shaped like WaitlistStudents."""
+    logger.info(f'fetching the students on the waitlist with coursecode and section no {course_code}, {section_number}')
+    rows = sample_rows(fetch_all(db_connection, 'get_waitlist', 'section_waitlist', {'course_code': course_code, 'section_number': section_number}),
+                       __name__)
+    return [{"student_id": row[0],
+             "student_name": row[1],
+             "enrollment_date": row[2]} for row in rows]
+
+# check if student is enrolled
 def check_is_enrolled(db_connection, DropRequest) -> bool:
-    query = """SELECT Status FROM RegistrationList WHERE StudentID = ? AND CourseCode = ? AND SectionNumber = ?"""
-    cursor = db_connection.cursor()
-    cursor.execute(query, (DropRequest.student_id, DropRequest.course_code, DropRequest.section_number))
-    result = cursor.fetchone()
+    params = {'student_id': DropRequest.student_id, 'course_code': DropRequest.course_code,
+              'section_number': DropRequest.section_number}
+    result = fetch_one(db_connection, 'check_is_enrolled', 'registration_status', params)
     if result is not None and (result[0] == "enrolled" or result[0] == "waitlisted"):
         return True
     else:
         return False
-    
-# check if instructor is the instructor of the section 
+
+# check if instructor is the instructor of the section
 def check_is_instructor_of_section(db_connection, DropRequest) -> bool:
-    query = """SELECT InstructorID FROM Section WHERE CourseCode = ? AND SectionNumber = ?"""
-    cursor = db_connection.cursor()
-    cursor.execute(query, (DropRequest.course_code, DropRequest.section_number))
-    result = cursor.fetchone()
+    params = {'course_code': DropRequest.course_code, 'section_number': DropRequest.section_number}
+    result = fetch_one(db_connection, 'check_is_instructor_of_section', 'section_instructor', params)
     if result is not None and result[0] == DropRequest.instructor_id:
         return True
     else:
         return False
 
-# drop a student 
+# drop a student
 def drop_student(db_connection: Connection, DropRequest: DropStudentRequest) -> str:
     logger.info('Dropping student')
-    drop = """
-                UPDATE RegistrationList SET Status = 'dropped' WHERE StudentID = ? AND CourseCode = ? AND SectionNumber = ?
-    """
-    update_enrollment = """
-                UPDATE Section SET CurrentEnrollment = CurrentEnrollment - 1 WHERE CourseCode = ? AND SectionNumber = ?
-    """
-    params = [DropRequest.student_id, DropRequest.course_code, DropRequest.section_number]
-    cursor = db_connection.cursor()
-    cursor.execute("BEGIN")
-    try:
-        cursor.execute(drop, tuple(params))
-        cursor.execute(update_enrollment, (DropRequest.course_code, DropRequest.section_number))
-        cursor.execute("COMMIT")
-    except Exception as err:
-        logger.error(err)
-        cursor.execute("ROLLBACK")
-        logger.info('Rolling back transaction')
-        raise DBException(error_detail = 'Fail to drop student')
-    finally:
-        cursor.close()
+    with transaction(db_connection, 'Fail to drop student', begin="BEGIN IMMEDIATE") as cursor:
+        dropped = _drop_registration(cursor, DropRequest.student_id, DropRequest.course_code, DropRequest.section_number)
+        if dropped is None:
+            raise RecordNotFoundException(error_detail = 'Student is not enrolled in the section')
     return QueryStatus.SUCCESS
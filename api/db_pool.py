@@ -0,0 +1,388 @@
+"""Per-process pools of reusable SQLite connections."""
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from .metrics import increment
+
+
+class PoolExhausted(Exception):
+    """Raised when no connection is returned to the pool within the checkout timeout."""
+
+
+class ConnectionPool:
+    """A fixed-size pool of SQLite connections to a single database file.
+
+    Connections keep their prepared-statement cache (``cached_statements``)
+    between checkouts. A connection that has been idle longer than
+    ``health_check_interval`` is pinged before it is handed out, and any
+    connection that failed with a connection-level error is thrown away.
+
+    The pool also watches the database file and the LiteFS ``.primary``
+    marker in the same directory. When either changes (the file was replaced
+    or a LiteFS failover moved the primary) every pooled connection is
+    recycled so no request keeps talking to a stale inode.
+    """
+
+    def __init__(self, database: str, size: int = 4, uri: bool = False, cached_statements: int = 256,
+                 health_check_interval: float = 30.0, failover_check_interval: float = 1.0,
+                 checkout_timeout: float = 5.0, setup=None):
+        self.database = database
+        self.size = size
+        self.uri = uri
+        self.cached_statements = cached_statements
+        self.health_check_interval = health_check_interval
+        self.failover_check_interval = failover_check_interval
+        self.checkout_timeout = checkout_timeout
+        self.setup = setup
+
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._generation = 0
+        self._marker = None
+        self._marker_checked_at = 0.0
+        self._closed = False
+
+    def _open(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.database, uri=self.uri, check_same_thread=False,
+                                     cached_statements=self.cached_statements)
+        connection.row_factory = sqlite3.Row
+        connection.isolation_level = None
+        if self.setup is not None:
+            self.setup(connection)
+        return connection
+
+    def _file_path(self) -> str:
+        path = self.database
+        if self.uri:
+            path = path[len("file:"):].split("?", 1)[0]
+        return path
+
+    def _read_marker(self):
+        path = self._file_path()
+        try:
+            stat = os.stat(path)
+            inode = (stat.st_dev, stat.st_ino)
+        except OSError:
+            inode = None
+        try:
+            with open(os.path.join(os.path.dirname(path), ".primary")) as primary_file:
+                primary = primary_file.read().strip()
+        except OSError:
+            primary = None
+        return inode, primary
+
+    def _check_failover(self):
+        now = time.monotonic()
+        if now - self._marker_checked_at < self.failover_check_interval:
+            return
+        self._marker_checked_at = now
+        marker = self._read_marker()
+        if self._marker is not None and marker != self._marker:
+            logger.warning(f'Database {self.database} changed underneath the pool, recycling connections')
+            self.recycle()
+        self._marker = marker
+
+    def recycle(self):
+        """Close every idle connection and retire the ones currently checked out."""
+        with self._lock:
+            self._generation += 1
+        while True:
+            try:
+                connection, _, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(connection)
+
+    def _discard(self, connection: sqlite3.Connection):
+        with contextlib.suppress(sqlite3.Error):
+            connection.close()
+        with self._lock:
+            self._opened -= 1
+
+    def _healthy(self, connection: sqlite3.Connection) -> bool:
+        try:
+            connection.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        if self._closed:
+            raise PoolExhausted(f'Connection pool for {self.database} is closed')
+        self._check_failover()
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            try:
+                connection, generation, released_at = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_open = self._opened < self.size
+                    if can_open:
+                        self._opened += 1
+                        generation = self._generation
+                if can_open:
+                    try:
+                        return self._open(), generation
+                    except Exception:
+                        with self._lock:
+                            self._opened -= 1
+                        raise
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhausted(f'No connection to {self.database} available')
+                try:
+                    connection, generation, released_at = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    raise PoolExhausted(f'No connection to {self.database} available')
+
+            if generation != self._generation:
+                self._discard(connection)
+                continue
+            if time.monotonic() - released_at > self.health_check_interval and not self._healthy(connection):
+                self._discard(connection)
+                continue
+            return connection, generation
+
+    def release(self, connection: sqlite3.Connection, generation: int, broken: bool = False):
+        if not broken and connection.in_transaction:
+            try:
+                connection.execute("ROLLBACK")
+            except sqlite3.Error:
+                broken = True
+        if broken or self._closed or generation != self._generation:
+            self._discard(connection)
+            return
+        try:
+            self._idle.put_nowait((connection, generation, time.monotonic()))
+        except queue.Full:
+            self._discard(connection)
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection, generation = self.acquire()
+        broken = False
+        try:
+            yield connection
+        except (sqlite3.IntegrityError, sqlite3.ProgrammingError, sqlite3.DataError):
+            # statement level errors, the connection itself is fine
+            raise
+        except sqlite3.DatabaseError:
+            broken = True
+            raise
+        finally:
+            self.release(connection, generation, broken)
+
+    def close(self):
+        self._closed = True
+        self.recycle()
+
+
+class DatabaseManager:
+    """One writer connection and a pool of read-only connections to a WAL database.
+
+    Work is handed in as a function taking the connection as its first
+    argument and runs on dedicated threads, so SQLite never blocks the event
+    loop. Writes are serialized on a single writer thread. Reads run
+    concurrently on up to ``readers`` threads, which WAL allows alongside the
+    writer.
+
+    With a ``write_batch_window`` (seconds) the writer thread group-commits.
+    It collects the writes that arrive within the window, up to
+    ``write_batch_size`` of them, and runs them in one BEGIN IMMEDIATE
+    transaction, each inside its own SAVEPOINT. A write that fails rolls
+    back to its savepoint alone. Callers get their result, or their
+    exception, only after the batch commits. If the batch itself cannot
+    begin or commit, every write in it runs again in its own transaction.
+
+    ``stream`` holds a connection for as long as its consumer keeps reading,
+    so streams get their own ``streams`` connections and threads. Slow
+    downloads then only ever wait on each other, never on ``read``.
+    """
+
+    def __init__(self, database: str, readers: int = 4, busy_timeout: int = 5000,
+                 synchronous: str = "NORMAL", mmap_size: int = 268435456, cache_size: int = -16000,
+                 cached_statements: int = 256, setup=None, write_batch_window: float = 0.0,
+                 write_batch_size: int = 64, streams: int = 2):
+        self.database = database
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.setup = setup
+        self.write_batch_window = write_batch_window
+        self.write_batch_size = write_batch_size
+
+        self.writer = sqlite3.connect(database, check_same_thread=False, cached_statements=cached_statements)
+        self.writer.row_factory = sqlite3.Row
+        self.writer.isolation_level = None
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self._configure(self.writer)
+
+        self.readers = ConnectionPool(f"file:{database}?mode=ro", size=readers, uri=True,
+                                      cached_statements=cached_statements, setup=self._configure)
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self.stream_readers = ConnectionPool(f"file:{database}?mode=ro", size=streams, uri=True,
+                                             cached_statements=cached_statements, setup=self._configure)
+        self._stream_executor = ThreadPoolExecutor(max_workers=streams, thread_name_prefix="db-stream")
+        self._write_queue = queue.Queue()
+        self._batch_writer = None
+        if write_batch_window > 0:
+            self._batch_writer = threading.Thread(target=self._write_batches, name="db-batch-writer", daemon=True)
+            self._batch_writer.start()
+
+    def _configure(self, connection: sqlite3.Connection):
+        connection.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        connection.execute(f"PRAGMA synchronous={self.synchronous}")
+        connection.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        connection.execute(f"PRAGMA cache_size={int(self.cache_size)}")
+        if self.setup is not None:
+            self.setup(connection)
+
+    def _read(self, func, args, kwargs):
+        with self.readers.connection() as connection:
+            return func(connection, *args, **kwargs)
+
+    def _write(self, func, args, kwargs):
+        return func(self.writer, *args, **kwargs)
+
+    def _run(self, executor, func, *args):
+        # carry the caller's context variables (the log request id) over to the database thread
+        context = contextvars.copy_context()
+        return asyncio.get_running_loop().run_in_executor(executor, functools.partial(context.run, func, *args))
+
+    async def read(self, func, *args, **kwargs):
+        return await self._run(self._read_executor, self._read, func, args, kwargs)
+
+    async def write(self, func, *args, **kwargs):
+        if self._batch_writer is None:
+            return await self._run(self._write_executor, self._write, func, args, kwargs)
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.put((contextvars.copy_context(), func, args, kwargs, future))
+        return await future
+
+    def _write_batches(self):
+        while True:
+            job = self._write_queue.get()
+            if job is None:
+                return
+            jobs = [job]
+            deadline = time.monotonic() + self.write_batch_window
+            while len(jobs) < self.write_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    job = self._write_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if job is None:
+                    self._apply_batch(jobs)
+                    return
+                jobs.append(job)
+            self._apply_batch(jobs)
+
+    def _call(self, job):
+        context, func, args, kwargs, _ = job
+        try:
+            return True, context.run(func, self.writer, *args, **kwargs)
+        except Exception as err:
+            return False, err
+
+    @staticmethod
+    def _settle(future, ok, value):
+        if future.cancelled():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def _finish(self, job, ok, value):
+        future = job[-1]
+        future.get_loop().call_soon_threadsafe(self._settle, future, ok, value)
+
+    def _apply_alone(self, jobs):
+        for job in jobs:
+            self._finish(job, *self._call(job))
+
+    def _apply_batch(self, jobs):
+        increment('write_batches_total')
+        increment('write_batch_jobs_total', len(jobs))
+        if len(jobs) == 1:
+            self._apply_alone(jobs)
+            return
+        outcomes = []
+        try:
+            self.writer.execute("BEGIN IMMEDIATE")
+            for job in jobs:
+                self.writer.execute("SAVEPOINT write_job")
+                ok, value = self._call(job)
+                if not ok:
+                    self.writer.execute("ROLLBACK TO write_job")
+                self.writer.execute("RELEASE write_job")
+                outcomes.append((ok, value))
+            self.writer.execute("COMMIT")
+        except sqlite3.Error as err:
+            logger.warning(f'Write batch of {len(jobs)} failed ({err}), running each write on its own')
+            increment('write_batch_fallbacks_total')
+            if self.writer.in_transaction:
+                with contextlib.suppress(sqlite3.Error):
+                    self.writer.execute("ROLLBACK")
+            self._apply_alone(jobs)
+            return
+        for job, outcome in zip(jobs, outcomes):
+            self._finish(job, *outcome)
+
+    async def stream(self, func, *args, batch_size: int = 500, **kwargs):
+        """Yield the rows of the cursor ``func`` returns, ``batch_size`` rows at a time.
+
+        One stream connection stays checked out until the cursor is exhausted
+        or the consumer closes the generator, so only a single batch is ever
+        held in memory. Raises PoolExhausted when every stream connection is
+        still busy after the pool's checkout timeout.
+        """
+        # waiting for a free connection happens off the stream threads, which the open streams need to finish
+        connection, generation = await self._run(None, self.stream_readers.acquire)
+        cursor = None
+        broken = False
+        try:
+            cursor = await self._run(self._stream_executor, functools.partial(func, connection, *args, **kwargs))
+            while True:
+                rows = await self._run(self._stream_executor, cursor.fetchmany, batch_size)
+                if not rows:
+                    break
+                yield rows
+        except (sqlite3.IntegrityError, sqlite3.ProgrammingError, sqlite3.DataError):
+            raise
+        except sqlite3.DatabaseError:
+            broken = True
+            raise
+        finally:
+            if cursor is not None:
+                with contextlib.suppress(sqlite3.Error):
+                    cursor.close()
+            self.stream_readers.release(connection, generation, broken)
+
+    def close(self):
+        if self._batch_writer is not None:
+            self._write_queue.put(None)
+            self._batch_writer.join()
+        self._read_executor.shutdown(wait=True)
+        self._stream_executor.shutdown(wait=True)
+        self._write_executor.shutdown(wait=True)
+        self.readers.close()
+        self.stream_readers.close()
+        self.writer.close()
@@ -1,92 +1,286 @@
 """Main module to run server and serve endpoints for clients."""
 
-from datetime import datetime
-import sqlite3
+import asyncio
+import os
+import secrets
+import uuid
 
-from fastapi import FastAPI, HTTPException, status
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Header, HTTPException, Query, Request, status
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from loguru import logger
-from typing import Optional
+from typing import List, Optional
 
 from .database_query import *
+from .db_pool import DatabaseManager, PoolExhausted
+from .log_config import configure_logging
+from .metrics import METRICS_CONTENT_TYPE, MetricsRoute, render_metrics
 from .models import *
+from .shard_router import ShardRouter
 from .utils import *
 
-app = FastAPI()
-
-DATABASE_URL = "./api/var/enrollments.db"
+configure_logging()
 
-db_connection = sqlite3.connect(DATABASE_URL)
-db_connection.isolation_level = None
+app = FastAPI()
+app.router.route_class = MetricsRoute
+
+DATABASE_URL = os.environ.get("ENROLLMENTS_DATABASE", "./api/var/enrollments.db")
+# comma-separated shard files written by api.bin.reshard, in shard order; unset keeps the single DATABASE_URL
+SHARD_URLS = [path.strip() for path in os.environ.get("ENROLLMENTS_SHARDS", "").split(",") if path.strip()] \
+    or [DATABASE_URL]
+ROSTER_MAX_PAGE_SIZE = int(os.environ.get("ROSTER_MAX_PAGE_SIZE", 1000))
+ROSTER_STREAM_BATCH_SIZE = int(os.environ.get("ROSTER_STREAM_BATCH_SIZE", 500))
+CART_MAX_SECTIONS = int(os.environ.get("CART_MAX_SECTIONS", 10))
+
+def warm_enrollments_statements(connection):
+    warm_statement_cache(connection, ENROLLMENTS_STATEMENTS)
+
+# per shard, one writer plus a pool of WAL readers, all SQLite work runs off the event loop
+db = ShardRouter([DatabaseManager(url,
+                                  readers=int(os.environ.get("ENROLLMENTS_DB_READERS", 4)),
+                                  # NDJSON roster downloads, on their own connections so they never hold up reads
+                                  streams=int(os.environ.get("ENROLLMENTS_DB_STREAMS", 2)),
+                                  busy_timeout=int(os.environ.get("ENROLLMENTS_DB_BUSY_TIMEOUT", 5000)),
+                                  synchronous=os.environ.get("ENROLLMENTS_DB_SYNCHRONOUS", "NORMAL"),
+                                  mmap_size=int(os.environ.get("ENROLLMENTS_DB_MMAP_SIZE", 268435456)),
+                                  cache_size=int(os.environ.get("ENROLLMENTS_DB_CACHE_SIZE", -16000)),
+                                  setup=warm_enrollments_statements,
+                                  # group commit: writes arriving within the window share one transaction and one fsync
+                                  write_batch_window=float(os.environ.get("ENROLLMENTS_WRITE_BATCH_WINDOW_MS", 2)) / 1000,
+                                  write_batch_size=int(os.environ.get("ENROLLMENTS_WRITE_BATCH_SIZE", 64)))
+                  for url in SHARD_URLS])
+
+# pre-serialized /classes bodies per department, keyed on the department's ResourceVersion
+catalog_cache = ResponseCache()
+
+# database-read roles of recently authorized users, for calls that reach the service without gateway claims
+role_cache = RoleCache()
+
+# KrakenD adds it as X-Gateway-Secret to every request it forwards; unset, the claim headers are never trusted
+GATEWAY_SECRET = os.environ.get("GATEWAY_SECRET", "")
+if not GATEWAY_SECRET:
+    logger.warning('GATEWAY_SECRET is not set, X-User and X-Role are ignored and every role is looked up')
+
+def _validator_headers(etag: str) -> dict:
+    # no-cache: clients and KrakenD may store the body but must revalidate it with If-None-Match
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=_validator_headers(etag))
+
+def _json_response(body: bytes, etag: Optional[str] = None) -> Response:
+    # read endpoints build plain dicts in their response_model's shape and skip per-row model validation
+    headers = _validator_headers(etag) if etag is not None else None
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def _from_gateway(request: Request) -> bool:
+    """True when the request carries KrakenD's X-Gateway-Secret, so its claim headers came from a verified JWT."""
+    secret = request.headers.get("X-Gateway-Secret")
+    return (bool(GATEWAY_SECRET) and secret is not None
+            and secrets.compare_digest(secret.encode(), GATEWAY_SECRET.encode()))
+
+def _known_role(request: Request, cwid: int) -> Optional[str]:
+    """Role of ``cwid`` without a query, or None when it has to be looked up.
+
+    KrakenD verifies the JWT and forwards its jti (the CWID) and roles claims
+    as X-User and X-Role, which are trusted when the token belongs to
+    ``cwid`` and the request proves it came through KrakenD. Anything else,
+    like direct calls or acting on another user, falls back to role_cache.
+    """
+    if (request.headers.get("X-User") == str(cwid) and request.headers.get("X-Role")
+            and _from_gateway(request)):
+        return request.headers["X-Role"]
+    return role_cache.get(cwid)
+
+def _remember_role(cwid: int, role: str):
+    """Cache a role read from the database; roles taken from headers or the cache are never stored."""
+    if role != UserRole.NOT_FOUND:
+        role_cache.put(cwid, role)
+
+async def _user_role(request: Request, cwid: int) -> str:
+    role = _known_role(request, cwid)
+    if role is None:
+        role = await db.users.read(check_user_role, cwid)
+        _remember_role(cwid, role)
+    return role
+
+@app.middleware("http")
+async def request_id_context(request: Request, call_next):
+    """Tag every log record of a request with its X-Request-ID, generating one when the client sent none."""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    with logger.contextualize(request_id=request_id):
+        response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
 
 @app.on_event("shutdown")
 async def shutdown():
-    db_connection.close()
+    db.close()
+    await logger.complete()
+
+def _ping(connection):
+    connection.execute("SELECT 1").fetchone()
 
 @app.get(path='/db_liveness', operation_id='check_db_health')
 async def check_db_health():
     try:
-        db_connection.cursor()
+        await db.read_all(_ping)
         return JSONResponse(content= {'status': 'ok'}, status_code = status.HTTP_200_OK)
     except Exception as ex:
         return JSONResponse(content= {'status': 'not connected'}, status_code = status.HTTP_503_SERVICE_UNAVAILABLE)
 
+@app.get(path='/metrics', operation_id='metrics', include_in_schema=False)
+async def metrics():
+    """Prometheus metrics of this instance: request latency, in-flight requests, SQL timings and rollbacks."""
+    return Response(content=render_metrics(STATEMENT_STATS, FUNCTION_STATS), media_type=METRICS_CONTENT_TYPE)
+
+@app.get(path='/db_statement_stats', operation_id='db_statement_stats')
+async def db_statement_stats():
+    """Execution counts and timings of every SQL statement this process has run."""
+    return JSONResponse(content=get_statement_stats(), status_code=status.HTTP_200_OK)
+
 
 ##########   STUDENTS ENDPOINTS     ######################
 @app.get(path="/classes", operation_id="available_classes", response_model = AvailableClassResponse)
-async def available_classes(department_name: str):
+async def available_classes(department_name: str, if_none_match: Optional[str] = Header(None)):
     """API to fetch list of available classes for a given department name.
 
+    Serves the pre-serialized body from catalog_cache while the department's
+    catalog version in the database still matches the cached one, and
+    answers 304 when the client already has that version.
+
     Args:
         department_name (str): Department name
+        if_none_match (str): ETag of the listing the client already has
 
     Returns:
         AvailableClassResponse: AvailableClassResponse model
     """
-    result = get_available_classes(db_connection=db_connection, department_name=department_name)
+    resource = classes_resource(department_name)
+    # a department's courses are spread over the shards, each counting its own catalog changes
+    version = sum(await db.read_all(get_catalog_version, department_name))
+    etag = make_etag(resource, version)
+    if etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    body = catalog_cache.get(resource, version)
+    if body is None:
+        snapshots = await db.read_all(get_available_classes_snapshot, department_name)
+        version = sum(shard_version for shard_version, _ in snapshots)
+        result = [available_class for _, classes in snapshots for available_class in classes]
+        body = json_bytes({"available_classes": result})
+        catalog_cache.put(resource, version, body, tags=[available_class["course_code"] for available_class in result])
     logger.info('Succesffuly exexuted available')
-    return AvailableClassResponse(available_classes = result)
+    return _json_response(body, make_etag(resource, version))
 
 @app.post(path ="/enrollment", operation_id="course_enrollment", response_model= EnrollmentResponse)
-async def course_enrollment(enrollment_request: EnrollmentRequest):
+async def course_enrollment(enrollment_request: EnrollmentRequest, request: Request):
     """Allow enrollment of a course under given section for a student
 
     Args:
         enrollment_request (EnrollmentRequest): EnrollmentRequest model
 
     Raises:
-        HTTPException: Raise HTTP exception when role is not authrorized
+        HTTPException: Raise HTTP exception when role is not authrorized or the class is no longer active
+        HTTPException: Raise HTTP exception when the section does not exist
         HTTPException: Raise HTTP exception when query fail to execute in database
 
     Returns:
         EnrollmentResponse: EnrollmentResponse model
     """
 
-    role = check_user_role(db_connection, enrollment_request.student_id)
-    if role == UserRole.NOT_FOUND or role != UserRole.STUDENT:
-        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= f'Enrollment not authorized for role:{role}')
-    check_if_already_enrolled = check_status_query(db_connection, enrollment_request)
-    if check_if_already_enrolled :
-        return check_if_already_enrolled
-    eligibility_status = check_enrollment_eligibility(db_connection, enrollment_request.section_number, enrollment_request.course_code)
-    if eligibility_status == RegistrationStatus.NOT_ELIGIBLE:
-        return EnrollmentResponse(enrollment_status = 'not eligible')
-    active = check_if_active(db_connection, enrollment_request)
-    if active == False:
-        logger.info('Class is no longer active')
-        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= f'Class is no longer active')
-    
     try:
-        registration = Registration(student_id = enrollment_request.student_id, enrollment_status = eligibility_status, 
-                                    section_number = enrollment_request.section_number, course_code = enrollment_request.course_code) 
-        insert_status = complete_registration(db_connection,registration)
-        if insert_status == QueryStatus.SUCCESS:
-            return EnrollmentResponse(enrollment_date = datetime.utcnow(), enrollment_status = eligibility_status)
+        role = _known_role(request, enrollment_request.student_id)
+        response = await db.for_course(enrollment_request.course_code).write(enroll_student, enrollment_request, role)
+        if role is None:
+            # enroll_student read the role itself and only gets here for students
+            _remember_role(enrollment_request.student_id, UserRole.STUDENT.value)
+        catalog_cache.invalidate_tag(enrollment_request.course_code)
+        return response
+    except NotAuthorizedException as err:
+        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= err.error_detail)
+    except SectionClosedException as err:
+        logger.info(err.error_detail)
+        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= err.error_detail)
+    except RecordNotFoundException as err:
+        raise HTTPException(status_code = status.HTTP_400_BAD_REQUEST, detail= err.error_detail)
+    except DBException as err:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail= err.error_detail)
+
+
+@app.post(path ="/enrollment/cart", operation_id="cart_enrollment", response_model= CartEnrollmentResponse)
+async def cart_enrollment(cart_request: CartEnrollmentRequest, request: Request):
+    """Enroll a student in several sections at once, in one write transaction per shard
+
+    Every section gets its own status, the same ones /enrollment returns
+    plus 'not found', 'closed' and 'duplicate'. A section that cannot be
+    claimed does not undo the others. Sections on different shards are
+    claimed in parallel, each shard's share of the cart in one transaction.
+    When a shard fails, its sections get 'failed' and the reason in
+    ``error`` while the other shards' sections keep their results.
 
+    Args:
+        cart_request (CartEnrollmentRequest): CartEnrollmentRequest model
+
+    Raises:
+        HTTPException: Raise HTTP exception when the cart is empty or has more than CART_MAX_SECTIONS sections
+        HTTPException: Raise HTTP exception when role is not authrorized
+        HTTPException: Raise HTTP exception when query fail to execute in database
+
+    Returns:
+        CartEnrollmentResponse: CartEnrollmentResponse model
+    """
+    if not 1 <= len(cart_request.sections) <= CART_MAX_SECTIONS:
+        raise HTTPException(status_code = status.HTTP_400_BAD_REQUEST,
+                            detail = f'A cart holds between 1 and {CART_MAX_SECTIONS} sections')
+    try:
+        role = _known_role(request, cart_request.student_id)
+        results = await _enroll_cart(cart_request, role)
+        if role is None and any(result.enrollment_status != 'failed' for result in results):
+            _remember_role(cart_request.student_id, UserRole.STUDENT.value)
+        for course_code in {section.course_code for section in cart_request.sections}:
+            catalog_cache.invalidate_tag(course_code)
+        return CartEnrollmentResponse(results=results)
+    except NotAuthorizedException as err:
+        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= err.error_detail)
     except DBException as err:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail= err.error_detail)
 
 
+async def _enroll_cart(cart_request: CartEnrollmentRequest, role: Optional[str]) -> List[CartSectionResult]:
+    """enroll_cart on every shard holding part of the cart, results back in cart order.
+
+    Raises NotAuthorizedException only when every shard refused the student.
+    """
+    positions = {}
+    for index, section in enumerate(cart_request.sections):
+        positions.setdefault(db.shard_of(section.course_code), []).append(index)
+    shard_results = await asyncio.gather(*(
+        db.shards[shard].write(enroll_cart, CartEnrollmentRequest(
+            student_id=cart_request.student_id, sections=[cart_request.sections[index] for index in indexes]), role)
+        for shard, indexes in positions.items()), return_exceptions=True)
+    if all(isinstance(shard_result, NotAuthorizedException) for shard_result in shard_results):
+        raise shard_results[0]
+    results = [None] * len(cart_request.sections)
+    for indexes, shard_result in zip(positions.values(), shard_results):
+        if isinstance(shard_result, BaseException):
+            error = _shard_error(shard_result)
+            for index in indexes:
+                section = cart_request.sections[index]
+                results[index] = CartSectionResult(course_code=section.course_code,
+                                                   section_number=section.section_number,
+                                                   enrollment_status='failed', error=error)
+            continue
+        for index, result in zip(indexes, shard_result):
+            results[index] = result
+    return results
+
+def _shard_error(err: BaseException) -> str:
+    """What to report for a shard whose part of a multi-shard write failed."""
+    if isinstance(err, DBException):
+        return err.error_detail
+    logger.opt(exception=err).error('Shard write failed')
+    return 'Shard unavailable'
+
+
 @app.put(path = "/dropcourse", operation_id= "update_registration_status",response_model= DropCourseResponse)
 async def update_registration_status(enrollment_request:EnrollmentRequest):
     """API for students to drop a course
@@ -105,7 +299,8 @@ async def update_registration_status(enrollment_request:EnrollmentRequest):
                                     student_id=enrollment_request.student_id,
                                     course_code=enrollment_request.course_code,
                                     enrollment_status='enrolled')
-        result = update_student_registration_status(db_connection,registration)
+        result = await db.for_course(registration.course_code).write(update_student_registration_status, registration)
+        catalog_cache.invalidate_tag(enrollment_request.course_code)
         
         if result == RegistrationStatus.DROPPED:
             return DropCourseResponse(course_code=enrollment_request.course_code,
@@ -115,16 +310,20 @@ async def update_registration_status(enrollment_request:EnrollmentRequest):
         return DropCourseResponse(course_code=enrollment_request.course_code,
                                                    section_number=enrollment_request.section_number,
                                                    status='drop successfull')
+    except RecordNotFoundException as err:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,detail=err.error_detail)
     except DBException as err:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,detail=err.error_detail)
 
 ##########   REGISTRAR ENDPOINTS     ######################
 @app.post(path="/classes", operation_id="add_class", response_model=AddClassResponse)
 async def add_class(addClass_request: AddClassRequest):
-    classExists = check_class_exists(db_connection, addClass_request.course_code)
+    shard = db.for_course(addClass_request.course_code)
+    classExists = await shard.read(check_class_exists, addClass_request.course_code)
     if classExists:
         try:
-            response = addSection(db_connection, addClass_request.section_number, addClass_request.course_code, addClass_request.instructor_id, addClass_request.max_enrollment)
+            response = await shard.write(addSection, addClass_request.section_number, addClass_request.course_code, addClass_request.instructor_id, addClass_request.max_enrollment)
+            catalog_cache.invalidate_tag(addClass_request.course_code)
             if response == QueryStatus.SUCCESS:
                 return AddClassResponse(addClass_status = 'Successfully added new section')
             else:
@@ -134,9 +333,10 @@ async def add_class(addClass_request: AddClassRequest):
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail= err.error_detail)
     else:
         try:
-            addClassResponse = addClass(db_connection, addClass_request.course_code, addClass_request.class_name, addClass_request.department)
+            addClassResponse = await shard.write(addClass, addClass_request.course_code, addClass_request.class_name, addClass_request.department)
             if addClassResponse == QueryStatus.SUCCESS:
-                addSectionResponse = addSection(db_connection, addClass_request.section_number, addClass_request.course_code, addClass_request.instructor_id, addClass_request.max_enrollment)
+                addSectionResponse = await shard.write(addSection, addClass_request.section_number, addClass_request.course_code, addClass_request.instructor_id, addClass_request.max_enrollment)
+                catalog_cache.invalidate(classes_resource(addClass_request.department))
                 if addSectionResponse == QueryStatus.SUCCESS:
                     return AddClassResponse(addClass_status = 'Successfully added Class & Section')
                 else:
@@ -147,10 +347,12 @@ async def add_class(addClass_request: AddClassRequest):
 
 @app.delete(path="/sections", operation_id="delete_section", response_model=DeleteSectionResponse)  
 async def delete_section(deleteSection_Request: DeleteSectionRequest):
-    sectionExists = check_section_exists(db_connection, deleteSection_Request.course_code, deleteSection_Request.section_number)
+    shard = db.for_course(deleteSection_Request.course_code)
+    sectionExists = await shard.read(check_section_exists, deleteSection_Request.course_code, deleteSection_Request.section_number)
     if not sectionExists:
         raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= f'This section does not exist')
-    response = deleteSection(db_connection, deleteSection_Request.course_code, deleteSection_Request.section_number)
+    response = await shard.write(deleteSection, deleteSection_Request.course_code, deleteSection_Request.section_number)
+    catalog_cache.invalidate_tag(deleteSection_Request.course_code)
     if response == QueryStatus.SUCCESS:
         return DeleteSectionResponse(deleteSection_status = 'Successfully deleted section ' + str(deleteSection_Request.section_number) + ' of course ' + deleteSection_Request.course_code)
     else:
@@ -158,10 +360,12 @@ async def delete_section(deleteSection_Request: DeleteSectionRequest):
     
 @app.post(path="/changeSectionInstructor", operation_id="change_section_instructor", response_model=ChangeInstructorResponse)
 async def change_section_instructor(changeInstructor_Request: ChangeInstructorRequest):
-    sectionExists = check_section_exists(db_connection, changeInstructor_Request.course_code, changeInstructor_Request.section_number)
+    shard = db.for_course(changeInstructor_Request.course_code)
+    sectionExists = await shard.read(check_section_exists, changeInstructor_Request.course_code, changeInstructor_Request.section_number)
     if sectionExists == 0:
         raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= f'This section does not exist')
-    response = changeSectionInstructor(db_connection, changeInstructor_Request.course_code, changeInstructor_Request.section_number, changeInstructor_Request.instructor_id)
+    response = await shard.write(changeSectionInstructor, changeInstructor_Request.course_code, changeInstructor_Request.section_number, changeInstructor_Request.instructor_id)
+    catalog_cache.invalidate_tag(changeInstructor_Request.course_code)
     if response == QueryStatus.SUCCESS:
         return ChangeInstructorResponse(changeInstructor_status = 'Successfully changed instructor of section ' + str(changeInstructor_Request.section_number))
     else:
@@ -169,116 +373,282 @@ async def change_section_instructor(changeInstructor_Request: ChangeInstructorRe
     
 @app.post(path="/freezeEnrollment", operation_id='freeze_enrollment', response_model=FreezeEnrollmentResponse)
 async def freeze_enrollment(freezeEnrollment_Request: FreezeEnrollmentRequest):
-    sectionExists = check_section_exists(db_connection, freezeEnrollment_Request.course_code, freezeEnrollment_Request.section_number)
+    shard = db.for_course(freezeEnrollment_Request.course_code)
+    sectionExists = await shard.read(check_section_exists, freezeEnrollment_Request.course_code, freezeEnrollment_Request.section_number)
     if sectionExists == 0:
         raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= f'This section does not exist')
-    response = freezeEnrollment(db_connection, freezeEnrollment_Request.course_code, freezeEnrollment_Request.section_number)
+    response = await shard.write(freezeEnrollment, freezeEnrollment_Request.course_code, freezeEnrollment_Request.section_number)
+    catalog_cache.invalidate_tag(freezeEnrollment_Request.course_code)
     if response == QueryStatus.SUCCESS:
         return FreezeEnrollmentResponse(freezeEnrollment_status = 'Successfully freezed enrollment for section ' + str(freezeEnrollment_Request.section_number))
     else:
         return FreezeEnrollmentResponse(freezeEnrollment_status = 'Failed to freeze enrollment')
 
+@app.post(path="/rebalance_waitlists", operation_id="rebalance_waitlists", response_model=RebalanceWaitlistsResponse)
+async def rebalance_all_waitlists():
+    """API to fill every open seat of every open section from the front of its waitlist.
+
+    Drops already promote within their own section; this catches up sections
+    whose seats were freed some other way, e.g. a raised MaxEnrollment.
+    Each shard commits on its own, so a shard that fails is listed in
+    failed_shards and the promotions of the others are still returned.
+
+    Raises:
+        HTTPException: Raise HTTP exception when every shard failed
+
+    Returns:
+        RebalanceWaitlistsResponse: students promoted, per section
+    """
+    promoted, failed_shards = {}, []
+    for shard, shard_promoted in enumerate(await db.write_all(rebalance_waitlists, return_exceptions=True)):
+        if isinstance(shard_promoted, BaseException):
+            failed_shards.append(FailedShard(shard=shard, error=_shard_error(shard_promoted)))
+        else:
+            promoted.update(shard_promoted)
+    if len(failed_shards) == len(db.shards):
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail= failed_shards[0].error)
+    sections = []
+    for (course_code, section_number), count in sorted(promoted.items()):
+        catalog_cache.invalidate_tag(course_code)
+        sections.append(PromotedSection(course_code=course_code, section_number=section_number, promoted_students=count))
+    return RebalanceWaitlistsResponse(promoted_students=sum(promoted.values()), sections=sections,
+                                      failed_shards=failed_shards)
+
 ##########   REGISTRAR ENDPOINTS ENDS    ######################    
 
                                              
 ##########   WAITLIST ENDPOINTS     ######################
 # student viewing their position in the waitlist
 @app.get(path="/waitlist_position", operation_id="waitlist_position", response_model = WaitlistPositionRes)
-async def waitlist_position(student_id: int):
+async def waitlist_position(student_id: int, if_none_match: Optional[str] = Header(None)):
     """API to fetch the current position of a student in a waitlist.
     Args:
         student_id: int
+        if_none_match: ETag of the positions the client already has
     Returns:
-        WaitlistPositionRes: WaitlistPositionRes model
+        WaitlistPositionRes: WaitlistPositionRes model, or 304 when unchanged
     """
-    result = get_waitlist_status(db_connection=db_connection, 
-                                 student_id=student_id)
+    # the student's waitlists can sit on any shard
+    tags = await db.read_all(get_waitlist_position_tag, student_id)
+    etag = make_etag('waitlist_position', student_id, ','.join(tag for tag in tags if tag))
+    if etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    result = [position for positions in await db.read_all(get_waitlist_status, student_id=student_id)
+              for position in positions]
     logger.info('Succesffuly executed the query')
-    return WaitlistPositionRes(waitlist_positions = result)
+    return _json_response(json_bytes({"waitlist_positions": result}), etag)
 
 # instructors viewing the current waitlist for a course and section
 @app.get(path="/view_waitlist", operation_id="view_waitlist", response_model = ViewWaitlistRes)
-async def view_waitlist(course_code: str, section_number: int):
+async def view_waitlist(course_code: str, section_number: int, if_none_match: Optional[str] = Header(None)):
     """API to fetch the students in a waitlist.
     Args:
         section_number: int
         course_code: str
+        if_none_match: ETag of the waitlist the client already has
     Returns:
-        ViewWaitlistRes: ViewWaitlistRes model
+        ViewWaitlistRes: ViewWaitlistRes model, or 304 when unchanged
     """
-    result = get_waitlist(db_connection=db_connection, 
-                                 course_code=course_code, 
+    shard = db.for_course(course_code)
+    version = await shard.read(get_waitlist_version, course_code, section_number)
+    etag = make_etag(waitlist_resource(course_code, section_number), version)
+    if etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    result = await shard.read(get_waitlist, course_code=course_code, 
                                  section_number=section_number)
     logger.info('Succesffuly executed the query')
-    return ViewWaitlistRes(waitlisted_students = result)
+    return _json_response(json_bytes({"waitlisted_students": result}), etag)
 
 ##########   WAITLIST ENDPOINTS ENDS    ######################    
 
 
 ##########   INSTRUCTOR ENDPOINTS     ######################
+def _roster_after(cursor: Optional[str]) -> Optional[dict]:
+    try:
+        return decode_roster_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+
+def _check_instructor_role(role: str, action: str):
+    if role != UserRole.INSTRUCTOR:
+        logger.info(f'{action} not authorized for role')
+        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= f'{action} not authorized for role: {role}')
+
+async def _instructor_roster(request: Request, instructor_id: int, statuses, course_code: Optional[str],
+                             section_number: Optional[int], cursor: Optional[str], limit: Optional[int], action: str):
+    """Role check and one roster page in one database round trip per shard, raising 401 for non-instructors.
+
+    The instructor's sections can sit on any shard, so every shard reads the
+    same page and merge_roster_pages keeps the first ``limit`` records.
+    """
+    after = _roster_after(cursor)
+    shards = [db.for_course(course_code)] if course_code is not None else db.shards
+    known = _known_role(request, instructor_id)
+    pages = await asyncio.gather(*(shard.read(get_instructor_roster, instructor_id, statuses, course_code,
+                                              section_number, after, limit, known)
+                                   for shard in shards))
+    role = pages[0][0]
+    if known is None:
+        _remember_role(instructor_id, role)
+    _check_instructor_role(role, action)
+    if len(pages) == 1:
+        return pages[0][1], pages[0][2]
+    return merge_roster_pages([(roster, next_cursor) for _, roster, next_cursor in pages], limit)
+
+async def _ndjson_lines(first, batches):
+    try:
+        if first:
+            yield b"".join(json_bytes(roster_record(row)) + b"\n" for row in first)
+        async for rows in batches:
+            yield b"".join(json_bytes(roster_record(row)) + b"\n" for row in rows)
+    finally:
+        await batches.aclose()
+
+async def _stream_roster(request: Request, instructor_id: int, statuses, course_code: Optional[str],
+                         section_number: Optional[int], cursor: Optional[str], limit: Optional[int],
+                         action: str) -> StreamingResponse:
+    """Roster as NDJSON, one record per line, streamed from the SQLite cursors a batch at a time.
+
+    Every shard streams its part of the roster in roster order and
+    ShardRouter.stream_all merges them, so the output order is the same
+    as with one database.
+    """
+    after = _roster_after(cursor)
+    _check_instructor_role(await _user_role(request, instructor_id), action)
+    if course_code is not None:
+        batches = db.for_course(course_code).stream(roster_cursor, instructor_id, statuses, course_code,
+                                                    section_number, after, limit, batch_size=ROSTER_STREAM_BATCH_SIZE)
+    else:
+        batches = db.stream_all(roster_cursor, instructor_id, statuses, course_code, section_number, after, limit,
+                                key=roster_row_key, batch_size=ROSTER_STREAM_BATCH_SIZE, limit=limit)
+    # the first batch is read before the response starts, so a full stream pool is still a clean 503
+    try:
+        first = await batches.__anext__()
+    except StopAsyncIteration:
+        first = []
+    except PoolExhausted:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='Too many roster downloads in progress, try again later', headers={"Retry-After": "1"})
+    return StreamingResponse(_ndjson_lines(first, batches), media_type="application/x-ndjson")
+
 @app.get(path="/classEnrollment", operation_id="list_enrollment", response_model=RecordsEnrollmentResponse)
-async def list_enrollment(instructor_id: int, section_number: Optional[int] = None, course_code: Optional[str] = None):
+async def list_enrollment(request: Request, instructor_id: int, section_number: Optional[int] = None,
+                          course_code: Optional[str] = None,
+                          limit: Optional[int] = Query(None, ge=1, le=ROSTER_MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                          response_format: RosterFormat = Query(RosterFormat.JSON, alias="format")):
     """API to fetch list of enrolled students for a given instructor.
 
     Args:
         instructor_id (int): Instructor id
         section_number (Optional[int]): Section number (optional)
         course_code (Optional[str]): Course code (optional)
+        limit (Optional[int]): page size, every student when not given
+        cursor (Optional[str]): next_cursor of the previous page
+        response_format (RosterFormat): json, or ndjson to stream one student per line
 
     Returns:
         RecordsEnrollmentResponse: RecordsEnrollmentResponse model
     """
-    role = check_is_instructor(db_connection, instructor_id)
-    if role == UserRole.NOT_FOUND or role != UserRole.INSTRUCTOR:
-        logger.info('List Class Enrollment not authorized for role')
-        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= f'List Class Enrollment not authorized for role: {role}')
-    result = get_enrolled_students(db_connection, instructor_id, course_code, section_number)
+    if response_format == RosterFormat.NDJSON:
+        return await _stream_roster(request, instructor_id, [RosterStatus.ENROLLED], course_code, section_number,
+                                    cursor, limit, 'List Class Enrollment')
+    roster, next_cursor = await _instructor_roster(request, instructor_id, [RosterStatus.ENROLLED], course_code,
+                                                   section_number, cursor, limit, 'List Class Enrollment')
+    if not roster[RosterStatus.ENROLLED.value] and cursor is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Enrollment for instructor not found")
     logger.info('Successfully executed list_enrollment')
-    return RecordsEnrollmentResponse(enrolled_students = result)
+    return _json_response(json_bytes({"enrolled_students": roster[RosterStatus.ENROLLED.value], "next_cursor": next_cursor}))
 
-# TODO: test this endpoint 
 @app.get(path="/classWaitlist", operation_id="list_waitlist", response_model=RecordsWaitlistResponse)
-async def list_waitlist(instructor_id: int, section_number: Optional[int] = None, course_code: Optional[str] = None):
-    """API to fetch list of enrolled students for a given instructor.
+async def list_waitlist(request: Request, instructor_id: int, section_number: Optional[int] = None,
+                        course_code: Optional[str] = None,
+                        limit: Optional[int] = Query(None, ge=1, le=ROSTER_MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                        response_format: RosterFormat = Query(RosterFormat.JSON, alias="format")):
+    """API to fetch list of waitlisted students for a given instructor.
 
     Args:
         instructor_id (int): Instructor id
         section_number (Optional[int]): Section number (optional)
         course_code (Optional[str]): Course code (optional)
+        limit (Optional[int]): page size, every student when not given
+        cursor (Optional[str]): next_cursor of the previous page
+        response_format (RosterFormat): json, or ndjson to stream one student per line
 
     Returns:
         RecordsWaitlistResponse: RecordsWaitlistResponse model
     """
-    role = check_is_instructor(db_connection, instructor_id)
-    if role == UserRole.NOT_FOUND or role != UserRole.INSTRUCTOR:
-        logger.info('List Class Waitlist not authorized for role')
-        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= f'List Class Waitlist not authorized for role: {role}')
-    result = get_waitlisted_students(db_connection, instructor_id, course_code, section_number)
+    if response_format == RosterFormat.NDJSON:
+        return await _stream_roster(request, instructor_id, [RosterStatus.WAITLISTED], course_code, section_number,
+                                    cursor, limit, 'List Class Waitlist')
+    roster, next_cursor = await _instructor_roster(request, instructor_id, [RosterStatus.WAITLISTED], course_code,
+                                                   section_number, cursor, limit, 'List Class Waitlist')
+    if not roster[RosterStatus.WAITLISTED.value] and cursor is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Waitlist for instructor not found")
     logger.info('Successfully executed list_waitlist')
-    return RecordsWaitlistResponse(waitlisted_students = result)
+    return _json_response(json_bytes({"waitlisted_students": roster[RosterStatus.WAITLISTED.value], "next_cursor": next_cursor}))
 
 @app.get(path="/classDropped", operation_id="list_dropped", response_model=RecordsDroppedResponse)
-async def list_dropped(instructor_id: int, section_number: Optional[int] = None, course_code: Optional[str] = None):
+async def list_dropped(request: Request, instructor_id: int, section_number: Optional[int] = None,
+                       course_code: Optional[str] = None,
+                       limit: Optional[int] = Query(None, ge=1, le=ROSTER_MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                       response_format: RosterFormat = Query(RosterFormat.JSON, alias="format")):
     """API to fetch list of dropped students for a given section.
 
     Args:
         instructor_id (int): Instructor id
         section_number (Optional[int]): Section number (optional)
         course_code (Optional[str]): Course code (optional)
+        limit (Optional[int]): page size, every student when not given
+        cursor (Optional[str]): next_cursor of the previous page
+        response_format (RosterFormat): json, or ndjson to stream one student per line
 
     Returns:
         RecordsDroppedResponse: RecordsDroppedResponse model
     """
-    role = check_is_instructor(db_connection, instructor_id)
-    if role == UserRole.NOT_FOUND or role != UserRole.INSTRUCTOR:
-        logger.info('List Class Dropped not authorized for role')
-        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= f'List Class Dropped not authorized for role: {role}')
-    result = get_dropped_students(db_connection, instructor_id, course_code, section_number)
+    if response_format == RosterFormat.NDJSON:
+        return await _stream_roster(request, instructor_id, [RosterStatus.DROPPED], course_code, section_number,
+                                    cursor, limit, 'List Class Dropped')
+    roster, next_cursor = await _instructor_roster(request, instructor_id, [RosterStatus.DROPPED], course_code,
+                                                   section_number, cursor, limit, 'List Class Dropped')
+    if not roster[RosterStatus.DROPPED.value] and cursor is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No students that dropped found for instructor")
     logger.info('Successfully executed list_dropped')
-    return RecordsDroppedResponse(dropped_students = result)
+    return _json_response(json_bytes({"dropped_students": roster[RosterStatus.DROPPED.value], "next_cursor": next_cursor}))
+
+@app.get(path="/classRoster", operation_id="class_roster", response_model=RosterResponse)
+async def class_roster(request: Request, instructor_id: int, section_number: Optional[int] = None,
+                       course_code: Optional[str] = None,
+                       status_filter: Optional[List[RosterStatus]] = Query(None, alias="status"),
+                       limit: Optional[int] = Query(None, ge=1, le=ROSTER_MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                       response_format: RosterFormat = Query(RosterFormat.JSON, alias="format")):
+    """API to fetch enrolled, waitlisted and dropped students of an instructor's sections in one call.
+
+    Args:
+        instructor_id (int): Instructor id
+        section_number (Optional[int]): Section number (optional)
+        course_code (Optional[str]): Course code (optional)
+        status_filter (Optional[List[RosterStatus]]): statuses to include, repeat ?status= for several (default all)
+        limit (Optional[int]): page size across all statuses, every student when not given
+        cursor (Optional[str]): next_cursor of the previous page
+        response_format (RosterFormat): json, or ndjson to stream one student per line in roster order
+
+    Returns:
+        RosterResponse: RosterResponse model, empty lists for statuses without students
+    """
+    statuses = [roster_status.value for roster_status in (status_filter or list(RosterStatus))]
+    if response_format == RosterFormat.NDJSON:
+        return await _stream_roster(request, instructor_id, statuses, course_code, section_number, cursor, limit,
+                                    'Class Roster')
+    roster, next_cursor = await _instructor_roster(request, instructor_id, statuses, course_code, section_number, cursor,
+                                                   limit, 'Class Roster')
+    logger.info('Successfully executed class_roster')
+    return _json_response(json_bytes({"enrolled_students": roster.get(RosterStatus.ENROLLED.value, []),
+                                      "waitlisted_students": roster.get(RosterStatus.WAITLISTED.value, []),
+                                      "dropped_students": roster.get(RosterStatus.DROPPED.value, []),
+                                      "next_cursor": next_cursor}))
 
 @app.post(path="/dropStudent", operation_id="instructor_drop_student", response_model=DroppedResponse)
-async def instructor_drop_student(DropRequest: DropStudentRequest):
+async def instructor_drop_student(DropRequest: DropStudentRequest, request: Request):
     """API to drop a student from a section.
 
     Args:
@@ -290,25 +660,29 @@ async def instructor_drop_student(DropRequest: DropStudentRequest):
     Returns:
         droppedResponse: droppedResponse model
     """
-    role = check_is_instructor(db_connection, DropRequest.instructor_id)
+    role = await _user_role(request, DropRequest.instructor_id)
     # # check if action is being perform by instructor 
     if role == UserRole.NOT_FOUND or role != UserRole.INSTRUCTOR:
         logger.info('Drop Student not authorized for role')
         raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= f'Drop Student not authorized for role: {role}')
     # # check if instructor teaches the section 
-    check_instructor = check_is_instructor_of_section(db_connection, DropRequest)
+    shard = db.for_course(DropRequest.course_code)
+    check_instructor = await shard.read(check_is_instructor_of_section, DropRequest)
     if check_instructor == False:
         logger.info('Instructor does not teach the section')
         raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= f'Instructor does not teach the section')
     # # check if student is enrolled in the section or waitlisted
-    check_status = check_is_enrolled(db_connection, DropRequest)
+    check_status = await shard.read(check_is_enrolled, DropRequest)
     if check_status == False:
         logger.info('Student is not enrolled in the section')
         raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= f'Student is not enrolled in the section')
     try:    
-        result = drop_student(db_connection, DropRequest)
+        result = await shard.write(drop_student, DropRequest)
+        catalog_cache.invalidate_tag(DropRequest.course_code)
         logger.info('Successfully executed drop_student')
         if result == QueryStatus.SUCCESS:
             return DroppedResponse(drop_status = "Student was dropped")
+    except RecordNotFoundException as err:
+        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail= err.error_detail)
     except DBException as err:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,detail=err.error_detail)
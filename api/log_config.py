@@ -0,0 +1,76 @@
+"""Queue-backed loguru setup with per-module levels, row sampling and request ids."""
+
+import os
+import random
+import sys
+from typing import Dict
+
+from loguru import logger
+
+# default level, and per-module overrides as "api.database_query=WARNING,api.db_pool=DEBUG"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+# "json" writes one serialized record per line instead of text
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+# share of result rows logged at DEBUG by sample_rows
+LOG_ROW_SAMPLE_RATE = float(os.environ.get("LOG_ROW_SAMPLE_RATE", 0.01))
+
+TEXT_FORMAT = ("<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | {extra[request_id]} | "
+               "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>")
+
+_module_levels: Dict[str, int] = {"": logger.level(LOG_LEVEL).no}
+_debug_enabled: Dict[str, bool] = {}
+
+
+def parse_levels(default: str, overrides: str) -> Dict[str, str]:
+    """Level per module prefix, "" being every module without a more specific entry."""
+    levels = {"": default}
+    for entry in filter(None, (part.strip() for part in overrides.split(","))):
+        module, _, level = entry.partition("=")
+        levels[module.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(level: str = LOG_LEVEL, levels: str = LOG_LEVELS, serialize: bool = LOG_FORMAT == "json"):
+    """Replace loguru's default handler with one that writes from a background thread.
+
+    enqueue=True hands every record to a queue, so request threads never
+    wait on stderr. Records carry a request_id field, "-" outside of a
+    request.
+    """
+    module_levels = parse_levels(level, levels)
+    _module_levels.clear()
+    _module_levels.update({module: logger.level(name).no for module, name in module_levels.items()})
+    _debug_enabled.clear()
+    logger.remove()
+    logger.configure(extra={"request_id": "-"})
+    logger.add(sys.stderr, level=0, filter=module_levels, format=TEXT_FORMAT, serialize=serialize, enqueue=True)
+
+
+def _module_level(name: str) -> int:
+    module = name
+    while module not in _module_levels:
+        module = module.rpartition(".")[0] if "." in module else ""
+    return _module_levels[module]
+
+
+def _sampled(rows, rate: float):
+    log = logger.opt(depth=1)
+    for row in rows:
+        if random.random() < rate:
+            log.debug(f'row {tuple(row)}')
+        yield row
+
+
+def sample_rows(rows, name: str, rate: float = LOG_ROW_SAMPLE_RATE):
+    """Pass result rows through, logging about ``rate`` of them at DEBUG.
+
+    Returns ``rows`` untouched when DEBUG is off for the module ``name``, so
+    the sampling costs nothing in production.
+    """
+    enabled = _debug_enabled.get(name)
+    if enabled is None:
+        enabled = _debug_enabled[name] = _module_level(name) <= logger.level("DEBUG").no
+    if not enabled or rate <= 0:
+        return rows
+    return _sampled(rows, rate)
@@ -0,0 +1,153 @@
+"""Per-process request, database and password-hash metrics in the Prometheus text format.
+
+Everything is a plain dict or list bumped in place. Request latency and
+in-flight counts only change on the event loop thread. Counters and the
+statement stats in database_query are also bumped from the database
+threads, so those updates and their reads in render_metrics hold
+STATS_LOCK. Each service process keeps its own numbers and Prometheus
+scrapes every instance's /metrics separately.
+"""
+
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+# seconds, upper bounds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+COUNTER_HELP = {
+    "transaction_rollbacks_total": "Transactions rolled back, rejected by a check or failed with an error.",
+    "sqlite_busy_total": "Statements that gave up waiting for a SQLite lock after busy_timeout, the requests clients retry.",
+    "password_hash_rejected_total": "Password hashes refused because the hash queue was full.",
+    "write_batches_total": "Group commit transactions run by the database writer.",
+    "write_batch_jobs_total": "Writes applied through group commit, divided by write_batches_total gives the mean batch size.",
+    "write_batch_fallbacks_total": "Group commit batches that could not begin or commit and were rerun one write at a time.",
+}
+
+
+class Histogram:
+    __slots__ = ("counts", "total")
+
+    def __init__(self):
+        # one slot per bucket plus +Inf, not cumulative until rendered
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+
+
+REQUEST_LATENCY: Dict[str, Histogram] = {}
+IN_FLIGHT: Dict[str, int] = {}
+COUNTERS: Dict[tuple, int] = {}
+
+# guards COUNTERS and database_query's STATEMENT_STATS and FUNCTION_STATS, bumped from the database threads
+STATS_LOCK = threading.Lock()
+
+
+def increment(name: str, value: int = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with STATS_LOCK:
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+
+class MetricsRoute(APIRoute):
+    """APIRoute that records latency and in-flight requests under the route's operation_id.
+
+    Latency runs until the handler returns its response, so for streaming
+    responses it does not include sending the body.
+    """
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        operation = self.operation_id or self.name
+        histogram = REQUEST_LATENCY.setdefault(operation, Histogram())
+        IN_FLIGHT.setdefault(operation, 0)
+
+        async def timed_handler(request: Request) -> Response:
+            IN_FLIGHT[operation] += 1
+            start = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+                IN_FLIGHT[operation] -= 1
+
+        return timed_handler
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_label_value(value)}"' for name, value in labels.items()) + "}"
+
+
+def _family(lines: list, name: str, kind: str, help_text: str):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def _statement_families(lines: list, prefix: str, label: str, stats: Dict[str, list], what: str):
+    _family(lines, f"{prefix}_total", "counter", f"SQL statements executed, by {what}.")
+    lines.extend(f"{prefix}_total{_labels(**{label: key})} {count}" for key, (count, _) in stats.items() if count)
+    _family(lines, f"{prefix}_seconds_total", "counter", f"Time spent running SQL statements and fetching their rows, by {what}.")
+    lines.extend(f"{prefix}_seconds_total{_labels(**{label: key})} {total:.6f}"
+                 for key, (count, total) in stats.items() if count)
+
+
+def render_metrics(statement_stats: Optional[Dict[str, list]] = None, function_stats: Optional[Dict[str, list]] = None,
+                   gauges: Optional[Dict[str, tuple]] = None) -> str:
+    """Every metric of this process in the Prometheus text exposition format.
+
+    Args:
+        statement_stats: database_query.STATEMENT_STATS, [count, seconds] per statement name
+        function_stats: database_query.FUNCTION_STATS, [count, seconds] per database_query function
+        gauges: extra gauges, name -> (help text, value)
+    """
+    with STATS_LOCK:
+        # copied so the threads can go on counting while the text is built
+        if statement_stats is not None:
+            statement_stats = {name: tuple(stats) for name, stats in statement_stats.items()}
+        if function_stats is not None:
+            function_stats = {name: tuple(stats) for name, stats in function_stats.items()}
+        counters = list(COUNTERS.items())
+
+    lines = []
+    _family(lines, "http_request_duration_seconds", "histogram", "Request latency by operation_id.")
+    for operation, histogram in REQUEST_LATENCY.items():
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+            cumulative += count
+            lines.append(f"http_request_duration_seconds_bucket{_labels(operation_id=operation, le=bound)} {cumulative}")
+        lines.append(f"http_request_duration_seconds_sum{_labels(operation_id=operation)} {histogram.total:.6f}")
+        lines.append(f"http_request_duration_seconds_count{_labels(operation_id=operation)} {cumulative}")
+    _family(lines, "http_requests_in_flight", "gauge", "Requests currently being handled, by operation_id.")
+    lines.extend(f"http_requests_in_flight{_labels(operation_id=operation)} {count}"
+                 for operation, count in IN_FLIGHT.items())
+
+    if statement_stats is not None:
+        _statement_families(lines, "sqlite_statements", "statement", statement_stats, "catalogue statement")
+    if function_stats is not None:
+        _statement_families(lines, "sqlite_function_statements", "function", function_stats,
+                            "database_query function")
+
+    for name, help_text in COUNTER_HELP.items():
+        _family(lines, name, "counter", help_text)
+        values = [(dict(labels), value) for (counter, labels), value in counters if counter == name]
+        lines.extend(f"{name}{_labels(**labels)} {value}" for labels, value in values or [({}, 0)])
+
+    for name, (help_text, value) in (gauges or {}).items():
+        _family(lines, name, "gauge", help_text)
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
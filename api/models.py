@@ -16,6 +16,16 @@ class CreateUserRequest(BaseModel):
 class CreateUserResponse(BaseModel):
     message: str
 
+class BulkCreateUserError(BaseModel):
+    line: int
+    username: Optional[str] = None
+    detail: str
+
+class BulkCreateUserResponse(BaseModel):
+    created: int
+    failed: int
+    errors: List[BulkCreateUserError]
+
 class AuthenticateUserResponse(BaseModel):
     jwt: str
     message: str
@@ -45,6 +55,25 @@ class EnrollmentRequest(BaseModel):
     course_code: str
     student_id: int
 
+class CartSection(BaseModel):
+    course_code: str
+    section_number: int
+
+class CartEnrollmentRequest(BaseModel):
+    student_id: int
+    sections: List[CartSection]
+
+class CartSectionResult(BaseModel):
+    course_code: str
+    section_number: int
+    enrollment_status: str
+    enrollment_date: Optional[datetime] = None
+    # why the section's shard failed, for enrollment_status 'failed'
+    error: Optional[str] = None
+
+class CartEnrollmentResponse(BaseModel):
+    results: List[CartSectionResult]
+
 class RegistrationStatus(str, Enum):
     ENROLLED = 'enrolled'
     WAITLISTED = 'waitlisted'
@@ -106,6 +135,20 @@ class FreezeEnrollmentRequest(BaseModel):
     course_code: str
     section_number: int
 
+class PromotedSection(BaseModel):
+    course_code: str
+    section_number: int
+    promoted_students: int
+
+class FailedShard(BaseModel):
+    shard: int
+    error: str
+
+class RebalanceWaitlistsResponse(BaseModel):
+    promoted_students: int
+    sections: List[PromotedSection]
+    failed_shards: List[FailedShard] = []
+
 # instructor models 
 class EnrollmentListResponse(BaseModel):
     student_cwid: int
@@ -118,12 +161,30 @@ class EnrollmentListResponse(BaseModel):
 
 class RecordsEnrollmentResponse(BaseModel):
     enrolled_students: List[EnrollmentListResponse]
+    next_cursor: Optional[str] = None
 
 class RecordsDroppedResponse(BaseModel):
     dropped_students: List[EnrollmentListResponse]
+    next_cursor: Optional[str] = None
 
 class RecordsWaitlistResponse(BaseModel):
     waitlisted_students: List[EnrollmentListResponse]
+    next_cursor: Optional[str] = None
+
+class RosterStatus(str, Enum):
+    ENROLLED = 'enrolled'
+    WAITLISTED = 'waitlisted'
+    DROPPED = 'dropped'
+
+class RosterFormat(str, Enum):
+    JSON = 'json'
+    NDJSON = 'ndjson'
+
+class RosterResponse(BaseModel):
+    enrolled_students: List[EnrollmentListResponse] = []
+    waitlisted_students: List[EnrollmentListResponse] = []
+    dropped_students: List[EnrollmentListResponse] = []
+    next_cursor: Optional[str] = None
 
 class WaitlistPositionReq(BaseModel):
     # section_number: int
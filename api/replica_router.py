@@ -0,0 +1,185 @@
+"""Route users reads to the healthiest LiteFS replica that is caught up enough."""
+
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from loguru import logger
+
+from .db_pool import ConnectionPool, PoolExhausted
+
+
+def read_litefs_position(database_path: str) -> Optional[int]:
+    """Return the replication TXID LiteFS reports for a database, or None without LiteFS.
+
+    LiteFS exposes ``<database>-pos`` next to the database in the FUSE mount,
+    containing ``<txid>/<checksum>`` in hex.
+    """
+    try:
+        with open(f"{database_path}-pos") as pos_file:
+            txid, _, _ = pos_file.read().strip().partition("/")
+        return int(txid, 16)
+    except (OSError, ValueError):
+        return None
+
+
+class ReplicaState:
+    def __init__(self, pool: ConnectionPool, database_path: str):
+        self.pool = pool
+        self.database_path = database_path
+        self.position = None
+        self.in_flight = 0
+        self.latency = 0.0
+        self.error_rate = 0.0
+
+    def record(self, ok: bool, alpha: float):
+        self.error_rate = (1 - alpha) * self.error_rate + (0.0 if ok else alpha)
+
+    def mark_down(self):
+        # out of rotation until enough successful probes bring the rate back down
+        self.error_rate = 1.0
+
+
+class ReplicaRouter:
+    """Picks a replica per read based on replication lag, load and recent errors.
+
+    A replica is eligible when its LiteFS position is at most ``max_lag``
+    transactions behind the primary and its error rate (an exponentially
+    weighted average over requests and probes) is below ``max_error_rate``.
+    Among eligible replicas the one with the fewest reads in flight wins,
+    ties broken by probe latency. With no eligible replica, reads go to the
+    primary. A replica that fails to open or to run a read with an
+    OperationalError is marked down at once, and the read is retried on the
+    primary, so an outage never reaches the caller.
+
+    ``track_write`` gives read-your-writes for a key (the username): for
+    ``read_your_writes_window`` seconds after the write, reads for that key
+    only go to replicas that have replayed the primary position seen right
+    after the commit, or to the primary when positions are unknown.
+    """
+
+    def __init__(self, primary_pool: ConnectionPool, primary_path: str,
+                 replicas: List[Tuple[ConnectionPool, str]], max_lag: int = 10,
+                 max_error_rate: float = 0.5, refresh_interval: float = 0.5,
+                 read_your_writes_window: float = 30.0, alpha: float = 0.2):
+        self.primary_pool = primary_pool
+        self.primary_path = primary_path
+        self.replicas = [ReplicaState(pool, path) for pool, path in replicas]
+        self.max_lag = max_lag
+        self.max_error_rate = max_error_rate
+        self.refresh_interval = refresh_interval
+        self.read_your_writes_window = read_your_writes_window
+        self.alpha = alpha
+
+        self._lock = threading.Lock()
+        self._primary_position = None
+        self._refreshed_at = 0.0
+        self._writes = {}
+
+    def _probe(self, replica: ReplicaState):
+        start = time.perf_counter()
+        ok, down = True, False
+        try:
+            with replica.pool.connection() as db:
+                db.execute("SELECT 1").fetchone()
+        except (sqlite3.Error, PoolExhausted) as err:
+            logger.warning(f'Replica {replica.database_path} failed health probe: {err}')
+            # a busy pool only counts as an error, a database that cannot be read is down
+            ok, down = False, isinstance(err, sqlite3.Error)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            replica.latency = (1 - self.alpha) * replica.latency + self.alpha * elapsed
+            if down:
+                replica.mark_down()
+            else:
+                replica.record(ok, self.alpha)
+
+    def refresh(self, force: bool = False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._refreshed_at < self.refresh_interval:
+                return
+            self._refreshed_at = now
+            cutoff = now - self.read_your_writes_window
+            for key in [key for key, (_, written_at) in self._writes.items() if written_at < cutoff]:
+                del self._writes[key]
+        self._primary_position = read_litefs_position(self.primary_path)
+        for replica in self.replicas:
+            replica.position = read_litefs_position(replica.database_path)
+            self._probe(replica)
+
+    def track_write(self, key: str):
+        self.track_writes([key])
+
+    def track_writes(self, keys):
+        position = read_litefs_position(self.primary_path)
+        written_at = time.monotonic()
+        with self._lock:
+            for key in keys:
+                self._writes[key] = (position, written_at)
+
+    def _required_position(self, key: Optional[str]):
+        """Minimum replica position for a read, or -1 when any position is fine."""
+        if key is None:
+            return -1
+        write = self._writes.get(key)
+        if write is None or write[1] < time.monotonic() - self.read_your_writes_window:
+            return -1
+        return write[0]
+
+    def _eligible(self, replica: ReplicaState, required_position) -> bool:
+        if replica.error_rate >= self.max_error_rate:
+            return False
+        if required_position is None:
+            # the write happened but its position is unknown, only the primary is safe
+            return False
+        if required_position >= 0 and (replica.position is None or replica.position < required_position):
+            return False
+        if self._primary_position is not None:
+            if replica.position is None or self._primary_position - replica.position > self.max_lag:
+                return False
+        return True
+
+    def choose(self, key: Optional[str] = None) -> Optional[ReplicaState]:
+        self.refresh()
+        with self._lock:
+            required_position = self._required_position(key)
+            eligible = [replica for replica in self.replicas if self._eligible(replica, required_position)]
+            if not eligible:
+                return None
+            replica = min(eligible, key=lambda replica: (replica.in_flight, replica.latency))
+            replica.in_flight += 1
+            return replica
+
+    def read(self, func, *args, key: Optional[str] = None, **kwargs):
+        """Run ``func(connection, *args, **kwargs)`` on the chosen replica, or on the primary.
+
+        ``key`` is the read-your-writes key of the read. A replica that cannot
+        be opened, fails the read with an OperationalError or has no free
+        connection gets the read retried once on the primary.
+        """
+        replica = self.choose(key)
+        if replica is None:
+            with self.primary_pool.connection() as db:
+                return func(db, *args, **kwargs)
+
+        ok, down = True, False
+        try:
+            with replica.pool.connection() as db:
+                return func(db, *args, **kwargs)
+        except (sqlite3.OperationalError, PoolExhausted) as err:
+            logger.warning(f'Read on replica {replica.database_path} failed, retrying on the primary: {err}')
+            ok, down = False, isinstance(err, sqlite3.OperationalError)
+        except sqlite3.DatabaseError:
+            ok = False
+            raise
+        finally:
+            with self._lock:
+                replica.in_flight -= 1
+                if down:
+                    replica.mark_down()
+                else:
+                    replica.record(ok, self.alpha)
+        with self.primary_pool.connection() as db:
+            return func(db, *args, **kwargs)
@@ -0,0 +1,114 @@
+"""Route enrollments work to the SQLite shard that holds each course."""
+
+import asyncio
+import contextlib
+import heapq
+import zlib
+from collections import deque
+from typing import Callable, List, Optional
+
+from .db_pool import DatabaseManager
+
+
+def shard_index(course_code: str, shards: int) -> int:
+    """Shard of a course, stable across processes and Python versions (unlike hash())."""
+    return zlib.crc32(course_code.encode("utf-8")) % shards
+
+
+class ShardRouter:
+    """Sends each database_query operation to the DatabaseManager holding its course.
+
+    Class, Section, RegistrationList and their ResourceVersion rows are
+    partitioned by shard_index of the course code. Every shard has a full
+    copy of Users, so role checks and roster joins stay local to any shard.
+    Work keyed on a course goes to one shard. Work that spans courses (a
+    department's classes, a student's waitlists, an instructor's roster)
+    runs on every shard in parallel through ``read_all``/``write_all``, and
+    the caller merges the results. Each shard has its own writer, so writes
+    to different shards never wait on each other's lock.
+
+    With a single shard every call goes to that one database, which is the
+    unsharded layout.
+    """
+
+    def __init__(self, shards: List[DatabaseManager]):
+        if not shards:
+            raise ValueError('ShardRouter needs at least one shard')
+        self.shards = shards
+
+    def shard_of(self, course_code: str) -> int:
+        return shard_index(course_code, len(self.shards))
+
+    def for_course(self, course_code: str) -> DatabaseManager:
+        return self.shards[self.shard_of(course_code)]
+
+    @property
+    def users(self) -> DatabaseManager:
+        """Any shard will do for Users-only queries, they all hold the same rows."""
+        return self.shards[0]
+
+    async def read_all(self, func, *args, **kwargs) -> list:
+        """Run a read on every shard at once, results in shard order."""
+        return await asyncio.gather(*(shard.read(func, *args, **kwargs) for shard in self.shards))
+
+    async def write_all(self, func, *args, return_exceptions: bool = False, **kwargs) -> list:
+        """Run a write on every shard at once, one transaction per shard, results in shard order.
+
+        With ``return_exceptions`` a shard that fails leaves its exception in
+        its place in the results instead of failing the whole call.
+        """
+        return await asyncio.gather(*(shard.write(func, *args, **kwargs) for shard in self.shards),
+                                    return_exceptions=return_exceptions)
+
+    async def stream_all(self, func, *args, key: Callable, batch_size: int = 500, limit: Optional[int] = None,
+                         **kwargs):
+        """Merge the sorted row streams of every shard into one, ``batch_size`` rows at a time.
+
+        ``func`` must return rows already sorted by ``key`` on each shard.
+        Only one batch per shard is held in memory. At most ``limit`` rows
+        are yielded overall.
+        """
+        if len(self.shards) == 1:
+            # no merge needed, the shard's own batches pass straight through
+            async for rows in self.shards[0].stream(func, *args, batch_size=batch_size, **kwargs):
+                yield rows
+            return
+
+        streams = [shard.stream(func, *args, batch_size=batch_size, **kwargs) for shard in self.shards]
+        buffers = [deque() for _ in streams]
+
+        async def refill(index: int) -> bool:
+            try:
+                buffers[index].extend(await streams[index].__anext__())
+            except StopAsyncIteration:
+                return False
+            return True
+
+        try:
+            heap = []
+            for index in range(len(streams)):
+                if await refill(index):
+                    heap.append((key(buffers[index][0]), index))
+            heapq.heapify(heap)
+            batch = []
+            sent = 0
+            while heap and (limit is None or sent < limit):
+                _, index = heapq.heappop(heap)
+                batch.append(buffers[index].popleft())
+                sent += 1
+                if buffers[index] or await refill(index):
+                    heapq.heappush(heap, (key(buffers[index][0]), index))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            for stream in streams:
+                with contextlib.suppress(Exception):
+                    await stream.aclose()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
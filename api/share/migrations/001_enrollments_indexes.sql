@@ -0,0 +1,28 @@
+-- 001_enrollments_indexes.sql
+-- Secondary indexes for the queries in api/database_query.py.
+-- api/bin/check_query_plans.py fails if any statement falls back to a full table scan.
+
+BEGIN TRANSACTION;
+
+-- LIST_AVAILABLE_SQL_QUERY filters classes by department
+CREATE INDEX IF NOT EXISTS ClassDepartmentIdx ON Class (Department, CourseCode, Name);
+
+-- the Section primary key leads with SectionNumber, joins come in by CourseCode
+CREATE INDEX IF NOT EXISTS SectionCourseIdx ON Section (CourseCode, SectionNumber);
+
+-- instructor roster queries start from the instructor's sections
+CREATE INDEX IF NOT EXISTS SectionInstructorIdx ON Section (InstructorID, CourseCode, SectionNumber);
+
+-- a student's own registration for a section (check_status_query, drops)
+CREATE INDEX IF NOT EXISTS RegistrationStudentIdx ON RegistrationList (StudentID, CourseCode, SectionNumber, Status);
+
+-- per-section listings by status in enrollment order (waitlists, rosters, section deletes)
+CREATE INDEX IF NOT EXISTS RegistrationSectionStatusIdx ON RegistrationList (CourseCode, SectionNumber, Status, EnrollmentDate);
+
+-- a section's registrations of one status (promotion of every waitlist,
+-- per-course roster lookups)
+CREATE INDEX IF NOT EXISTS RegistrationStatusIdx ON RegistrationList (Status, CourseCode, SectionNumber, EnrollmentDate, StudentID);
+
+COMMIT;
+
+ANALYZE;
@@ -0,0 +1,15 @@
+-- 002_resource_versions.sql
+-- Version counters for data that services cache in process.
+-- Write transactions bump the counter of every resource they change, e.g.
+-- 'classes:<Department>' for the /classes listing of a department. Each
+-- enrollments instance compares the counter with the version its cached
+-- response was built from, so a write on one instance invalidates the others.
+
+BEGIN TRANSACTION;
+
+CREATE TABLE IF NOT EXISTS ResourceVersion (
+    Resource TEXT PRIMARY KEY,
+    Version INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+COMMIT;
@@ -0,0 +1,45 @@
+-- 003_waitlist_positions.sql
+-- Store each waitlisted registration's place in its section's waitlist instead
+-- of ranking every waitlisted row with ROW_NUMBER() on each lookup.
+-- Positions run 1..n per section with no gaps. The write paths in
+-- api/database_query.py keep them that way on insert, drop and promotion;
+-- non-waitlisted rows have NULL.
+-- The Section counters are recomputed from the registration rows at the same
+-- time, so a database whose counters had drifted starts out consistent.
+
+BEGIN TRANSACTION;
+
+ALTER TABLE RegistrationList ADD COLUMN WaitlistPosition INTEGER;
+
+UPDATE RegistrationList
+SET WaitlistPosition = Ranked.Position
+FROM (
+    SELECT
+        RecordID,
+        ROW_NUMBER() OVER (PARTITION BY CourseCode, SectionNumber ORDER BY EnrollmentDate, RecordID) AS Position
+    FROM RegistrationList
+    WHERE Status = 'waitlisted'
+) AS Ranked
+WHERE RegistrationList.RecordID = Ranked.RecordID;
+
+UPDATE Section
+SET CurrentEnrollment = (
+        SELECT COUNT(*) FROM RegistrationList r
+        WHERE r.CourseCode = Section.CourseCode AND r.SectionNumber = Section.SectionNumber AND r.Status = 'enrolled'
+    ),
+    Waitlist = (
+        SELECT COUNT(*) FROM RegistrationList r
+        WHERE r.CourseCode = Section.CourseCode AND r.SectionNumber = Section.SectionNumber AND r.Status = 'waitlisted'
+    );
+
+-- a student's own positions (waitlist_position)
+CREATE INDEX IF NOT EXISTS RegistrationStudentWaitlistIdx
+ON RegistrationList (StudentID, CourseCode, SectionNumber, WaitlistPosition) WHERE Status = 'waitlisted';
+
+-- a section's waitlist in order (view_waitlist, promotion, shifting positions after a drop)
+CREATE INDEX IF NOT EXISTS RegistrationSectionWaitlistIdx
+ON RegistrationList (CourseCode, SectionNumber, WaitlistPosition) WHERE Status = 'waitlisted';
+
+COMMIT;
+
+ANALYZE;
@@ -1,53 +1,89 @@
-import sqlite3
-import contextlib
+import csv
+import json
+import os
+from typing import List, Optional
 
 
-from fastapi import FastAPI, HTTPException, status, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request, status, Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response
+from loguru import logger
+from pydantic import ValidationError
 
 from .database_query import *
+from .db_pool import ConnectionPool
+from .metrics import METRICS_CONTENT_TYPE, MetricsRoute, render_metrics
 from .models import *
+from .replica_router import ReplicaRouter
 from .utils import *
 
 app = FastAPI()
+app.router.route_class = MetricsRoute
+
+credential_cache = CredentialCache()
+
+@app.on_event("startup")
+async def startup():
+    # fork the hashing workers up front so the first logins don't pay for it
+    await warm_hash_executor()
+
+@app.on_event("shutdown")
+async def shutdown():
+    shutdown_hash_executor()
+    primary_pool.close()
+    for pool in secondary_pools:
+        pool.close()
 
-current_index = 0
- 
 USERS_PRIMARY_DB_URL = "./api/var/primary/fuse/users.db"
 USERS_SECONDARY_DB_URLS = ["./api/var/secondary-1/fuse/users.db", "./api/var/secondary-2/fuse/users.db"]
+USERS_DB_POOL_SIZE = int(os.environ.get("USERS_DB_POOL_SIZE", 4))
+USERS_REPLICA_MAX_LAG = int(os.environ.get("USERS_REPLICA_MAX_LAG", 10))
+USERS_BULK_BATCH_SIZE = int(os.environ.get("USERS_BULK_BATCH_SIZE", 5000))
+
+def warm_users_statements(connection):
+    warm_statement_cache(connection, USERS_STATEMENTS)
+
+primary_pool = ConnectionPool(USERS_PRIMARY_DB_URL, size=USERS_DB_POOL_SIZE, setup=warm_users_statements)
+secondary_pools = [ConnectionPool(f"file:{url}?mode=ro", size=USERS_DB_POOL_SIZE, uri=True, setup=warm_users_statements)
+                   for url in USERS_SECONDARY_DB_URLS]
+replica_router = ReplicaRouter(primary_pool, USERS_PRIMARY_DB_URL, list(zip(secondary_pools, USERS_SECONDARY_DB_URLS)),
+                               max_lag=USERS_REPLICA_MAX_LAG)
 
 def get_primary_db():
-    with contextlib.closing(sqlite3.connect(USERS_PRIMARY_DB_URL, check_same_thread = False)) as db:
-        db.row_factory = sqlite3.Row
-        db.isolation_level = None
+    with primary_pool.connection() as db:
         yield db
 
-def get_secondary_db():
-    global current_index
-    with contextlib.closing(sqlite3.connect(USERS_SECONDARY_DB_URLS[current_index], check_same_thread = False)) as db:
-        db.row_factory = sqlite3.Row
-        db.isolation_level = None
-        yield db
-    current_index = (current_index + 1) % len(USERS_SECONDARY_DB_URLS)
-    
+
+@app.get(path='/metrics', operation_id='metrics', include_in_schema=False)
+async def metrics():
+    """Prometheus metrics of this instance, including the password hash queue depth."""
+    gauges = {'password_hash_queue_depth': ('Password hashes queued or running in the hash workers.', hash_queue_depth())}
+    return Response(content=render_metrics(STATEMENT_STATS, FUNCTION_STATS, gauges), media_type=METRICS_CONTENT_TYPE)
+
 
 ##########   USERS ENDPOINTS        ######################
 @app.post(path='/users/create', operation_id='create_user', response_model = CreateUserResponse)
 async def create_user(user_info: CreateUserRequest, users_connection = Depends(get_primary_db)):
-    # check if username is available
-    if username_exists(users_connection, user_info.username):
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'username="{user_info.username}" already exist!')
-
     # check if valid role
     if not user_info.role in ['instructor', 'registrar', 'student']:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"role={user_info.role} is not valid!")
 
     # hash the password before adding it to database
-    hashed_password = hash_password(user_info.password)
+    try:
+        hashed_password = await hash_password_async(user_info.password)
+    except PasswordHashQueueFull:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="server is busy, try again later", headers={"Retry-After": "1"})
     user_info.password = hashed_password
 
-    # create entry in users table
-    response = add_user(users_connection, user_info)
+    # create entry in users table, a taken username is reported by the insert itself
+    try:
+        response = add_user(users_connection, user_info)
+    except DuplicateRecordException as err:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=err.error_detail)
+    except DBException as err:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=err.error_detail)
+    credential_cache.invalidate(user_info.username)
+    replica_router.track_write(user_info.username)
 
     if response == QueryStatus.SUCCESS:
         return CreateUserResponse(message="user added successfully")
@@ -56,19 +92,123 @@ async def create_user(user_info: CreateUserRequest, users_connection = Depends(g
 
 
 @app.get(path="/users/authenticate", operation_id="authenticate_user")
-async def authenticate_user(username: str, password: str, users_connection = Depends(get_secondary_db)):
-    # check if username exists
-    if not username_exists(users_connection, username):
+async def authenticate_user(username: str, password: str):
+    # check if username exists; reads for a username written recently stick to replicas that already have the write
+    user = replica_router.read(get_user_credentials, username, key=username)
+    if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"username or password is invalid!")
-    
+
     # check if password is correct
-    user = get_user(users_connection, username)
-    password_hash = user[5] # based on users schema
-    if not verify_password(password, password_hash):
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"username or password is invalid!")
-    
-    userid = user[0]
-    role = user[6]
+    userid, password_hash, role = user
+
+    # a repeat login with the same password and stored hash skips PBKDF2
+    if credential_cache.get(username, password, password_hash) is None:
+        try:
+            password_valid = await verify_password_async(password, password_hash)
+        except PasswordHashQueueFull:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="server is busy, try again later", headers={"Retry-After": "1"})
+        if not password_valid:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"username or password is invalid!")
+        credential_cache.put(username, password, password_hash, (userid, role))
+
     jwt_claims = generate_claims(username, userid, role)
     return JSONResponse(status_code=status.HTTP_200_OK, content=jwt_claims)
 
+
+
+async def _read_lines(request: Request):
+    # raw bytes, each line is decoded by the caller so a bad one only fails its own row
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if buffer:
+        yield buffer.rstrip(b"\r")
+
+
+def _parse_bulk_row(line: str, csv_header: Optional[List[str]]) -> CreateUserRequest:
+    if csv_header is None:
+        return CreateUserRequest(**json.loads(line))
+    # strict, so the first half of a quoted field split over two lines fails instead of loading
+    values = next(csv.reader([line], strict=True))
+    return CreateUserRequest(**{column: value for column, value in zip(csv_header, values) if value != ""})
+
+
+async def _create_users_batch(users_connection, batch, errors):
+    """Hash and insert one batch of (line, CreateUserRequest), appending failures to errors.
+
+    A batch that fails as a whole is reported row by row and the upload
+    goes on with the next batch, since earlier batches are already committed.
+    """
+    try:
+        hashed_passwords = await hash_passwords_async([user_info.password for _, user_info in batch])
+        for (_, user_info), hashed_password in zip(batch, hashed_passwords):
+            user_info.password = hashed_password
+        results = await run_in_threadpool(add_users_batch, users_connection, [user_info for _, user_info in batch])
+    except DBException as err:
+        results = [err.error_detail] * len(batch)
+    except Exception as err:
+        logger.error(f'bulk create batch failed: {err}')
+        results = ["batch failed, not created"] * len(batch)
+
+    created = []
+    for (line_number, user_info), error_detail in zip(batch, results):
+        if error_detail is None:
+            created.append(user_info.username)
+        else:
+            errors.append(BulkCreateUserError(line=line_number, username=user_info.username, detail=error_detail))
+    for username in created:
+        credential_cache.invalidate(username)
+    replica_router.track_writes(created)
+    return len(created)
+
+
+@app.post(path='/users/bulk_create', operation_id='bulk_create_users', response_model = BulkCreateUserResponse)
+async def bulk_create_users(request: Request, users_connection = Depends(get_primary_db)):
+    """Create many users from a streamed NDJSON or CSV body.
+
+    Each NDJSON line, or each CSV row after a header row, holds the fields
+    of a CreateUserRequest. Rows are hashed in parallel and inserted in
+    transactions of USERS_BULK_BATCH_SIZE rows; rows that are not UTF-8,
+    fail validation or hit a UNIQUE conflict are reported by line number
+    and skipped.
+
+    The body is split into rows on line breaks before it is parsed, so a
+    quoted CSV field cannot contain a line break. Such a row is reported
+    as failed.
+    """
+    is_csv = "csv" in request.headers.get("content-type", "")
+    csv_header = None
+    created = 0
+    errors = []
+    batch = []
+    line_number = 0
+
+    async for raw_line in _read_lines(request):
+        line_number += 1
+        if not raw_line.strip():
+            continue
+        try:
+            line = raw_line.decode("utf-8")
+            if is_csv and csv_header is None:
+                csv_header = [column.strip() for column in next(csv.reader([line], strict=True))]
+                continue
+            user_info = _parse_bulk_row(line, csv_header)
+        except (ValueError, TypeError, ValidationError, csv.Error) as err:
+            errors.append(BulkCreateUserError(line=line_number, detail=str(err)))
+            continue
+        if not user_info.role in ['instructor', 'registrar', 'student']:
+            errors.append(BulkCreateUserError(line=line_number, username=user_info.username, detail=f"role={user_info.role} is not valid!"))
+            continue
+        batch.append((line_number, user_info))
+        if len(batch) >= USERS_BULK_BATCH_SIZE:
+            created += await _create_users_batch(users_connection, batch, errors)
+            batch = []
+
+    if batch:
+        created += await _create_users_batch(users_connection, batch, errors)
+
+    errors.sort(key=lambda error: error.line)
+    return BulkCreateUserResponse(created=created, failed=len(errors), errors=errors)
@@ -1,14 +1,48 @@
+import asyncio
 import base64
 import os
 import hashlib
+import hmac
 import secrets
+import time
+from collections import OrderedDict
 import datetime
 import json
+from concurrent.futures import ProcessPoolExecutor
 from jwcrypto import jwk
 import sys
 
+from .metrics import increment
+
+try:
+    import orjson
+except ImportError:  # optional, the json fallback writes the same bytes, only slower
+    orjson = None
+
 ALGORITHM = "pbkdf2_sha256"
 
+# PBKDF2 is CPU bound, so it runs in worker processes instead of on the event loop
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 64))
+# bulk uploads hash in their own processes, a small job at a time, so logins never queue behind them
+PASSWORD_HASH_BULK_WORKERS = int(os.environ.get("PASSWORD_HASH_BULK_WORKERS", max(1, PASSWORD_HASH_WORKERS // 2)))
+PASSWORD_HASH_BULK_CHUNK = int(os.environ.get("PASSWORD_HASH_BULK_CHUNK", 32))
+
+_hash_executor = None
+_bulk_hash_executor = None
+_hash_pending = 0
+
+CREDENTIAL_CACHE_SIZE = int(os.environ.get("CREDENTIAL_CACHE_SIZE", 10000))
+CREDENTIAL_CACHE_TTL = float(os.environ.get("CREDENTIAL_CACHE_TTL", 300))
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+ROLE_CACHE_SIZE = int(os.environ.get("ROLE_CACHE_SIZE", 10000))
+ROLE_CACHE_TTL = float(os.environ.get("ROLE_CACHE_TTL", 60))
+
+
+class PasswordHashQueueFull(Exception):
+    """Raised when more than PASSWORD_HASH_MAX_PENDING hashes are already queued."""
+
 
 def hash_password(password, salt=None, iterations=260000):
     if salt is None:
@@ -32,6 +66,241 @@ def verify_password(password, password_hash):
     return secrets.compare_digest(password_hash, compare_hash)
 
 
+def get_hash_executor():
+    global _hash_executor
+    if _hash_executor is None:
+        _hash_executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+    return _hash_executor
+
+
+def _warm_up():
+    return None
+
+
+async def warm_hash_executor():
+    """Start every hash worker now instead of on the first hashes.
+
+    ProcessPoolExecutor only forks a worker when a job is submitted and no
+    idle one is left, so one job per worker, submitted together, forks them all.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_hash_executor()
+    await asyncio.gather(*(loop.run_in_executor(executor, _warm_up) for _ in range(PASSWORD_HASH_WORKERS)))
+
+
+def get_bulk_hash_executor():
+    global _bulk_hash_executor
+    if _bulk_hash_executor is None:
+        _bulk_hash_executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_BULK_WORKERS)
+    return _bulk_hash_executor
+
+
+def shutdown_hash_executor():
+    global _hash_executor, _bulk_hash_executor
+    for executor in (_hash_executor, _bulk_hash_executor):
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    _hash_executor = None
+    _bulk_hash_executor = None
+
+
+def hash_queue_depth():
+    return _hash_pending
+
+
+async def _run_in_hash_pool(func, *args):
+    # only touched from the event loop thread, so a plain counter is enough
+    global _hash_pending
+    if _hash_pending >= PASSWORD_HASH_MAX_PENDING:
+        increment('password_hash_rejected_total')
+        raise PasswordHashQueueFull()
+    _hash_pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_hash_executor(), func, *args)
+    finally:
+        _hash_pending -= 1
+
+
+async def hash_password_async(password, salt=None, iterations=260000):
+    return await _run_in_hash_pool(hash_password, password, salt, iterations)
+
+
+async def verify_password_async(password, password_hash):
+    return await _run_in_hash_pool(verify_password, password, password_hash)
+
+
+def _hash_passwords(passwords):
+    return [hash_password(password) for password in passwords]
+
+
+async def hash_passwords_async(passwords):
+    """Hash a batch of passwords on the bulk workers, PASSWORD_HASH_BULK_CHUNK passwords per job.
+
+    Runs outside the interactive pool and its PASSWORD_HASH_MAX_PENDING
+    limit, so a large upload neither delays nor rejects single hashes.
+    """
+    passwords = list(passwords)
+    chunks = [passwords[i:i + PASSWORD_HASH_BULK_CHUNK] for i in range(0, len(passwords), PASSWORD_HASH_BULK_CHUNK)]
+    loop = asyncio.get_running_loop()
+    executor = get_bulk_hash_executor()
+    results = await asyncio.gather(*[loop.run_in_executor(executor, _hash_passwords, chunk) for chunk in chunks])
+    return [password_hash for chunk in results for password_hash in chunk]
+
+
+class CredentialCache:
+    """Bounded LRU cache of recently verified logins.
+
+    Entries are stored per username under an HMAC of (username, password,
+    stored hash) with a key that never leaves the process, so plaintext
+    passwords are not kept in memory and a changed password hash in the
+    database can never match an old entry.
+    """
+
+    def __init__(self, max_size=CREDENTIAL_CACHE_SIZE, ttl=CREDENTIAL_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._key = secrets.token_bytes(32)
+        self._entries = OrderedDict()
+
+    def _digest(self, username, password, password_hash):
+        message = "\0".join((username, password, password_hash or "")).encode("utf-8")
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    def get(self, username, password, password_hash):
+        entry = self._entries.get(username)
+        if entry is None:
+            return None
+        digest, value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[username]
+            return None
+        if not secrets.compare_digest(digest, self._digest(username, password, password_hash)):
+            return None
+        self._entries.move_to_end(username)
+        return value
+
+    def put(self, username, password, password_hash, value):
+        if self.max_size <= 0:
+            return
+        digest = self._digest(username, password, password_hash)
+        self._entries[username] = (digest, value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        self._entries.pop(username, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class RoleCache:
+    """Bounded LRU cache of user roles by CWID, each entry kept for ``ttl`` seconds."""
+
+    def __init__(self, max_size=ROLE_CACHE_SIZE, ttl=ROLE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, cwid):
+        entry = self._entries.get(cwid)
+        if entry is None:
+            return None
+        role, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[cwid]
+            return None
+        self._entries.move_to_end(cwid)
+        return role
+
+    def put(self, cwid, role):
+        if self.max_size <= 0:
+            return
+        self._entries[cwid] = (role, time.monotonic() + self.ttl)
+        self._entries.move_to_end(cwid)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, cwid):
+        self._entries.pop(cwid, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+def json_bytes(content) -> bytes:
+    """Compact UTF-8 JSON for plain dicts, lists and scalars, the same bytes FastAPI's JSONResponse writes."""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class ResponseCache:
+    """Bounded LRU cache of serialized response bodies.
+
+    Every body is stored with the version of the data it was built from and
+    is only returned for that same version, so a version bump written by any
+    process turns it into a miss. Entries can also carry tags (course codes,
+    say) so a process can drop them as soon as it changes that data itself.
+    """
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        cached_version, body, _ = entry
+        if cached_version != version:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return body
+
+    def put(self, key, version, body, tags=()):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (version, body, frozenset(tags))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def invalidate_tag(self, tag):
+        for key in [key for key, (_, _, tags) in self._entries.items() if tag in tags]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+
+def make_etag(*parts):
+    """Strong ETag for a response identified by ``parts`` (resource key and version)."""
+    digest = hashlib.blake2b("\0".join(str(part) for part in parts).encode("utf-8"), digest_size=12)
+    return f'"{digest.hexdigest()}"'
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value matches ``etag`` (weak comparison, per RFC 9110)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
 def expiration_in(minutes):
     creation = datetime.datetime.now(tz=datetime.timezone.utc)
     expiration = creation + datetime.timedelta(minutes=minutes)
@@ -0,0 +1,147 @@
+"""Benchmark: 304 hit rate, bytes and SQL work for clients polling the enrollments read endpoints.
+
+Simulates pollers looping over /classes, /view_waitlist and /waitlist_position
+while a small fraction of requests are enrollments that change the data.
+Each poller keeps the ETag of its last response and sends it back as
+If-None-Match. The same request sequence is replayed without
+If-None-Match for comparison.
+
+Runs the enrollments app in process (plain ASGI calls, no server) against a
+throwaway copy of the database built from api/share.
+
+Usage (from the repository root):
+    python -m benchmarks.conditional_polling [--requests N] [--write-ratio R] [--seed N]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import glob
+import importlib
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+from loguru import logger
+
+ENROLLMENTS_SCRIPTS = ["./api/share/enrollments.sql"] + sorted(glob.glob("./api/share/migrations/*.sql"))
+
+
+def build_database(path):
+    connection = sqlite3.connect(path)
+    for script in ENROLLMENTS_SCRIPTS:
+        with open(script) as sql:
+            connection.executescript(sql.read())
+    departments = [row[0] for row in connection.execute("SELECT DISTINCT Department FROM Class")]
+    sections = connection.execute("SELECT CourseCode, SectionNumber FROM Section").fetchall()
+    students = [row[0] for row in connection.execute("SELECT CWID FROM Users WHERE Role = 'student'")]
+    connection.close()
+    return departments, sections, students
+
+
+async def call(app, method, path, query=None, headers=None, body=None):
+    """Run one request through the ASGI app and return (status, headers, body)."""
+    payload = json.dumps(body).encode() if body is not None else b""
+    raw_headers = [(b"content-type", b"application/json")]
+    raw_headers += [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+             "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+             "query_string": urlencode(query or {}).encode(), "headers": raw_headers,
+             "client": ("127.0.0.1", 0), "server": ("127.0.0.1", 80)}
+    response = {"status": None, "headers": {}, "body": b""}
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            return {"type": "http.disconnect"}
+        received = True
+        return {"type": "http.request", "body": payload, "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {name.decode(): value.decode() for name, value in message["headers"]}
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    await app(scope, receive, send)
+    return response["status"], response["headers"], response["body"]
+
+
+def workload(departments, sections, students, requests, write_ratio, seed):
+    rng = random.Random(seed)
+    pollers = ([("/classes", {"department_name": department}) for department in departments]
+               + [("/view_waitlist", {"course_code": course, "section_number": section}) for course, section in sections]
+               + [("/waitlist_position", {"student_id": student}) for student in students])
+    for _ in range(requests):
+        if rng.random() < write_ratio:
+            course, section = rng.choice(sections)
+            yield "POST", "/enrollment", {"student_id": rng.choice(students), "course_code": course,
+                                          "section_number": section}
+        else:
+            path, query = rng.choice(pollers)
+            yield "GET", path, query
+
+
+async def run(app, statement_stats, operations, conditional):
+    etags = {}
+    polls = not_modified = body_bytes = 0
+    statements_before = sum(count for count, _ in statement_stats.values())
+    start = time.perf_counter()
+    for method, path, params in operations:
+        if method == "POST":
+            await call(app, method, path, body=params)
+            continue
+        key = (path, tuple(sorted(params.items())))
+        headers = {"If-None-Match": etags[key]} if conditional and key in etags else {}
+        status, response_headers, body = await call(app, method, path, query=params, headers=headers)
+        polls += 1
+        body_bytes += len(body)
+        if status == 304:
+            not_modified += 1
+        if "etag" in response_headers:
+            etags[key] = response_headers["etag"]
+    elapsed = time.perf_counter() - start
+    statements = sum(count for count, _ in statement_stats.values()) - statements_before
+    return polls, not_modified, body_bytes, statements, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--write-ratio", type=float, default=0.01, help="fraction of requests that enroll a student")
+    parser.add_argument("--seed", type=int, default=449)
+    args = parser.parse_args()
+
+    logger.remove()
+    with tempfile.TemporaryDirectory() as directory:
+        for label, conditional in (("plain", False), ("etag", True)):
+            path = os.path.join(directory, f"{label}.db")
+            departments, sections, students = build_database(path)
+            os.environ["ENROLLMENTS_DATABASE"] = path
+            # a fresh app, caches and statement counters per run
+            for module in ("api.enrollments", "api.database_query"):
+                sys.modules.pop(module, None)
+            enrollments = importlib.import_module("api.enrollments")
+            database_query = importlib.import_module("api.database_query")
+            logger.remove()
+
+            operations = workload(departments, sections, students, args.requests, args.write_ratio, args.seed)
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                polls, not_modified, body_bytes, statements, elapsed = asyncio.run(
+                    run(enrollments.app, database_query.STATEMENT_STATS, operations, conditional))
+            enrollments.db.close()
+
+            print(f"{label:<6} {polls} polls, {not_modified / polls:6.1%} answered 304, "
+                  f"{body_bytes / polls:7.1f} body bytes/poll, {statements / args.requests:4.2f} statements/request, "
+                  f"{elapsed / args.requests * 1e6:6.0f} us/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Stress check: parallel enrollments into one section never oversell seats or waitlist spots.
+
+Builds a throwaway WAL database from api/share (schema, seed data and every
+migration), adds a section with --seats seats and --students students, then
+has --threads threads, each with its own connection, try to enroll every
+student at once. Afterwards the section counters must match the
+registration rows and stay within MaxEnrollment and the waitlist limit.
+
+--legacy runs the old check-then-insert sequence instead, to show the
+oversell the single transaction prevents.
+
+Usage (from the repository root):
+    python -m benchmarks.enrollment_contention [--students N] [--seats N] [--threads N] [--legacy]
+"""
+
+import argparse
+import glob
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from api.database_query import WAITLIST_ALLOWED, DBException, enroll_student
+from api.models import EnrollmentRequest
+
+ENROLLMENTS_SCRIPTS = ["./api/share/enrollments.sql"] + sorted(glob.glob("./api/share/migrations/*.sql"))
+COURSE_CODE = "STRESS101"
+SECTION_NUMBER = 1
+
+
+def build_database(path, students, seats):
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    for script in ENROLLMENTS_SCRIPTS:
+        with open(script) as sql:
+            connection.executescript(sql.read())
+    instructor_id = connection.execute(
+        "INSERT INTO Users (Name, LastName, Role) VALUES ('Stress', 'Instructor', 'instructor') RETURNING CWID"
+    ).fetchone()[0]
+    first_student = connection.execute("SELECT COALESCE(MAX(CWID), 0) + 1 FROM Users").fetchone()[0]
+    connection.executemany(
+        "INSERT INTO Users (CWID, Name, LastName, Role) VALUES (?, 'Stress', 'Student', 'student')",
+        [(first_student + i,) for i in range(students)],
+    )
+    connection.execute("INSERT INTO Class (CourseCode, Name, Department) VALUES (?, 'Stress Test', 'Testing')",
+                       (COURSE_CODE,))
+    connection.execute(
+        "INSERT INTO Section (SectionNumber, CourseCode, InstructorID, MaxEnrollment, CurrentEnrollment, Waitlist, "
+        "SectionStatus) VALUES (?, ?, ?, ?, 0, 0, 'open')",
+        (SECTION_NUMBER, COURSE_CODE, instructor_id, seats),
+    )
+    connection.commit()
+    connection.close()
+    return list(range(first_student, first_student + students))
+
+
+def legacy_enroll(connection, enrollment_request):
+    """The old enrollment path: read the counters, decide, then write in a separate transaction."""
+    section = (enrollment_request.course_code, enrollment_request.section_number)
+    current_enrollment, max_enrollment, waitlist, section_status = connection.execute(
+        "SELECT CurrentEnrollment, MaxEnrollment, Waitlist, SectionStatus FROM Section "
+        "WHERE CourseCode = ? AND SectionNumber = ?", section).fetchone()
+    if max_enrollment - current_enrollment >= 1:
+        registration_status = "enrolled"
+    elif waitlist <= WAITLIST_ALLOWED:
+        registration_status = "waitlisted"
+    else:
+        return
+    if section_status != "open":
+        return
+    connection.execute("BEGIN")
+    try:
+        waitlist_position = None
+        if registration_status == "enrolled":
+            connection.execute("UPDATE Section SET CurrentEnrollment = CurrentEnrollment + 1 "
+                               "WHERE CourseCode = ? AND SectionNumber = ?", section)
+        else:
+            waitlist_position = connection.execute("UPDATE Section SET Waitlist = Waitlist + 1 "
+                                                   "WHERE CourseCode = ? AND SectionNumber = ? RETURNING Waitlist",
+                                                   section).fetchone()[0]
+        connection.execute("INSERT INTO RegistrationList (StudentID, CourseCode, SectionNumber, Status, "
+                           "WaitlistPosition) VALUES (?, ?, ?, ?, ?)",
+                           (enrollment_request.student_id, *section, registration_status, waitlist_position))
+        connection.execute("COMMIT")
+    except sqlite3.Error:
+        connection.execute("ROLLBACK")
+        raise DBException(error_detail='Fail to register')
+
+
+def run(path, student_ids, threads, enroll):
+    local = threading.local()
+    start_barrier = threading.Barrier(threads)
+    failures = []
+
+    def connection():
+        if not hasattr(local, "connection"):
+            local.connection = sqlite3.connect(path, check_same_thread=False)
+            local.connection.isolation_level = None
+            local.connection.execute("PRAGMA busy_timeout=30000")
+            start_barrier.wait()
+        return local.connection
+
+    def attempt(student_id):
+        request = EnrollmentRequest(student_id=student_id, course_code=COURSE_CODE, section_number=SECTION_NUMBER)
+        try:
+            enroll(connection(), request)
+        except DBException as err:
+            failures.append(err.error_detail)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(attempt, student_ids))
+    return time.perf_counter() - start, failures
+
+
+def verify(path, seats):
+    connection = sqlite3.connect(path)
+    current, maximum, waitlist = connection.execute(
+        "SELECT CurrentEnrollment, MaxEnrollment, Waitlist FROM Section WHERE CourseCode = ? AND SectionNumber = ?",
+        (COURSE_CODE, SECTION_NUMBER),
+    ).fetchone()
+    counts = dict(connection.execute(
+        "SELECT Status, COUNT(*) FROM RegistrationList WHERE CourseCode = ? AND SectionNumber = ? GROUP BY Status",
+        (COURSE_CODE, SECTION_NUMBER),
+    ).fetchall())
+    connection.close()
+
+    enrolled, waitlisted = counts.get("enrolled", 0), counts.get("waitlisted", 0)
+    print(f"section counters: CurrentEnrollment={current}/{maximum} Waitlist={waitlist}")
+    print(f"registration rows: enrolled={enrolled} waitlisted={waitlisted}")
+    problems = []
+    if current > maximum or enrolled > seats:
+        problems.append("more students enrolled than seats")
+    if waitlisted > WAITLIST_ALLOWED + 1:
+        problems.append("more students waitlisted than the waitlist allows")
+    if current != enrolled or waitlist != waitlisted:
+        problems.append("section counters do not match registration rows")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=3000)
+    parser.add_argument("--seats", type=int, default=30)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--legacy", action="store_true", help="use the old check-then-insert enrollment path")
+    args = parser.parse_args()
+
+    logger.remove()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "enrollments.db")
+        student_ids = build_database(path, args.students, args.seats)
+        elapsed, failures = run(path, student_ids, args.threads, legacy_enroll if args.legacy else enroll_student)
+        print(f"{len(student_ids)} enrollment attempts on {args.threads} threads in {elapsed:.2f}s "
+              f"({len(student_ids) / elapsed:.0f}/s), {len(failures)} failed with a database error")
+        problems = verify(path, args.seats)
+
+    for problem in problems:
+        print(f"FAIL {problem}")
+    if not problems:
+        print("ok   capacity never exceeded")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
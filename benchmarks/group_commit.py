@@ -0,0 +1,156 @@
+"""Benchmark: write throughput of the enrollments writer against the group commit window.
+
+Builds a throwaway WAL database from api/share (schema, seed data and every
+migration) with --sections sections and --students students, then for every
+--windows value (milliseconds, 0 is one transaction per write) and every
+--synchronous mode, has --clients concurrent clients enroll students through
+DatabaseManager.write until --writes enrollments have been sent. Every
+--reject-every'th write comes from an instructor and must fail on its own.
+
+Reports writes and commits per second, the mean batch size and p50/p99
+write latency. Exits non-zero if any caller got the wrong result or the
+section counters stop matching the registration rows.
+
+Usage (from the repository root):
+    python -m benchmarks.group_commit [--windows 0 1 2 5 10] [--synchronous FULL NORMAL] [--writes N] [--clients N]
+"""
+
+import argparse
+import asyncio
+import glob
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from loguru import logger
+
+from api.database_query import NotAuthorizedException, enroll_student
+from api.db_pool import DatabaseManager
+from api.metrics import COUNTERS
+from api.models import EnrollmentRequest
+
+ENROLLMENTS_SCRIPTS = ["./api/share/enrollments.sql"] + sorted(glob.glob("./api/share/migrations/*.sql"))
+COURSE_CODE = "BATCH101"
+
+
+def build_database(path, sections, students):
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    for script in ENROLLMENTS_SCRIPTS:
+        with open(script) as sql:
+            connection.executescript(sql.read())
+    instructor_id = connection.execute(
+        "INSERT INTO Users (Name, LastName, Role) VALUES ('Batch', 'Instructor', 'instructor') RETURNING CWID"
+    ).fetchone()[0]
+    first_student = connection.execute("SELECT COALESCE(MAX(CWID), 0) + 1 FROM Users").fetchone()[0]
+    connection.executemany("INSERT INTO Users (CWID, Name, LastName, Role) VALUES (?, 'Batch', 'Student', 'student')",
+                           [(first_student + i,) for i in range(students)])
+    connection.execute("INSERT INTO Class (CourseCode, Name, Department) VALUES (?, 'Group Commit', 'Testing')",
+                       (COURSE_CODE,))
+    connection.executemany(
+        "INSERT INTO Section (SectionNumber, CourseCode, InstructorID, MaxEnrollment, CurrentEnrollment, Waitlist, "
+        "SectionStatus) VALUES (?, ?, ?, 40, 0, 0, 'open')",
+        [(number, COURSE_CODE, instructor_id) for number in range(1, sections + 1)])
+    connection.commit()
+    connection.close()
+    return instructor_id, list(range(first_student, first_student + students))
+
+
+def section_problems(path):
+    connection = sqlite3.connect(path)
+    problems = connection.execute(
+        """
+        SELECT COUNT(*) FROM Section s
+        WHERE s.CourseCode = ? AND (
+            s.CurrentEnrollment != (SELECT COUNT(*) FROM RegistrationList r WHERE r.CourseCode = s.CourseCode
+                                    AND r.SectionNumber = s.SectionNumber AND r.Status = 'enrolled')
+            OR s.Waitlist != (SELECT COUNT(*) FROM RegistrationList r WHERE r.CourseCode = s.CourseCode
+                              AND r.SectionNumber = s.SectionNumber AND r.Status = 'waitlisted')
+            OR s.CurrentEnrollment > s.MaxEnrollment)
+        """, (COURSE_CODE,)).fetchone()[0]
+    connection.close()
+    return problems
+
+
+def counter(name):
+    return COUNTERS.get((name, ()), 0)
+
+
+async def run(db, requests, clients):
+    latencies = []
+    failures = []
+    pending = iter(requests)
+
+    async def client():
+        for expect_rejection, request in pending:
+            start = time.perf_counter()
+            try:
+                response = await db.write(enroll_student, request)
+                if expect_rejection or response.enrollment_status not in ("enrolled", "waitlisted", "not eligible"):
+                    failures.append(f"student {request.student_id}: unexpected {response.enrollment_status}")
+            except NotAuthorizedException:
+                if not expect_rejection:
+                    failures.append(f"student {request.student_id}: rejected")
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(client() for _ in range(clients)))
+    return latencies, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 1, 2, 5, 10])
+    parser.add_argument("--synchronous", nargs="+", default=["FULL", "NORMAL"])
+    parser.add_argument("--writes", type=int, default=4000)
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--sections", type=int, default=200)
+    parser.add_argument("--reject-every", type=int, default=20)
+    args = parser.parse_args()
+
+    logger.remove()
+    failed = False
+    print(f"{'synchronous':<11} {'window ms':>9} {'writes/s':>9} {'commits/s':>10} {'batch':>6} "
+          f"{'p50 ms':>8} {'p99 ms':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        for synchronous in args.synchronous:
+            for window in args.windows:
+                path = os.path.join(directory, f"{synchronous}-{window}.db")
+                instructor_id, students = build_database(path, args.sections, args.writes)
+                requests = []
+                for index, student_id in enumerate(students):
+                    expect_rejection = args.reject_every > 0 and index % args.reject_every == 0
+                    requests.append((expect_rejection, EnrollmentRequest(
+                        student_id=instructor_id if expect_rejection else student_id,
+                        course_code=COURSE_CODE, section_number=index % args.sections + 1)))
+
+                db = DatabaseManager(path, synchronous=synchronous, write_batch_window=window / 1000,
+                                     write_batch_size=args.batch_size)
+                batches, jobs = counter("write_batches_total"), counter("write_batch_jobs_total")
+                start = time.perf_counter()
+                latencies, failures = asyncio.run(run(db, requests, args.clients))
+                elapsed = time.perf_counter() - start
+                db.close()
+
+                # without a window every write is its own transaction
+                commits = counter("write_batches_total") - batches if window > 0 else len(requests)
+                batched = counter("write_batch_jobs_total") - jobs if window > 0 else len(requests)
+                latencies.sort()
+                print(f"{synchronous:<11} {window:>9g} {len(requests) / elapsed:9.0f} {commits / elapsed:10.0f} "
+                      f"{batched / max(commits, 1):6.1f} {statistics.median(latencies) * 1000:8.2f} "
+                      f"{latencies[int(len(latencies) * 0.99)] * 1000:8.2f}")
+
+                problems = section_problems(path)
+                for failure in failures[:5]:
+                    print(f"  {failure}")
+                if failures or problems:
+                    print(f"  {len(failures)} wrong results, {problems} sections with mismatched counters")
+                    failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
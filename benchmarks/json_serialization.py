@@ -0,0 +1,171 @@
+"""Benchmark: latency and allocations of the JSON read path, per-row Pydantic models versus plain dicts.
+
+For /classes, /view_waitlist and /waitlist_position at --sizes rows each,
+times the query plus serialization of the response body two ways:
+
+    models  the previous path, one Pydantic model per row, the response
+            model around them, jsonable_encoder and json.dumps
+    fast    the current path, dicts built straight from the rows and
+            encoded by utils.json_bytes (orjson when installed)
+
+Both paths must produce the same bytes. Latency is reported as p50 and p99
+over --requests requests; allocations as the peak traced memory of one
+request, measured in a separate tracemalloc pass.
+
+Usage (from the repository root):
+    python -m benchmarks.json_serialization [--sizes 10 100 1000] [--requests N]
+"""
+
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from fastapi.encoders import jsonable_encoder
+from loguru import logger
+
+from api.database_query import fetch_all, get_available_classes, get_waitlist, get_waitlist_status
+from api.models import (AvailableClass, AvailableClassResponse, ViewWaitlistRes, WaitlistPositionList,
+                        WaitlistPositionRes, WaitlistStudents)
+from api.utils import json_bytes, orjson
+
+ENROLLMENTS_SCRIPTS = ["./api/share/enrollments.sql"] + sorted(glob.glob("./api/share/migrations/*.sql"))
+DEPARTMENT = "Benchmarking"
+WAITLIST_COURSE = "BENCH-0"
+
+
+def build_database(path, size):
+    connection = sqlite3.connect(path)
+    for script in ENROLLMENTS_SCRIPTS:
+        with open(script) as sql:
+            connection.executescript(sql.read())
+    instructor_id = connection.execute(
+        "INSERT INTO Users (Name, LastName, Role) VALUES ('Bench', 'Instructor', 'instructor') RETURNING CWID"
+    ).fetchone()[0]
+    student_id = connection.execute(
+        "INSERT INTO Users (Name, LastName, Role) VALUES ('Bench', 'Student', 'student') RETURNING CWID"
+    ).fetchone()[0]
+    first_student = student_id + 1
+    connection.executemany("INSERT INTO Users (CWID, Name, LastName, Role) VALUES (?, ?, 'Student', 'student')",
+                           [(first_student + i, f"Student {i}") for i in range(size)])
+    courses = [f"BENCH-{i}" for i in range(size)]
+    connection.executemany("INSERT INTO Class (CourseCode, Name, Department) VALUES (?, ?, ?)",
+                           [(course, f"Benchmark {course}", DEPARTMENT) for course in courses])
+    connection.executemany(
+        "INSERT INTO Section (SectionNumber, CourseCode, InstructorID, MaxEnrollment, CurrentEnrollment, Waitlist, "
+        "SectionStatus) VALUES (1, ?, ?, 30, 30, ?, 'open')",
+        [(course, instructor_id, size if course == WAITLIST_COURSE else 1) for course in courses])
+    # a section with size waitlisted students, and one student waitlisted in size sections
+    connection.executemany(
+        "INSERT INTO RegistrationList (StudentID, CourseCode, SectionNumber, Status, WaitlistPosition) "
+        "VALUES (?, ?, 1, 'waitlisted', ?)",
+        [(first_student + i, WAITLIST_COURSE, i + 1) for i in range(size)]
+        + [(student_id, course, 2 if course == WAITLIST_COURSE else 1) for course in courses])
+    connection.commit()
+    connection.close()
+    return student_id
+
+
+def _model_bytes(model):
+    return json.dumps(jsonable_encoder(model), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def models_classes(connection, department_name):
+    rows = fetch_all(connection, 'models_classes', 'available_classes', {'department_name': department_name})
+    result = [AvailableClass(course_name=row[0], course_code=row[1], department=row[2], current_enrollment=row[3],
+                             waitlist=row[4], max_enrollment=row[5], section_number=row[6],
+                             instructor_first_name=row[7], instructor_last_name=row[8]) for row in rows]
+    return _model_bytes(AvailableClassResponse(available_classes=result))
+
+
+def models_waitlist(connection, course_code, section_number):
+    rows = fetch_all(connection, 'models_waitlist', 'section_waitlist', {'course_code': course_code, 'section_number': section_number})
+    result = [WaitlistStudents(student_id=row[0], student_name=row[1], enrollment_date=row[2]) for row in rows]
+    return _model_bytes(ViewWaitlistRes(waitlisted_students=result))
+
+
+def models_positions(connection, student_id):
+    rows = fetch_all(connection, 'models_positions', 'waitlist_positions', {'student_id': student_id})
+    result = [WaitlistPositionList(waitlist_position=row[0], section_number=row[2], course_code=row[1])
+              for row in rows]
+    return _model_bytes(WaitlistPositionRes(waitlist_positions=result))
+
+
+def fast_classes(connection, department_name):
+    return json_bytes({"available_classes": get_available_classes(connection, department_name)})
+
+
+def fast_waitlist(connection, course_code, section_number):
+    return json_bytes({"waitlisted_students": get_waitlist(connection, course_code, section_number)})
+
+
+def fast_positions(connection, student_id):
+    return json_bytes({"waitlist_positions": get_waitlist_status(connection, student_id)})
+
+
+def endpoints(student_id):
+    return [
+        ("/classes", models_classes, fast_classes, (DEPARTMENT,)),
+        ("/view_waitlist", models_waitlist, fast_waitlist, (WAITLIST_COURSE, 1)),
+        ("/waitlist_position", models_positions, fast_positions, (student_id,)),
+    ]
+
+
+def measure(connection, func, args, requests):
+    for _ in range(min(requests, 50)):
+        func(connection, *args)
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        func(connection, *args)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    p50 = statistics.median(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+    peaks = []
+    tracemalloc.start()
+    for _ in range(min(requests, 20)):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        func(connection, *args)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    return p50, p99, statistics.median(peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+
+    logger.remove()
+    print(f"encoder: {'orjson' if orjson is not None else 'json'}")
+    print(f"{'endpoint':<19} {'rows':>5} {'path':<7} {'p50 ms':>8} {'p99 ms':>8} {'peak KiB':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            path = os.path.join(directory, f"{size}.db")
+            student_id = build_database(path, size)
+            connection = sqlite3.connect(path)
+            connection.row_factory = sqlite3.Row
+            for endpoint, models, fast, params in endpoints(student_id):
+                if models(connection, *params) != fast(connection, *params):
+                    raise SystemExit(f"{endpoint}: the fast path body differs from the model path body")
+                results = {label: measure(connection, func, params, args.requests)
+                           for label, func in (("models", models), ("fast", fast))}
+                for label, (p50, p99, peak) in results.items():
+                    print(f"{endpoint:<19} {size:>5} {label:<7} {p50 * 1000:8.3f} {p99 * 1000:8.3f} {peak / 1024:9.1f}")
+                print(f"{'':<19} {'':>5} {'speedup':<7} {results['models'][0] / results['fast'][0]:7.1f}x "
+                      f"{results['models'][1] / results['fast'][1]:7.1f}x "
+                      f"{results['models'][2] / max(results['fast'][2], 1):8.1f}x")
+            connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+"""Open-loop load test through the KrakenD gateway: record, replay and registration-rush mixes.
+
+Subcommands:
+    record  reverse proxy in front of KrakenD. Forwards every request and
+            appends the ones for endpoints in api/etc/krakend.json to a
+            JSONL request log.
+    replay  sends a JSONL request log again, at the recorded pace scaled
+            by --speed, or as Poisson arrivals at --rate.
+    rush    synthetic registration rush: login, browse /classes, enroll,
+            drop and check the waitlist position, mixed by --mix, as
+            Poisson arrivals at --rate for --duration seconds.
+
+Runs are open loop. Every request gets a start time up front and its
+latency is measured from that time, so a gateway that falls behind shows
+up as latency instead of as a lower request rate. The report is one JSON
+object on stdout (or in --report): throughput, latency percentiles overall
+and per operation, status and error counts, and the sections whose seats,
+waitlist or counters went wrong during the run, read from the enrollments
+database.
+
+rush and replay --accounts take a JSONL file of login accounts, one
+{"username", "password", "cwid", "role"} object per line. Requests are
+signed with a token of an account whose role the endpoint's auth/validator
+allows, logging in on first use.
+
+Only the standard library is used.
+
+Usage (from the repository root, with the foreman formation running):
+    python -m benchmarks.load_test record --out traffic.jsonl [--listen 8081]
+    python -m benchmarks.load_test replay traffic.jsonl [--speed 2 | --rate 200] [--accounts accounts.jsonl]
+    python -m benchmarks.load_test rush --accounts accounts.jsonl [--rate 200] [--duration 60] [--mix enroll=0.5,...]
+"""
+
+import argparse
+import http.client
+import json
+import random
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode, urlsplit
+
+from api.database_query import WAITLIST_ALLOWED
+
+KRAKEND_CONFIG = "./api/etc/krakend.json"
+GATEWAY = "http://localhost:8080"
+ENROLLMENTS_DB = "./api/var/enrollments.db"
+
+RUSH_MIX = {"login": 0.05, "classes": 0.45, "enroll": 0.25, "drop": 0.10, "waitlist": 0.15}
+RECORDED_HEADERS = ("Authorization", "Content-Type", "If-None-Match", "X-Request-ID")
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade", "host",
+              "content-length"}
+
+
+def load_gateway_endpoints(path):
+    """(method, endpoint) -> roles allowed by the endpoint's auth/validator, [] for public endpoints."""
+    with open(path) as config_file:
+        config = json.load(config_file)
+    endpoints = {}
+    for endpoint in config["endpoints"]:
+        validator = endpoint.get("extra_config", {}).get("auth/validator", {})
+        endpoints[(endpoint.get("method", "GET").upper(), endpoint["endpoint"])] = validator.get("roles", [])
+    return endpoints
+
+
+def endpoint_of(path):
+    return urlsplit(path).path.rstrip("/") + "/"
+
+
+def load_jsonl(path):
+    with open(path) as jsonl:
+        return [json.loads(line) for line in jsonl if line.strip()]
+
+
+class Gateway:
+    """Keep-alive HTTP connections to the gateway, one per worker thread."""
+
+    def __init__(self, base_url, timeout=30.0):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, method, path, headers=None, body=None):
+        payload = body.encode() if isinstance(body, str) else body
+        for attempt in (1, 2):
+            connection = getattr(self._local, "connection", None)
+            if connection is None:
+                connection = self._local.connection = http.client.HTTPConnection(self.host, self.port,
+                                                                                  timeout=self.timeout)
+            try:
+                connection.request(method, path, body=payload, headers=headers or {})
+                response = connection.getresponse()
+                return response.status, response.read()
+            except (ConnectionError, http.client.HTTPException):
+                # the server closed an idle keep-alive connection, reconnect once
+                connection.close()
+                self._local.connection = None
+                if attempt == 2:
+                    raise
+
+
+class Tokens:
+    """Access tokens per account, logging in through the gateway on first use and before expiry."""
+
+    def __init__(self, gateway, accounts, endpoints):
+        self.gateway = gateway
+        self.endpoints = endpoints
+        self.by_role = defaultdict(list)
+        for account in accounts:
+            self.by_role[account["role"]].append(account)
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def login(self, account):
+        query = urlencode({"username": account["username"], "password": account["password"]})
+        status, body = self.gateway.request("GET", f"/api/users/authenticate/?{query}")
+        if status == 200:
+            token = json.loads(body)
+            with self._lock:
+                self._tokens[account["username"]] = (token["access_token"], token.get("exp", 0))
+        return status
+
+    def account_for(self, method, path, preferred=None, rng=random):
+        """preferred when the endpoint allows its role, otherwise a random account with an allowed role."""
+        roles = self.endpoints.get((method, endpoint_of(path)), [])
+        if not roles or (preferred is not None and preferred["role"] in roles):
+            return preferred
+        candidates = [account for role in roles for account in self.by_role.get(role, [])]
+        if not candidates:
+            raise SystemExit(f"no account with role {' or '.join(roles)} for {method} {endpoint_of(path)}")
+        return rng.choice(candidates)
+
+    def headers(self, account):
+        if account is None:
+            return {}
+        token = self._tokens.get(account["username"])
+        if token is None or token[1] - time.time() < 60:
+            self.login(account)
+            token = self._tokens.get(account["username"])
+        return {"Authorization": f"Bearer {token[0]}"} if token else {}
+
+
+class Job:
+    __slots__ = ("offset", "operation", "method", "path", "body", "headers", "account")
+
+    def __init__(self, offset, operation, method, path, body=None, headers=None, account=None):
+        self.offset = offset
+        self.operation = operation
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers or {}
+        self.account = account
+
+
+def poisson_offsets(rng, rate, duration):
+    offset = rng.expovariate(rate)
+    while offset < duration:
+        yield offset
+        offset += rng.expovariate(rate)
+
+
+def run_open_loop(gateway, tokens, jobs, workers):
+    """Send every job at its offset from the start, whatever happened to the requests before it."""
+    results = []
+    results_lock = threading.Lock()
+
+    def send(job, scheduled):
+        started = time.perf_counter()
+        status, error = None, None
+        try:
+            headers = dict(job.headers)
+            if job.operation == "login":
+                status = tokens.login(job.account)
+            else:
+                if tokens is not None and job.account is not None:
+                    headers.update(tokens.headers(job.account))
+                if job.body is not None:
+                    headers.setdefault("Content-Type", "application/json")
+                status, _ = gateway.request(job.method, job.path, headers, job.body)
+        except Exception as err:
+            error = f"{type(err).__name__}: {err}"
+        finished = time.perf_counter()
+        with results_lock:
+            results.append((job.operation, finished - scheduled, started - scheduled, status, error))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for job in jobs:
+            scheduled = start + job.offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, job, scheduled)
+    return results, time.perf_counter() - start
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def rank(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {"p50": rank(0.50), "p90": rank(0.90), "p99": rank(0.99), "p999": rank(0.999),
+            "max": ordered[-1] * 1000, "mean": sum(ordered) / len(ordered) * 1000}
+
+
+def summarize(results, elapsed):
+    def stats(rows):
+        statuses = Counter(str(status) for _, _, _, status, error in rows if error is None)
+        errors = [error for _, _, _, _, error in rows if error is not None]
+        server_errors = sum(count for status, count in statuses.items() if status.startswith("5"))
+        return {"requests": len(rows), "latency_ms": percentiles([latency for _, latency, _, _, _ in rows]),
+                "status_counts": dict(statuses), "errors": len(errors) + server_errors,
+                "error_samples": sorted(set(errors))[:5]}
+
+    by_operation = defaultdict(list)
+    for row in results:
+        by_operation[row[0]].append(row)
+    report = stats(results)
+    report.update({"duration_s": elapsed, "throughput_rps": len(results) / elapsed if elapsed else 0.0,
+                   "late_start_ms": percentiles([late for _, _, late, _, _ in results]),
+                   "operations": {operation: stats(rows) for operation, rows in sorted(by_operation.items())}})
+    return report
+
+
+def section_problems(database):
+    """Sections oversold, over the waitlist limit, or whose counters disagree with their registrations."""
+    connection = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+    rows = connection.execute("""
+        SELECT s.CourseCode, s.SectionNumber, s.MaxEnrollment, s.CurrentEnrollment, s.Waitlist,
+               COUNT(*) FILTER (WHERE r.Status = 'enrolled'), COUNT(*) FILTER (WHERE r.Status = 'waitlisted')
+        FROM Section s
+        LEFT JOIN RegistrationList r ON r.CourseCode = s.CourseCode AND r.SectionNumber = s.SectionNumber
+        GROUP BY s.CourseCode, s.SectionNumber
+    """).fetchall()
+    connection.close()
+    problems = {"oversold": set(), "waitlist_overflow": set(), "counter_mismatch": set()}
+    for course, section, maximum, current, waitlist, enrolled, waitlisted in rows:
+        key = f"{course}/{section}"
+        if enrolled > maximum or current > maximum:
+            problems["oversold"].add(key)
+        # claim_waitlist_spot admits while Waitlist <= WAITLIST_ALLOWED, so a full waitlist holds one more
+        if waitlisted > WAITLIST_ALLOWED + 1:
+            problems["waitlist_overflow"].add(key)
+        if current != enrolled or waitlist != waitlisted:
+            problems["counter_mismatch"].add(key)
+    return problems
+
+
+def integrity_report(before, after):
+    """Counts after the run, and the sections that went wrong during it (problems before it are excluded)."""
+    return {kind: {"sections": len(after[kind]), "new_during_run": sorted(after[kind] - before[kind])}
+            for kind in after}
+
+
+def rush_jobs(args, accounts, tokens, database):
+    rng = random.Random(args.seed)
+    connection = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+    departments = [row[0] for row in connection.execute("SELECT DISTINCT Department FROM Class")]
+    sections = connection.execute("SELECT CourseCode, SectionNumber FROM Section").fetchall()
+    connection.close()
+    students = [account for account in accounts if account["role"] == "student"]
+    if not students:
+        raise SystemExit("the accounts file has no student accounts")
+
+    operations, weights = zip(*args.mix.items())
+    for offset in poisson_offsets(rng, args.rate, args.duration):
+        operation = rng.choices(operations, weights)[0]
+        student = rng.choice(students)
+        course, section = rng.choice(sections)
+        registration = json.dumps({"student_id": student["cwid"], "course_code": course, "section_number": section})
+        if operation == "login":
+            yield Job(offset, operation, "GET", "/api/users/authenticate/", account=rng.choice(accounts))
+            continue
+        if operation == "classes":
+            method, path, body = "GET", f"/api/classes/?{urlencode({'department_name': rng.choice(departments)})}", None
+        elif operation == "enroll":
+            method, path, body = "POST", "/api/enrollment/", registration
+        elif operation == "drop":
+            method, path, body = "PUT", "/api/dropcourse/", registration
+        else:
+            method, path, body = "GET", f"/api/waitlist_position/?{urlencode({'student_id': student['cwid']})}", None
+        account = tokens.account_for(method, path, student, rng)
+        yield Job(offset, operation, method, path, body, account=account)
+
+
+def replay_jobs(args, entries, tokens):
+    rng = random.Random(args.seed)
+    first = entries[0].get("t", 0.0) if entries else 0.0
+    offsets = (poisson_offsets(rng, args.rate, float("inf")) if args.rate
+               else ((entry.get("t", 0.0) - first) / args.speed for entry in entries))
+    for entry, offset in zip(entries, offsets):
+        method = entry["method"].upper()
+        headers = dict(entry.get("headers", {}))
+        account = None
+        if tokens is not None:
+            # recorded tokens expire, sign the request again with a fresh one
+            headers.pop("Authorization", None)
+            account = tokens.account_for(method, entry["path"], rng=rng)
+        yield Job(offset, f"{method} {endpoint_of(entry['path'])}", method, entry["path"], entry.get("body"),
+                  headers, account)
+
+
+def record(args, endpoints):
+    target = urlsplit(args.target)
+    log = open(args.out, "a")
+    log_lock = threading.Lock()
+    start = time.monotonic()
+
+    class RecordingProxy(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _forward(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else None
+            headers = {name: value for name, value in self.headers.items() if name.lower() not in HOP_BY_HOP}
+            offset = time.monotonic() - start
+            upstream = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=60)
+            try:
+                upstream.request(self.command, self.path, body=body, headers=headers)
+                response = upstream.getresponse()
+                payload = response.read()
+                self.send_response(response.status)
+                for name, value in response.getheaders():
+                    if name.lower() not in HOP_BY_HOP:
+                        self.send_header(name, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                status = response.status
+            finally:
+                upstream.close()
+            if (self.command, endpoint_of(self.path)) in endpoints:
+                entry = {"t": round(offset, 6), "method": self.command, "path": self.path,
+                         "headers": {name: self.headers[name] for name in RECORDED_HEADERS if name in self.headers},
+                         "body": body.decode() if body else None, "status": status}
+                with log_lock:
+                    log.write(json.dumps(entry) + "\n")
+                    log.flush()
+
+        do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = _forward
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.listen), RecordingProxy)
+    print(f"recording {args.target} on http://127.0.0.1:{args.listen} to {args.out}, Ctrl-C to stop", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        log.close()
+
+
+def parse_mix(text):
+    mix = dict(RUSH_MIX)
+    if text:
+        mix = {}
+        for entry in text.split(","):
+            operation, _, weight = entry.partition("=")
+            if operation.strip() not in RUSH_MIX:
+                raise argparse.ArgumentTypeError(f"unknown operation {operation!r}, use {', '.join(RUSH_MIX)}")
+            mix[operation.strip()] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gateway", default=GATEWAY, help="KrakenD base URL")
+    parser.add_argument("--krakend-config", default=KRAKEND_CONFIG)
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subcommands.add_parser("record", help="record gateway traffic to a JSONL log")
+    record_parser.add_argument("--out", default="traffic.jsonl")
+    record_parser.add_argument("--listen", type=int, default=8081)
+
+    for name, help_text in (("replay", "replay a JSONL request log"), ("rush", "run a synthetic registration rush")):
+        run_parser = subcommands.add_parser(name, help=help_text)
+        run_parser.add_argument("--workers", type=int, default=256, help="most requests in flight at once")
+        run_parser.add_argument("--seed", type=int, default=449)
+        run_parser.add_argument("--enrollments-db", default=ENROLLMENTS_DB,
+                                help="database to read sections from and to check for oversold seats, '' to skip")
+        run_parser.add_argument("--report", help="write the JSON report here instead of stdout")
+        if name == "replay":
+            run_parser.add_argument("log")
+            run_parser.add_argument("--speed", type=float, default=1.0, help="replay this many times faster")
+            run_parser.add_argument("--rate", type=float, help="Poisson arrivals per second instead of recorded times")
+            run_parser.add_argument("--accounts", help="re-sign requests with tokens of these accounts")
+        else:
+            run_parser.add_argument("--accounts", required=True)
+            run_parser.add_argument("--rate", type=float, default=100.0, help="arrivals per second")
+            run_parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+            run_parser.add_argument("--mix", type=parse_mix, default=dict(RUSH_MIX),
+                                    help="operation weights, e.g. login=0.05,classes=0.45,enroll=0.25,drop=0.1,waitlist=0.15")
+    args = parser.parse_args()
+
+    endpoints = load_gateway_endpoints(args.krakend_config)
+    if args.command == "record":
+        args.target = args.gateway
+        record(args, endpoints)
+        return
+
+    gateway = Gateway(args.gateway)
+    accounts = load_jsonl(args.accounts) if args.accounts else []
+    tokens = Tokens(gateway, accounts, endpoints) if accounts else None
+    before = section_problems(args.enrollments_db) if args.enrollments_db else None
+    if args.command == "rush":
+        jobs = rush_jobs(args, accounts, tokens, args.enrollments_db or ENROLLMENTS_DB)
+        offered = args.rate
+    else:
+        entries = load_jsonl(args.log)
+        jobs = replay_jobs(args, entries, tokens)
+        offered = args.rate
+    results, elapsed = run_open_loop(gateway, tokens, jobs, args.workers)
+
+    report = {"mode": args.command, "gateway": args.gateway, "offered_rps": offered, "seed": args.seed}
+    report.update(summarize(results, elapsed))
+    if before is not None:
+        report["integrity"] = integrity_report(before, section_problems(args.enrollments_db))
+    output = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, "w") as report_file:
+            report_file.write(output + "\n")
+    else:
+        print(output)
+    oversold = report.get("integrity", {}).get("oversold", {}).get("new_during_run")
+    sys.exit(1 if oversold else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Micro-benchmark: SQL statements and time per request for the users service.
+
+Compares the old authenticate/create paths (existence check followed by a
+second lookup or insert) with the single-query data access in
+api/database_query.py. Runs against an in-memory copy of api/share/users.sql.
+
+Usage (from the repository root):
+    python -m benchmarks.users_query_count [--iterations N]
+"""
+
+import argparse
+import sqlite3
+import time
+
+from api.database_query import DuplicateRecordException, add_user, get_user_credentials
+from api.models import CreateUserRequest
+
+USERS_SCHEMA = "./api/share/users.sql"
+
+
+def open_users_db():
+    connection = sqlite3.connect(":memory:")
+    with open(USERS_SCHEMA) as schema:
+        connection.executescript(schema.read())
+    connection.isolation_level = None
+    return connection
+
+
+class StatementCounter:
+    """Counts statements run on a connection, ignoring transaction control."""
+
+    def __init__(self, connection):
+        self.count = 0
+        connection.set_trace_callback(self._trace)
+
+    def _trace(self, statement):
+        if statement.strip().upper() not in ("BEGIN", "COMMIT", "ROLLBACK"):
+            self.count += 1
+
+
+def legacy_authenticate(connection, username):
+    exists = connection.execute("SELECT * FROM Users WHERE username = ?", (username,)).fetchone()
+    if not exists:
+        return None
+    return connection.execute("SELECT * FROM Users WHERE username = ?", (username,)).fetchone()
+
+
+def legacy_create(connection, user):
+    if connection.execute("SELECT * FROM Users WHERE username = ?", (user.username,)).fetchone():
+        return False
+    connection.execute("BEGIN")
+    connection.execute(
+        "INSERT INTO Users (CWID, Name, Middle, LastName, username, password, Role) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (user.cwid, user.first_name, user.middle_name, user.last_name, user.username, user.password, user.role),
+    )
+    connection.execute("COMMIT")
+    return True
+
+
+def current_authenticate(connection, username):
+    return get_user_credentials(connection, username)
+
+
+def current_create(connection, user):
+    try:
+        add_user(connection, user)
+    except DuplicateRecordException:
+        return False
+    return True
+
+
+def new_user(cwid):
+    return CreateUserRequest(cwid=cwid, first_name="Bench", last_name="User",
+                             username=f"bench{cwid}", password="x", role="student")
+
+
+def run(label, authenticate, create, iterations):
+    connection = open_users_db()
+    counter = StatementCounter(connection)
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        authenticate(connection, f"student{i % 30 + 1}")
+    auth_elapsed = time.perf_counter() - start
+    auth_queries = counter.count
+
+    counter.count = 0
+    start = time.perf_counter()
+    for i in range(iterations):
+        create(connection, new_user(100000 + i))
+    create_elapsed = time.perf_counter() - start
+    create_queries = counter.count
+    connection.close()
+
+    print(f"{label:<8} authenticate: {auth_queries / iterations:.1f} queries/request, "
+          f"{auth_elapsed / iterations * 1e6:.1f} us/request")
+    print(f"{label:<8} create:       {create_queries / iterations:.1f} queries/request, "
+          f"{create_elapsed / iterations * 1e6:.1f} us/request")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+
+    run("legacy", legacy_authenticate, legacy_create, args.iterations)
+    run("current", current_authenticate, current_create, args.iterations)
+
+
+if __name__ == "__main__":
+    main()